@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 
 import contextlib
+import hashlib
+import http.server
+import json
 import os
+import struct
 import tempfile
+import threading
 import unittest
+import unittest.mock
+import zipfile
 
+from PIL import Image as PILImage
+
+from tools import cache
+from tools import common
 from tools import containers
+from tools import epoc
+from tools import iso9660
+from tools import merkle
+from tools import opolua
+from tools import remote
+from tools import scratch
+from tools import utils
 
-from tools.indexer import import_application, import_installer
+from tools.indexer import (INDEXER_VERSION, DirectoryCache, UnknownApplication, analyse_installer, import_application,
+                           import_installer, import_source, recognize_files)
 
 ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 EXAMPLES_DIRECTORY = os.path.join(ROOT_DIRECTORY, "examples")
@@ -20,11 +39,130 @@ def example_zip(path):
         yield temporary_directory
 
 
+def uid_header(uid1, uid2, uid3, checksum=None):
+    uids = struct.pack("<III", uid1, uid2, uid3)
+    return uids + struct.pack("<I", epoc.uid_checksum(uids) if checksum is None else checksum)
+
+
+def bitmap_stream(rows, bpp, compression=epoc.BITMAP_COMPRESSION_NONE):
+    # Packs rows of pixel values into a `CFbsBitmap` stream, with the first pixel in the least significant bits.
+    width, height = len(rows[0]), len(rows)
+    stride = ((width * bpp + 31) // 32) * 4
+    data = bytearray()
+    for row in rows:
+        line = bytearray(stride)
+        for index, value in enumerate(row):
+            line[index * bpp // 8] |= value << (index * bpp % 8)
+        data += line
+    if compression == epoc.BITMAP_COMPRESSION_BYTE_RLE:
+        chunks = [data[offset:offset + 0x80] for offset in range(0, len(data), 0x80)]
+        data = b"".join(bytes([0x100 - len(chunk)]) + chunk for chunk in chunks)
+    return epoc.BITMAP_HEADER.pack(epoc.BITMAP_HEADER.size + len(data), epoc.BITMAP_HEADER.size, width, height, 0, 0,
+                                   bpp, 0, 0, compression) + bytes(data)
+
+
+def aif_data(uid3, captions, icons):
+    # Builds an EPOC32 AIF with 8-bit captions and a list of (bitmap, mask) `bitmap_stream` pairs.
+    header_size = 20
+    icon_data = b""
+    icon_pointers = []
+    for bitmap, mask in icons:
+        icon_pointers.append(header_size + len(icon_data))
+        icon_data += bitmap + mask
+    trailer = bytes([len(captions) << 1])
+    for language, caption in captions.items():
+        trailer += bytes([len(caption) << 2]) + caption.encode("ascii") + struct.pack("<H", language)
+    trailer += bytes([len(icons) << 1])
+    for pointer in icon_pointers:
+        trailer += struct.pack("<IH", pointer, 0)
+    return (uid_header(epoc.UID_DIRECT_FILE_STORE, epoc.UID_APP_INFO_FILE, uid3)
+            + struct.pack("<I", header_size + len(icon_data)) + icon_data + trailer)
+
+
+def iso_record(name, extent, size, flags=0, system_use=b""):
+    padding = b"\0" if len(name) % 2 == 0 else b""
+    length = 33 + len(name) + len(padding) + len(system_use)
+    return (struct.pack("<BB", length, 0) + struct.pack("<I", extent) + struct.pack(">I", extent)
+            + struct.pack("<I", size) + struct.pack(">I", size) + bytes(7) + bytes([flags, 0, 0])
+            + struct.pack("<H", 1) + struct.pack(">H", 1) + bytes([len(name)]) + name + padding + system_use)
+
+
+def iso_directory(extent, records, system_use=b""):
+    # A single-sector directory at `extent`, with its '.' (holding `system_use`) and '..' records.
+    return (iso_record(b"\0", extent, iso9660.SECTOR_SIZE, iso9660.FLAG_DIRECTORY, system_use)
+            + iso_record(b"\1", extent, iso9660.SECTOR_SIZE, iso9660.FLAG_DIRECTORY)
+            + b"".join(records))
+
+
+def iso_image(sectors, root=20, joliet_root=None):
+    # Builds an image from a dictionary of sector contents, with the primary (and optionally Joliet) volume descriptors
+    # pointing at the root directories in the given sectors.
+    descriptors = [(iso9660.VOLUME_DESCRIPTOR_PRIMARY, b"", root)]
+    if joliet_root is not None:
+        descriptors.append((iso9660.VOLUME_DESCRIPTOR_SUPPLEMENTARY, b"%/E", joliet_root))
+    sector_count = max(sectors) + 1
+    image = bytearray(sector_count * iso9660.SECTOR_SIZE)
+    descriptors.append((iso9660.VOLUME_DESCRIPTOR_TERMINATOR, b"", None))
+    for index, (kind, escape_sequences, extent) in enumerate(descriptors):
+        offset = (iso9660.FIRST_VOLUME_DESCRIPTOR_SECTOR + index) * iso9660.SECTOR_SIZE
+        image[offset:offset + 6] = bytes([kind]) + iso9660.STANDARD_IDENTIFIER
+        image[offset + 88:offset + 88 + len(escape_sequences)] = escape_sequences
+        if extent is not None:
+            image[offset + 156:offset + 190] = iso_record(b"\0", extent, iso9660.SECTOR_SIZE, iso9660.FLAG_DIRECTORY)
+    for sector, data in sectors.items():
+        image[sector * iso9660.SECTOR_SIZE:sector * iso9660.SECTOR_SIZE + len(data)] = data
+    return bytes(image)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Stand-in for a web server that supports range requests, serving `server.data` at every path.
+
+    def do_HEAD(self):
+        self._respond(include_body=False)
+
+    def do_GET(self):
+        self._respond(include_body=True)
+
+    def _respond(self, include_body):
+        data = self.server.data
+        self.server.requests.append((self.command, self.headers.get("Range")))
+        start, end = 0, len(data) - 1
+        if self.headers.get("Range") is not None:
+            start, end = (int(value) for value in self.headers["Range"].removeprefix("bytes=").split("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def range_server(data):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.data = data
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
 class ExtractionTests(unittest.TestCase):
 
     maxDiff = None
 
-    def _import_installer(self, path):
+    def _import_installer(self, path, result_cache=None):
 
         errors = []
         def error_handler(error):
@@ -35,7 +173,8 @@ class ExtractionTests(unittest.TestCase):
                                          output_directory=temporary_directory,
                                          reference=[],
                                          path=path,
-                                         error_handler=error_handler)
+                                         error_handler=error_handler,
+                                         result_cache=result_cache)
         release = installer.as_dict(relative_icons_path="icons")
         return (release, errors)
 
@@ -77,6 +216,123 @@ class ExtractionTests(unittest.TestCase):
         self.assertEqual(icon['width'], 48)
         self.assertEqual(icon['height'], 48)
 
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            result_cache = cache.ResultCache(temporary_directory, version=INDEXER_VERSION)
+            path = os.path.join(EXAMPLES_DIRECTORY, "baseconv7.sis")
+            release, _ = self._import_installer(path, result_cache=result_cache)
+            cached_release, _ = self._import_installer(path, result_cache=result_cache)
+        self.assertEqual(cached_release, release)
+        self.assertEqual(result_cache.statistics.hits, 1)
+        self.assertEqual(result_cache.statistics.misses, 1)
+
+    def test_result_cache_skips_errors(self):
+
+        def analyse(path, error_handler):
+            error_handler(path, opolua.ResourceLimitExceeded("Timed out"))
+            return opolua.Installer(uid=0x10000123, name={"en_GB": "Example"}, version={"major": 1, "minor": 0},
+                                    files={}, icons=[])
+
+        errors = []
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+             unittest.mock.patch.object(opolua, "analyse_installer", analyse):
+            result_cache = cache.ResultCache(temporary_directory, version=INDEXER_VERSION)
+            for _ in range(2):
+                analyse_installer("example.sis", "0" * 64,
+                                  error_handler=lambda path, error: errors.append(error),
+                                  result_cache=result_cache)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(result_cache.statistics.hits, 0)
+
+    def test_result_cache_skips_non_candidates(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            paths = [os.path.join(temporary_directory, name) for name in ["example.app", "readme.txt"]]
+            for path, data in zip(paths, [uid_header(0x10000079, 0x1000006d, 0x10000123), b"Not a Psion file"]):
+                with open(path, "wb") as fh:
+                    fh.write(data)
+            result_cache = cache.ResultCache(os.path.join(temporary_directory, "cache"), version=INDEXER_VERSION)
+            with unittest.mock.patch.object(opolua, "NATIVE_PARSERS", True), \
+                 unittest.mock.patch.object(opolua, "recognize_batch",
+                                            lambda paths, error_handler=None: [{"type": "app"} for _ in paths]), \
+                 unittest.mock.patch.object(utils, "shasum", wraps=utils.shasum) as shasum:
+                results = recognize_files(paths, result_cache=result_cache)
+            self.assertEqual(results, {paths[0]: {"type": "app"}, paths[1]: {"type": "unknown"}})
+            shasum.assert_called_once_with(paths[0])
+            self.assertEqual(result_cache.statistics.misses, 1)
+
+    def test_fingerprint_cache(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.app")
+            with open(path, "wb") as fh:
+                fh.write(b"app")
+            os.utime(path, ns=(0, 0))  # Old enough to be saved.
+            cache_path = os.path.join(temporary_directory, "fingerprints.json")
+            fingerprint_cache = cache.FingerprintCache(cache_path)
+            self.assertEqual(fingerprint_cache.shasum(path), utils.file_shasum(path))
+            fingerprint_cache.save()
+
+            fingerprint_cache = cache.FingerprintCache(cache_path, verify_rate=1.0)
+            self.assertEqual(fingerprint_cache.shasum(path), utils.file_shasum(path))
+            self.assertEqual(fingerprint_cache.statistics.hits, 1)
+            self.assertEqual(fingerprint_cache.verified, 1)
+            self.assertEqual(fingerprint_cache.stale, 0)
+
+            with open(path, "wb") as fh:
+                fh.write(b"other")
+            self.assertEqual(fingerprint_cache.shasum(path), utils.file_shasum(path))
+            self.assertEqual(fingerprint_cache.statistics.misses, 1)
+
+    def test_ingest(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(EXAMPLES_DIRECTORY, "baseconv7.sis")
+            with self.assertRaises(ValueError):
+                with utils.ingest(path, temporary_directory):
+                    raise ValueError()
+            self.assertEqual(os.listdir(temporary_directory), [])
+            with utils.ingest(path, temporary_directory) as sha256:
+                self.assertEqual(sha256, utils.file_shasum(path))
+            with utils.ingest(path, temporary_directory):
+                pass
+            self.assertEqual(os.listdir(temporary_directory), [sha256])
+            self.assertEqual(utils.file_shasum(os.path.join(temporary_directory, sha256)), sha256)
+
+    def test_unknown_files_are_not_stored(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            output_directory = os.path.join(temporary_directory, "files")
+            os.makedirs(output_directory)
+            path = os.path.join(temporary_directory, "example.app")
+            with open(path, "wb") as fh:
+                fh.write(b"Not an application")
+            with self.assertRaises(UnknownApplication):
+                import_application(source={}, output_directory=output_directory, reference=[], path=path,
+                                   error_handler=None)
+            with unittest.mock.patch.object(opolua, "analyse_installer",
+                                            unittest.mock.Mock(side_effect=opolua.UnsupportedInstaller())):
+                with self.assertRaises(opolua.UnsupportedInstaller):
+                    import_installer(source={}, output_directory=output_directory, reference=[], path=path,
+                                     error_handler=None)
+            self.assertEqual(os.listdir(output_directory), [])
+
+    def test_merkle_tree(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            for path, data in [("App/example.app", b"app"), ("App/example.aif", b"aif"), ("other.txt", b"other")]:
+                path = os.path.join(temporary_directory, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as fh:
+                    fh.write(data)
+                os.utime(path, ns=(0, 0))
+            tree = merkle.build(temporary_directory)
+            self.assertEqual(merkle.subtree(tree, "App/example.app")["hash"], utils.file_shasum(
+                os.path.join(temporary_directory, "App", "example.app")))
+            self.assertEqual(merkle.changes(tree, merkle.build(temporary_directory, tree)), [])
+
+            # Renaming a file changes the tree, even though the contents are the same.
+            os.rename(os.path.join(temporary_directory, "other.txt"), os.path.join(temporary_directory, "renamed.txt"))
+            with open(os.path.join(temporary_directory, "App", "example.app"), "wb") as fh:
+                fh.write(b"changed")
+            self.assertEqual(merkle.changes(tree, merkle.build(temporary_directory, tree)),
+                             ["App/example.app", "other.txt", "renamed.txt"])
+
     def test_alternative_aif_extensions(self):
         release, errors = self._import_installer(os.path.join(EXAMPLES_DIRECTORY, "Checkers.sis"))
         self.assertTrue("icons" in release)
@@ -141,6 +397,487 @@ class ExtractionTests(unittest.TestCase):
                 ]
             })
 
+    def test_selective_extraction_matches_dumpsis(self):
+        def contents(path):
+            result = set()
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    with open(os.path.join(root, f), "rb") as fh:
+                        result.add((f.lower(), fh.read()))
+            return result
+        for path in ["baseconv7.sis", "watchdog.SIS"]:
+            with tempfile.TemporaryDirectory() as selected, tempfile.TemporaryDirectory() as extracted:
+                skipped = opolua.extract_installer_native(os.path.join(EXAMPLES_DIRECTORY, path), selected)
+                opolua.dumpsis_extract(os.path.join(EXAMPLES_DIRECTORY, path), extracted)
+                selected_contents = contents(selected)
+                extracted_contents = contents(extracted)
+            self.assertLessEqual(selected_contents, extracted_contents)
+            self.assertLessEqual(len(selected_contents) + len(skipped), len(extracted_contents))
+
+    def test_combined_analysis_matches_native(self):
+        for path in ["baseconv7.sis", "Checkers.sis"]:
+            path = os.path.join(EXAMPLES_DIRECTORY, path)
+            native = opolua.analyse_installer(path).as_dict()
+            with unittest.mock.patch.object(opolua, "NATIVE_PARSERS", False):
+                combined = opolua.analyse_installer(path).as_dict()
+            self.assertEqual(combined, native)
+
+    def test_resource_limits_propagate(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            script = os.path.join(temporary_directory, "recognize.lua")
+            with open(script, "w") as fh:
+                fh.write("local arguments = {...}\n"
+                         "if arguments[#arguments]:find(\"spin\") then while true do end end\n"
+                         "print('{\"type\": \"example\"}')\n")
+            paths = [os.path.join(temporary_directory, name) for name in ["a", "spin", "b"]]
+            for workers in [0, 1]:
+                with self.subTest(workers=workers), \
+                     unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", script), \
+                     unittest.mock.patch.object(opolua, "LUA_TIMEOUT", 1), \
+                     unittest.mock.patch.object(opolua, "LUA_WORKERS", workers), \
+                     unittest.mock.patch.object(opolua, "_pool", None):
+                    self.assertEqual(opolua.recognize_batch([paths[0], paths[2]]), [{"type": "example"}] * 2)
+                    with self.assertRaises(opolua.ResourceLimitExceeded):
+                        opolua.recognize_batch(paths)
+                    errors = []
+                    self.assertEqual(opolua.recognize_batch(paths, error_handler=lambda *args: errors.append(args)),
+                                     [{"type": "example"}, {"type": "unknown"}, {"type": "example"}])
+                    self.assertEqual([(path, type(error)) for path, error in errors],
+                                     [(paths[1], opolua.ResourceLimitExceeded)])
+
+    def test_directory_cache_skips_siblings(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            script = os.path.join(temporary_directory, "recognize.lua")
+            with open(script, "w") as fh:
+                fh.write("local arguments = {...}\n"
+                         "if arguments[#arguments]:find(\"spin\") then while true do end end\n"
+                         "print('{\"type\": \"opl\", \"era\": \"sibo\"}')\n")
+            directory_path = os.path.join(temporary_directory, "App")
+            os.makedirs(directory_path)
+            for name in ["example.app", "spin.dat"]:
+                with open(os.path.join(directory_path, name), "wb") as fh:
+                    fh.write(b"data")
+            with unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", script), \
+                 unittest.mock.patch.object(opolua, "NATIVE_PARSERS", False), \
+                 unittest.mock.patch.object(opolua, "LUA_TIMEOUT", 1), \
+                 unittest.mock.patch.object(opolua, "LUA_WORKERS", 1), \
+                 unittest.mock.patch.object(opolua, "_pool", None):
+                # The sibling that exceeds the limit is skipped, but the directory is still tagged (and memoized).
+                directory_cache = DirectoryCache()
+                self.assertEqual(directory_cache.tags(directory_path), {"opl", "sibo"})
+                self.assertEqual([(path, type(error)) for path, error in directory_cache.take_skipped(directory_path)],
+                                 [(os.path.join(directory_path, "spin.dat"), opolua.ResourceLimitExceeded)])
+                with unittest.mock.patch.object(opolua, "recognize_many",
+                                                unittest.mock.Mock(side_effect=AssertionError)):
+                    self.assertEqual(directory_cache.tags(directory_path), {"opl", "sibo"})
+                self.assertEqual(directory_cache.take_skipped(directory_path), [])
+
+    def test_worker_survives_lua_errors(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            script = os.path.join(temporary_directory, "recognize.lua")
+            with open(script, "w") as fh:
+                fh.write("local arguments = {...}\n"
+                         "if arguments[#arguments]:find(\"bad\") then error(\"malformed\") end\n"
+                         "print('{\"type\": \"example\"}')\n")
+            paths = [os.path.join(temporary_directory, name) for name in ["a", "bad", "b"]]
+            with unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", script), \
+                 unittest.mock.patch.object(opolua, "LUA_WORKERS", 1), \
+                 unittest.mock.patch.object(opolua, "_pool", None):
+                self.assertEqual(opolua.recognize_batch(paths),
+                                 [{"type": "example"}, {"type": "unknown"}, {"type": "example"}])
+
+            # Scripts that can't even be loaded are reported per file, and the worker carries on serving requests.
+            worker = opolua.LuaWorker()
+            try:
+                missing = os.path.join(temporary_directory, "missing.lua")
+                status, stdout, stderr = worker.request(["batch", missing, "0"] + paths)
+                self.assertEqual(status, 0)
+                self.assertTrue(all("error" in result for result in json.loads(stdout)))
+                status, stdout, stderr = worker.request(["run", script, paths[0]])
+                self.assertEqual((status, stdout.strip()), (0, b'{"type": "example"}'))
+            finally:
+                worker.close()
+
+    def test_directory_cache_forgets_containers(self):
+        directory_cache = DirectoryCache()
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.zip")
+            with zipfile.ZipFile(path, "w") as zip:
+                zip.writestr("App/example.app", b"app")
+                zip.writestr("App/example.aif", b"aif")
+            with containers.on_close(directory_cache.forget):
+                for (file_path, reference) in containers.walk(path, relative_to=temporary_directory):
+                    containers.materialize(file_path, siblings=True)
+                    self.assertEqual(directory_cache.find_sibling(file_path, "EXAMPLE.AIF"),
+                                     os.path.join(os.path.dirname(file_path), "example.aif"))
+                    self.assertEqual(list(directory_cache._listings.keys()), [os.path.dirname(file_path)])
+            self.assertEqual(directory_cache._listings, {})
+
+    def test_streaming_walk(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.zip")
+            with zipfile.ZipFile(path, "w") as zip:
+                zip.writestr("App/example.app", b"app")
+                zip.writestr("App/Data/example.dat", b"data")
+                zip.writestr("Other/other.txt", b"other")
+                zip.writestr("._example.app", b"resource")
+            assets = list(containers.walk(path, relative_to=temporary_directory))
+            self.assertEqual(sorted([[item.name for item in reference] for (_, reference) in assets]), [
+                ["example.zip", "App/Data/example.dat"],
+                ["example.zip", "App/example.app"],
+                ["example.zip", "Other/other.txt"],
+            ])
+            # Assets within the same container share the container's reference.
+            self.assertEqual(len({id(reference.parent) for (_, reference) in assets}), 1)
+            for (file_path, reference) in containers.walk(path, relative_to=temporary_directory):
+                if file_path.endswith(".app"):
+                    self.assertFalse(os.path.exists(file_path))
+                    containers.materialize(file_path, siblings=True)
+                    with open(file_path, "rb") as fh:
+                        self.assertEqual(fh.read(), b"app")
+                    contents_path = os.path.dirname(os.path.dirname(file_path))
+                    self.assertTrue(os.path.exists(os.path.join(contents_path, "App", "Data", "example.dat")))
+                    self.assertFalse(os.path.exists(os.path.join(contents_path, "Other", "other.txt")))
+
+    def test_parallel_walk(self):
+
+        def walk(path, relative_to):
+            assets = []
+            for (file_path, reference) in containers.walk(path, relative_to=relative_to):
+                containers.materialize(file_path, siblings=True)
+                with open(file_path, "rb") as fh:
+                    assets.append(([item.name for item in reference], fh.read()))
+            return assets
+
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            for index in range(6):
+                with zipfile.ZipFile(os.path.join(temporary_directory, f"example{index}.zip"), "w") as zip:
+                    zip.writestr("App/example.app", b"app %d" % index)
+                    zip.writestr("App/example.aif", b"aif %d" % index)
+                    zip.writestr("example.sis", b"sis %d" % index)
+                    zip.writestr("readme.txt", b"readme %d" % index)
+            with zipfile.ZipFile(os.path.join(temporary_directory, "nested.zip"), "w") as zip:
+                for index in range(3):
+                    zip.write(os.path.join(temporary_directory, f"example{index}.zip"), f"Disks/disk{index}.zip")
+            serial = walk(temporary_directory, temporary_directory)
+            with unittest.mock.patch.object(containers, "extraction_processes", 2), \
+                 unittest.mock.patch.object(containers, "_extraction_executor", None):
+                try:
+                    parallel = walk(temporary_directory, temporary_directory)
+                finally:
+                    containers._extraction_executor.shutdown()
+        self.assertEqual(len(serial), 36)
+        self.assertEqual(parallel, serial)
+
+    def test_scratch_budget_with_loose_installers(self):
+
+        def analyse(path, error_handler):
+            temporary_directory = scratch.TemporaryDirectory()
+            with temporary_directory:
+                temporary_directory.charge(1024)
+                return opolua.Installer(uid=0x10000123, name={"en_GB": "Example"}, version={"major": 1, "minor": 0},
+                                        files={}, icons=[])
+
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            source_directory = os.path.join(temporary_directory, "source")
+            output_directory = os.path.join(temporary_directory, "files")
+            os.makedirs(source_directory)
+            os.makedirs(output_directory)
+            for index in range(8):
+                with zipfile.ZipFile(os.path.join(source_directory, f"example{index}.zip"), "w") as zip:
+                    zip.writestr("example.sis", b"contained %d" % index)
+                with open(os.path.join(source_directory, f"example{index}.sis"), "wb") as fh:
+                    fh.write(b"loose %d" % index)
+            source = common.LocalSource(temporary_directory, source_directory)
+            apps = []
+            manager = scratch.ScratchManager(budget=1)
+            with unittest.mock.patch.object(scratch, "manager", manager), \
+                 unittest.mock.patch.object(opolua, "analyse_installer", analyse):
+                thread = threading.Thread(target=lambda: apps.extend(import_source(source, output_directory)))
+                thread.start()
+                thread.join(timeout=30)
+                deadlocked = thread.is_alive()
+                if deadlocked:
+                    # Lift the budget so the import can finish and the test fails rather than hanging.
+                    with manager._condition:
+                        manager.budget = float("inf")
+                        manager._condition.notify_all()
+                    thread.join()
+        self.assertFalse(deadlocked, "Import deadlocked waiting for scratch space")
+        self.assertEqual(manager.usage, 0)
+        self.assertEqual(len(apps), 16)
+
+    def test_remote_zip(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.zip")
+            with zipfile.ZipFile(path, "w") as zip:
+                zip.writestr("App/example.app", b"app")
+                zip.writestr("Padding/padding.bin", os.urandom(4 * 1024 * 1024))
+                zip.writestr("example.sis", b"sis")
+            with open(path, "rb") as fh:
+                data = fh.read()
+
+            def walk(url):
+                contents = {}
+                for (file_path, reference) in remote.walk(remote.open_archive(url), path,
+                                                          relative_to=temporary_directory):
+                    if not file_path.endswith(".bin"):
+                        containers.materialize(file_path)
+                        with open(file_path, "rb") as fh:
+                            contents[tuple(item.name for item in reference)] = fh.read()
+                return contents
+
+            block_cache = remote.BlockCache(os.path.join(temporary_directory, "ranges"))
+            with range_server(data) as server, unittest.mock.patch.object(remote, "block_cache", block_cache):
+                url = f"http://127.0.0.1:{server.server_port}/example.zip"
+                self.assertEqual(walk(url), {
+                    ("example.zip", "App/example.app"): b"app",
+                    ("example.zip", "example.sis"): b"sis",
+                })
+                fetched = [(start, end) for (command, header) in server.requests if command == "GET"
+                           for (start, end) in [map(int, header.removeprefix("bytes=").split("-"))]]
+                self.assertLess(sum(end - start + 1 for (start, end) in fetched), len(data) // 2)
+
+                # Everything the second walk needs is in the block cache.
+                server.requests.clear()
+                walk(url)
+                self.assertEqual([command for (command, header) in server.requests if command == "GET"], [])
+
+            # Archives that can't be reached are downloaded instead.
+            self.assertIsNone(remote.open_archive(f"http://127.0.0.1:{server.server_port}/example.zip"))
+
+    def test_internet_archive_verification(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            source = common.InternetArchiveSource(
+                temporary_directory, "https://archive.org/download/example/400%20psion%20programmas.zip")
+            data = b"Example"
+            os.makedirs(source.item_directory)
+            with open(source.path, "wb") as fh:
+                fh.write(data)
+            with open(source.file_metadata_path, "w") as fh:
+                fh.write("<files>"
+                         "<file name=\"400 psion programmas.zip\" source=\"original\">"
+                         f"<size>{len(data)}</size><sha1>{hashlib.sha1(data).hexdigest()}</sha1>"
+                         "</file>"
+                         "<file name=\"example_meta.xml\" source=\"metadata\"/>"
+                         "</files>")
+            self.assertEqual(list(source.file_records.keys()), ["400 psion programmas.zip"])
+            self.assertFalse(source.verified)
+            source.verify()
+            self.assertTrue(source.verified)
+
+    def test_native_parsers_match_opolua(self):
+        paths = [os.path.join(EXAMPLES_DIRECTORY, f) for f in os.listdir(EXAMPLES_DIRECTORY)]
+        with example_zip("blackjack5.zip") as path:
+            paths += [os.path.join(path, f) for f in os.listdir(path)]
+            comparison = epoc.compare(paths, reference_sis=opolua.dumpsis, reference_aif=opolua.dumpaif)
+        self.assertEqual(comparison.mismatches, [])
+        self.assertGreater(comparison.matches, 0)
+
+
+class EpocTests(unittest.TestCase):
+
+    def _read_aif_icons(self, data):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.aif")
+            with open(path, "wb") as fh:
+                fh.write(data)
+            return epoc.read_aif(path), epoc.read_aif_icons(path), opolua.get_icons(path)
+
+    def test_aif_icons(self):
+        pixels = [[0, 1, 2, 3, 3], [3, 2, 1, 0, 0]]
+        mask = [[3, 3, 2, 1, 0], [0, 1, 2, 3, 3]]
+        data = aif_data(0x10000123, {1: "Example"}, [
+            (bitmap_stream(pixels, 2), bitmap_stream(mask, 2, epoc.BITMAP_COMPRESSION_BYTE_RLE)),
+            (bitmap_stream([[0, 5, 10, 15]], 4), bitmap_stream([[1, 0, 1, 0]], 1)),
+        ])
+        info, bitmaps, icons = self._read_aif_icons(data)
+        self.assertEqual(info, {"uid3": 0x10000123, "captions": {"en_GB": "Example"}})
+        self.assertEqual([(bitmap.width, bitmap.height, bitmap.bpp, mask.bpp) for bitmap, mask in bitmaps],
+                         [(5, 2, 2, 2), (4, 1, 4, 1)])
+        self.assertEqual([(icon.width, icon.height, icon.bpp) for icon in icons], [(5, 2, 2), (4, 1, 4)])
+
+        # Pixels are scaled to the full greyscale range, and 2bpp masks become the inverted alpha channel, matching the
+        # `convert("L").point(lambda i: i * 85)` conversion applied to the masks written by dumpaif.
+        image = icons[0]._source
+        self.assertEqual(list(image.getchannel("R").tobytes()), [value * 85 for row in pixels for value in row])
+        baseline_mask = PILImage.frombytes("L", (5, 2), bytes(value for row in mask for value in row))
+        baseline_alpha = [255 - value for value in baseline_mask.convert("L").point(lambda i: i * 85).tobytes()]
+        self.assertEqual(list(image.getchannel("A").tobytes()), baseline_alpha)
+        self.assertEqual(list(opolua.bitmap_image(bitmaps[0][1]).tobytes()),
+                         [value * 85 for row in mask for value in row])
+
+        # Other masks are ignored.
+        image = icons[1]._source
+        self.assertEqual(list(image.getchannel("R").tobytes()), [0, 85, 170, 255])
+        self.assertEqual(list(image.getchannel("A").tobytes()), [255] * 4)
+        self.assertEqual(list(opolua.bitmap_image(bitmaps[1][1]).tobytes()), [255, 0, 255, 0])
+
+    def test_unsupported_aif_icons(self):
+        mask = bitmap_stream([[0, 0]], 2)
+        for bitmap in [bitmap_stream([[0, 0]], 16),  # Colour depth.
+                       bitmap_stream([[0, 0]], 2, compression=3),  # Compression.
+                       bitmap_stream([[0, 0]], 2)[:-1]]:  # Truncated data.
+            with self.subTest(bitmap=bitmap):
+                with tempfile.TemporaryDirectory() as temporary_directory:
+                    path = os.path.join(temporary_directory, "example.aif")
+                    with open(path, "wb") as fh:
+                        fh.write(aif_data(0x10000123, {1: "Example"}, [(bitmap, mask)]))
+                    with self.assertRaises(epoc.UnsupportedFile):
+                        epoc.read_aif_icons(path)
+
+    def test_uid_checksum(self):
+        uid1 = 0x10000123  # Not one of the well-known UIDs.
+        header = uid_header(uid1, 0x10000456, 0x10000789)
+        self.assertTrue(epoc.is_psion_header(header))
+        self.assertFalse(epoc.is_psion_header(uid_header(uid1, 0x10000456, 0x10000789, checksum=0x12345678)))
+        self.assertFalse(epoc.is_psion_header(uid_header(0, 0, 0)))
+        self.assertFalse(epoc.is_psion_header(header[:15]))
+
+        # Well-known UIDs are accepted regardless of the checksum.
+        self.assertTrue(epoc.is_psion_header(uid_header(epoc.UID_EXECUTABLE, 0, 0, checksum=0)))
+
+        # As are headers with other signatures.
+        self.assertTrue(epoc.is_psion_header(uid_header(uid1, 0, 0, checksum=0) + epoc.IMAGE_FILE_SIGNATURE))
+        self.assertTrue(epoc.is_psion_header(b"OPLObjectFile**\0"))
+        self.assertTrue(epoc.is_psion_header(epoc.SIBO_BITMAP_SIGNATURE + b"\0" * 12))
+        self.assertFalse(epoc.is_psion_header(b"<html>\n<head>\n"))
+
+    def test_is_candidate(self):
+        valid = uid_header(0x10000123, 0x10000456, 0x10000789) + b"\0" * 16
+        invalid = uid_header(0x10000123, 0x10000456, 0x10000789, checksum=0) + b"\0" * 16
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            for filename, data, expected in [("valid.app", valid, True),
+                                             ("invalid.app", invalid, False),
+                                             ("empty.txt", b"", False),
+                                             ("invalid.rsc", invalid, True),  # Resources have no UIDs.
+                                             ("PROGRAM.OPL", b"PROC main:\n", True)]:
+                with self.subTest(filename=filename):
+                    path = os.path.join(temporary_directory, filename)
+                    with open(path, "wb") as fh:
+                        fh.write(data)
+                    self.assertEqual(epoc.is_candidate(path), expected)
+                    self.assertEqual(epoc.is_candidate_data(filename, memoryview(data)), expected)
+
+class ContainerTests(unittest.TestCase):
+
+    def _read_iso(self, image):
+        # Returns the contents of an image as read by `iso9660.list_files`, checking the native container agrees.
+        files = {path: image[offset:offset + length] for (path, offset, length) in iso9660.list_files(image)}
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.iso")
+            with open(path, "wb") as fh:
+                fh.write(image)
+            container = containers.open_container(path)
+            try:
+                self.assertIsInstance(container, containers.IsoArchive)
+                contents = {}
+                for member in container.members:
+                    containers.materialize(member)
+                    with open(member, "rb") as fh:
+                        relative_path = os.path.relpath(member, container.contents_path)
+                        contents[relative_path.replace(os.path.sep, "/")] = fh.read()
+            finally:
+                container.__exit__(None, None, None)
+        self.assertEqual(contents, files)
+        return files
+
+    def test_iso_names(self):
+        image = iso_image({
+            20: iso_directory(20, [iso_record(b"APP", 21, iso9660.SECTOR_SIZE, iso9660.FLAG_DIRECTORY),
+                                   iso_record(b"NOEXT.;1", 22, 4),
+                                   iso_record(b"README.TXT;1", 23, 5)]),
+            21: iso_directory(21, [iso_record(b"EXAMPLE.APP;1", 24, 3)]),
+            22: b"data",
+            23: b"hello",
+            24: b"app",
+        })
+        self.assertEqual(self._read_iso(image), {
+            "APP/EXAMPLE.APP": b"app",
+            "NOEXT": b"data",
+            "README.TXT": b"hello",
+        })
+
+    def test_joliet_names(self):
+        def joliet_record(name, *args):
+            return iso_record(name.encode("utf-16-be"), *args)
+
+        image = iso_image({
+            20: iso_directory(20, [iso_record(b"README.TXT;1", 23, 5)]),
+            21: iso_directory(21, [joliet_record("Read Me.txt;1", 23, 5),
+                                   joliet_record("Ünïcode", 22, iso9660.SECTOR_SIZE, iso9660.FLAG_DIRECTORY)]),
+            22: iso_directory(22, [joliet_record("Café.app;1", 24, 3)]),
+            23: b"hello",
+            24: b"app",
+        }, joliet_root=21)
+        self.assertEqual(self._read_iso(image), {
+            "Read Me.txt": b"hello",
+            "Ünïcode/Café.app": b"app",
+        })
+
+    def test_rock_ridge_names(self):
+        def name_entry(name, flags=0):
+            return b"NM" + bytes([5 + len(name), 1, flags]) + name
+
+        continuation = name_entry(b"name.txt")
+        continuation_entry = (b"CE" + bytes([28, 1]) + struct.pack("<I", 25) + struct.pack(">I", 25)
+                              + struct.pack("<I", 0) + struct.pack(">I", 0)
+                              + struct.pack("<I", len(continuation)) + struct.pack(">I", len(continuation)))
+        image = iso_image({
+            20: iso_directory(20, [iso_record(b"CAFE.APP;1", 22, 3, 0, name_entry("café.app".encode("utf-8"))),
+                                   iso_record(b"LONGNA~1.TXT;1", 23, 5, 0,
+                                              name_entry(b"long-", iso9660.ROCK_RIDGE_NAME_CONTINUE)
+                                              + continuation_entry),
+                                   iso_record(b"PLAIN.TXT;1", 24, 5)],
+                              system_use=b"SP\x07\x01\xbe\xef\x00"),
+            22: b"app",
+            23: b"hello",
+            24: b"plain",
+            25: continuation,
+        })
+        self.assertEqual(self._read_iso(image), {
+            "café.app": b"app",
+            "long-name.txt": b"hello",
+            "PLAIN.TXT": b"plain",
+        })
+
+    def test_iso_multi_extent(self):
+        image = iso_image({
+            20: iso_directory(20, [iso_record(b"LARGE.DAT;1", 21, 4, iso9660.FLAG_MULTI_EXTENT)]),
+            21: b"data",
+        })
+        with self.assertRaises(iso9660.UnsupportedImage):
+            iso9660.list_files(image)
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "example.iso")
+            with open(path, "wb") as fh:
+                fh.write(image)
+            self.assertIsInstance(containers.open_iso(path), containers.SevenZipArchive)
+
+    def test_seven_zip_archive(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            # 7-Zip detects the format from the contents, so a zip is enough to exercise the listing and extraction.
+            path = os.path.join(temporary_directory, "example.7z")
+            with zipfile.ZipFile(path, "w") as zip:
+                zip.writestr("App/example.app", b"app")
+                zip.writestr("App/example.aif", b"aif")
+                zip.writestr("Other/other.txt", b"other")
+            container = containers.open_container(path)
+            try:
+                self.assertIsInstance(container, containers.SevenZipArchive)
+                members = {os.path.relpath(member, container.contents_path).replace(os.path.sep, "/"): member
+                           for member in container.members}
+                self.assertEqual(sorted(members.keys()), ["App/example.aif", "App/example.app", "Other/other.txt"])
+                # The files the indexer needs are extracted once the archive has been listed; the rest are extracted
+                # when they're materialized.
+                self.assertTrue(os.path.exists(members["App/example.aif"]))
+                self.assertFalse(os.path.exists(members["Other/other.txt"]))
+                containers.materialize(members["Other/other.txt"])
+                with open(members["Other/other.txt"], "rb") as fh:
+                    self.assertEqual(fh.read(), b"other")
+            finally:
+                container.__exit__(None, None, None)
+
 
 if __name__ == "__main__":
     unittest.main()
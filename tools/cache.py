@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from PIL import Image as PILImage
+
+from . import utils
+
+
+# The maximum sizes of the result and extraction caches in megabytes; the least recently used entries are removed once
+# they're exceeded.
+MAXIMUM_SIZE = int(os.environ.get("INDEXER_CACHE_SIZE", 1024)) * 1024 * 1024
+MAXIMUM_EXTRACTION_SIZE = int(os.environ.get("INDEXER_EXTRACTION_CACHE_SIZE", 4096)) * 1024 * 1024
+
+# The fraction of fingerprint cache hits that are re-hashed to catch stale entries (e.g., 0.01 checks one in a hundred).
+FINGERPRINT_VERIFY_RATE = float(os.environ.get("INDEXER_FINGERPRINT_VERIFY_RATE", 0))
+
+# Files modified this close to being hashed could change again without their fingerprint changing (timestamps have a
+# limited resolution on some filesystems), so their hashes are only kept for the current run.
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+
+class CacheStatistics(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.1%}), {self.evictions} evictions"
+
+
+class ResultCache(object):
+    """
+    On-disk cache of opolua results (parsed metadata, recognition details, and icons), keyed by the sha256 of the file
+    they describe. Entries are namespaced by the opolua revision and the indexer version so changes to either never
+    return stale results, and icons are stored once per image hash.
+
+    The cache is shared between sources and libraries, so writes are atomic to allow multiple indexers to use it at once.
+    """
+
+    def __init__(self, path, version, maximum_size=MAXIMUM_SIZE):
+        # Loading opolua resolves the Lua interpreter, so we only do so for the cache that needs it.
+        from . import opolua
+
+        self.path = path
+        self.maximum_size = maximum_size
+        namespace = hashlib.sha256(f"{version}:{opolua.revision()}".encode("utf-8")).hexdigest()[:16]
+        self.namespace_path = os.path.join(path, namespace)
+        self.icons_path = os.path.join(path, "icons")
+        self.statistics = CacheStatistics()
+        os.makedirs(self.namespace_path, exist_ok=True)
+        os.makedirs(self.icons_path, exist_ok=True)
+
+    def _entry_path(self, kind, sha256):
+        return os.path.join(self.namespace_path, sha256[:2], f"{sha256}.{kind}.json")
+
+    def _write(self, path, write):
+        directory_path = os.path.dirname(path)
+        os.makedirs(directory_path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory_path, delete=False) as fh:
+            temporary_path = fh.name
+        try:
+            write(temporary_path)
+            os.replace(temporary_path, path)
+        except:
+            os.unlink(temporary_path)
+            raise
+
+    def get(self, kind, sha256):
+        path = self._entry_path(kind, sha256)
+        try:
+            with open(path) as fh:
+                value = json.load(fh)
+            os.utime(path)  # Mark the entry as recently used.
+        except (OSError, ValueError):
+            self.statistics.record(hit=False)
+            return None
+        self.statistics.record(hit=True)
+        return value
+
+    def set(self, kind, sha256, value):
+        def write(path):
+            with open(path, "w") as fh:
+                json.dump(value, fh)
+        self._write(self._entry_path(kind, sha256), write)
+
+    def store_icons(self, icons):
+        """
+        Store the images for a list of `opolua.Image`s, returning their details for inclusion in a cache entry.
+        """
+        for icon in icons:
+            path = os.path.join(self.icons_path, icon.shasum + ".png")
+            if os.path.exists(path):
+                os.utime(path)
+                continue
+            self._write(path, lambda temporary_path: icon.save(temporary_path, format="PNG"))
+        return [icon.as_dict() for icon in icons]
+
+    def load_icons(self, icons):
+        """
+        Load the `opolua.Image`s for details previously returned by `store_icons`, raising `OSError` if any are missing.
+        """
+        from . import opolua
+
+        images = []
+        for icon in icons:
+            path = os.path.join(self.icons_path, icon["sha256"] + ".png")
+            with PILImage.open(path) as image:
+                image.load()
+            os.utime(path)
+            images.append(opolua.Image(width=icon["width"],
+                                       height=icon["height"],
+                                       bpp=icon["bpp"],
+                                       source=image,
+                                       shasum=icon["sha256"]))
+        return images
+
+    def trim(self):
+        """
+        Remove the least recently used files until the cache fits within its maximum size.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        trim(entries, self.maximum_size, self.statistics, os.unlink)
+
+
+def trim(entries, maximum_size, statistics, remove):
+    # Removes the oldest of a list of (mtime, size, path) entries until their total size is within `maximum_size`.
+    size = sum(entry_size for _, entry_size, _ in entries)
+    if size <= maximum_size:
+        return
+    logging.info("Trimming cache (%d MB)...", size // (1024 * 1024))
+    for _, entry_size, path in sorted(entries):
+        if size <= maximum_size:
+            break
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+        statistics.evictions += 1
+
+
+class ExtractionCache(object):
+    """
+    On-disk cache of the files extracted from containers, keyed by the sha256 of the container. Each entry holds the
+    container's member listing (if any) and the files that were extracted from it, which are linked (or copied) back
+    into place on a hit. Entries are never modified once they've been written.
+    """
+
+    def __init__(self, path, maximum_size=MAXIMUM_EXTRACTION_SIZE):
+        self.path = path
+        self.maximum_size = maximum_size
+        self.statistics = CacheStatistics()
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def restore(self, sha256, destination):
+        """
+        Restore the files for a container into `destination`, returning the entry's listing, or None if there's no
+        entry (or it's been evicted).
+        """
+        entry_path = self._entry_path(sha256)
+        files_path = os.path.join(entry_path, "files")
+        try:
+            with open(os.path.join(entry_path, "listing.json")) as fh:
+                listing = json.load(fh)
+            for root, dirs, files in os.walk(files_path):
+                for d in dirs:
+                    os.makedirs(os.path.join(destination, os.path.relpath(os.path.join(root, d), files_path)),
+                                exist_ok=True)
+                for f in files:
+                    source_path = os.path.join(root, f)
+                    utils.link_or_copy(source_path, os.path.join(destination, os.path.relpath(source_path, files_path)))
+            os.utime(entry_path)  # Mark the entry as recently used.
+        except (OSError, ValueError):
+            # Don't leave a partially restored entry behind, as the files are linked to those in the cache.
+            shutil.rmtree(destination, ignore_errors=True)
+            os.makedirs(destination, exist_ok=True)
+            self.statistics.record(hit=False)
+            return None
+        self.statistics.record(hit=True)
+        return listing
+
+    def store(self, sha256, source, paths, listing=None):
+        """
+        Store the files in `paths` (which must be within `source`) along with an optional listing of the container.
+        """
+        entry_path = self._entry_path(sha256)
+        if os.path.exists(entry_path):
+            return
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        temporary_path = tempfile.mkdtemp(dir=os.path.dirname(entry_path))
+        try:
+            for path in paths:
+                destination_path = os.path.join(temporary_path, "files", os.path.relpath(path, source))
+                os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+                utils.link_or_copy(path, destination_path)
+            with open(os.path.join(temporary_path, "listing.json"), "w") as fh:
+                json.dump(listing, fh)
+            os.rename(temporary_path, entry_path)
+        except OSError as e:
+            # Another indexer may have stored the same container first.
+            logging.debug("Failed to cache extracted files for '%s' with error '%s'.", sha256, e)
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    def trim(self):
+        """
+        Remove the least recently used entries until the cache fits within its maximum size.
+        """
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for sha256 in os.listdir(prefix_path):
+                entry_path = os.path.join(prefix_path, sha256)
+                try:
+                    entries.append((os.stat(entry_path).st_mtime, utils.directory_size(entry_path), entry_path))
+                except FileNotFoundError:
+                    continue
+        trim(entries, self.maximum_size, self.statistics, shutil.rmtree)
+
+
+class FingerprintCache(object):
+    """
+    Persistent cache of file hashes keyed by each file's fingerprint (device, inode, size, and modification and change
+    times), so unchanged files are only read once. Set `utils.fingerprint_cache` to have `utils.shasum` use the cache.
+
+    A `verify_rate` greater than zero re-hashes that fraction of hits, replacing (and counting) any stale entries. Entries
+    are saved along with the path they were recorded for, and those that no longer match the file at that path (e.g.,
+    files in scratch space) are dropped when the cache is saved.
+    """
+
+    def __init__(self, path, verify_rate=FINGERPRINT_VERIFY_RATE):
+        self.path = path
+        self.verify_rate = verify_rate
+        self.statistics = CacheStatistics()
+        self.verified = 0
+        self.stale = 0
+        self._entries = {}  # fingerprint -> (path, sha256, racy)
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fh:
+                for *fingerprint, file_path, sha256 in json.load(fh)["entries"]:
+                    self._entries[tuple(fingerprint)] = (file_path, sha256, False)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring fingerprint cache '%s' with error '%s'.", path, e)
+            self._entries = {}
+
+    def shasum(self, path):
+        fingerprint = utils.fingerprint(os.stat(path))
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+        self.statistics.record(hit=entry is not None)
+        if entry is not None:
+            if self.verify_rate <= 0 or random.random() >= self.verify_rate:
+                return entry[1]
+            with self._lock:
+                self.verified += 1
+
+        hashed_at = time.time_ns()
+        sha256 = utils.file_shasum(path)
+        if entry is not None and entry[1] != sha256:
+            logging.warning("Replacing stale fingerprint cache entry for '%s'.", path)
+            with self._lock:
+                self.stale += 1
+
+        self.record(path, fingerprint, sha256, hashed_at)
+        return sha256
+
+    def record(self, path, fingerprint, sha256, hashed_at):
+        """
+        Record the sha256 of a file that was read (e.g., by `utils.ingest`) starting at `hashed_at` (in nanoseconds), when
+        its fingerprint was `fingerprint`.
+        """
+        # Only record the hash if the file didn't change while it was being read.
+        if utils.fingerprint(os.stat(path)) == fingerprint:
+            racy = fingerprint[3] >= hashed_at - RACY_INTERVAL_NS
+            with self._lock:
+                self._entries[fingerprint] = (os.path.abspath(path), sha256, racy)
+
+    def save(self):
+        """
+        Write the entries that still match their files to disk, dropping the rest.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        rows = []
+        for fingerprint, (path, sha256, racy) in entries:
+            try:
+                if racy or utils.fingerprint(os.stat(path)) != fingerprint:
+                    self.statistics.evictions += 1
+                    continue
+            except OSError:
+                self.statistics.evictions += 1
+                continue
+            rows.append([*fingerprint, path, sha256])
+        directory_path = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory_path, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory_path, delete=False) as fh:
+            temporary_path = fh.name
+            try:
+                json.dump({"entries": rows}, fh)
+            except:
+                os.unlink(temporary_path)
+                raise
+        os.replace(temporary_path, self.path)
+
+    def __str__(self):
+        return f"{self.statistics} ({self.verified} verified, {self.stale} stale)"
@@ -21,6 +21,7 @@
 # SOFTWARE.
 
 import contextlib
+import hashlib
 import json
 import logging
 import os
@@ -29,6 +30,7 @@ import sys
 import tempfile
 
 from urllib.parse import quote_plus
+from urllib.parse import unquote
 from urllib.parse import urlparse
 
 import yaml
@@ -36,7 +38,9 @@ import yaml
 import xml.etree.ElementTree as ET
 
 from . import containers
+from . import merkle
 from . import model
+from . import remote
 from . import utils
 
 
@@ -84,6 +88,13 @@ class Library(object):
             self.intermediates_directory = os.environ["INDEXER_INTERMEDIATES_DIRECTORY"]
             logging.warning("Using $INDEXER_INTERMEDIATES_DIRECTORY environment variable (%s)", self.intermediates_directory)
 
+        # The result cache is shared between libraries by default, alongside the assets.
+        self.cache_directory = os.path.normpath(os.path.join(root_directory,
+                                                             self._configuration.get('cache_directory', '../_cache')))
+        if "INDEXER_CACHE_DIRECTORY" in os.environ:
+            self.cache_directory = os.environ["INDEXER_CACHE_DIRECTORY"]
+            logging.warning("Using $INDEXER_CACHE_DIRECTORY environment variable (%s)", self.cache_directory)
+
         self.index_directory = os.path.normpath(os.path.join(root_directory, self._configuration['index_directory']))
         self.output_directory = os.path.normpath(os.path.join(root_directory, self._configuration['output_directory']))
         self.sources = [create_source(self.assets_directory, url) for url in self._configuration['sources']]
@@ -132,9 +143,15 @@ class InternetArchiveSource(object):
         self.item_directory = os.path.join(root_directory, self.internet_archive_identifier)
         self.item_metadata_path = os.path.join(self.item_directory, f"{self.internet_archive_identifier}_meta.xml")
         self.file_metadata_path = os.path.join(self.item_directory, f"{self.internet_archive_identifier}_files.xml")
+        self.verification_path = os.path.join(self.item_directory,
+                                              f"{self.internet_archive_identifier}_verification.json")
         self.relative_path = os.path.join(*(path_components[2:]))
         self.path = os.path.join(self.item_directory, self.relative_path)
+        # Files are downloaded to their (percent-encoded) URL paths, but the item's file metadata uses decoded names.
+        self.file_name = unquote(self.relative_path)
         self._metadata = None
+        self._is_remote = None
+        self._remote_archive = None
 
     def sync(self):
         logging.info("Syncing '%s'...", self.internet_archive_identifier)
@@ -148,16 +165,137 @@ class InternetArchiveSource(object):
                 f"https://archive.org/download/{self.internet_archive_identifier}/{self.internet_archive_identifier}_files.xml",
             ], self.file_metadata_path)
         if not os.path.exists(self.path):
+            if self.is_remote:
+                logging.info("Reading '%s' remotely.", self.url)
+                return
             destination_directory = os.path.dirname(self.path)
             logging.info(destination_directory)
             os.makedirs(destination_directory, exist_ok=True)
             utils.download_file_with_mirrors([
                 self.url,
             ], self.path)
+        self.verify()
+
+    @property
+    def file_records(self):
+        """
+        The size and checksums listed in the item's file metadata for each of the source's files, keyed by their names
+        within the item, or None if the file metadata hasn't been downloaded or doesn't list them.
+        """
+        try:
+            root = ET.parse(self.file_metadata_path).getroot()
+        except (OSError, ET.ParseError):
+            return None
+        records = {}
+        for file in root.findall("./file"):
+            name = file.get("name")
+            if name == self.file_name or name.startswith(self.file_name + "/"):
+                records[name] = {key: file.findtext(key) for key in ["size", "md5", "sha1"]}
+        return records or None
+
+    def _file_path(self, name):
+        # Returns the path that a file listed in the item's file metadata was downloaded to.
+        if name == self.file_name:
+            return self.path
+        return os.path.join(self.path, os.path.relpath(name, self.file_name))
+
+    def _load_verification(self):
+        try:
+            with open(self.verification_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def verify(self):
+        """
+        Check downloaded files against the sizes and checksums in the item's file metadata, recording the results so
+        each file is only read once. Files that don't match are logged, and are hashed rather than being trusted.
+        """
+        records = self.file_records
+        if records is None:
+            return
+        verification = self._load_verification()
+        for name, record in records.items():
+            path = self._file_path(name)
+            try:
+                fingerprint = list(utils.fingerprint(os.stat(path)))
+            except FileNotFoundError:
+                continue
+            if name in verification and verification[name]["fingerprint"] == fingerprint:
+                continue
+            logging.info("Verifying '%s'...", name)
+            status = "verified"
+            if record["size"] is not None and int(record["size"]) != fingerprint[2]:
+                status = "mismatch"
+            elif record["sha1"] or record["md5"]:
+                algorithm = "sha1" if record["sha1"] else "md5"
+                with open(path, "rb") as fh:
+                    digest = hashlib.file_digest(fh, algorithm).hexdigest()
+                if digest != record[algorithm]:
+                    status = "mismatch"
+            if status != "verified":
+                logging.error("'%s' doesn't match the Internet Archive's file metadata.", path)
+            verification[name] = {"fingerprint": fingerprint, "status": status}
+        with open(self.verification_path, "w") as fh:
+            json.dump(verification, fh, indent=4)
+
+    @property
+    def verified(self):
+        """
+        True if every one of the source's downloaded files has been verified, and hasn't changed since.
+        """
+        records = self.file_records
+        if records is None:
+            return False
+        verification = self._load_verification()
+        for name in records.keys():
+            path = self._file_path(name)
+            try:
+                fingerprint = list(utils.fingerprint(os.stat(path)))
+            except FileNotFoundError:
+                return False
+            if (name not in verification
+                    or verification[name]["fingerprint"] != fingerprint
+                    or verification[name]["status"] != "verified"):
+                return False
+        return True
+
+    @property
+    def is_remote(self):
+        """
+        True if the source hasn't been downloaded and will be read in place using range requests (see
+        `tools/remote.py`); sources that can't be read remotely are downloaded as usual.
+        """
+        if os.path.exists(self.path) or not remote.ENABLED:
+            return False
+        if self._is_remote is None:
+            # Keep the archive for the first walk, as opening it reads the archive's directory.
+            self._remote_archive = remote.open_archive(self.url)
+            self._is_remote = self._remote_archive is not None
+        return self._is_remote
+
+    def tree(self, previous=None):
+        """
+        Return the Merkle tree (see `tools/merkle.py`) of the source's files, reusing the unchanged parts of `previous`.
+        """
+        records = self.file_records
+        if records is not None and (self.is_remote or self.verified):
+            # The item's file metadata lists the checksums of every file, so there's no need to hash the files.
+            def record_hash(record):
+                return hashlib.sha256(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+            if list(records.keys()) == [self.file_name]:
+                return {"hash": record_hash(records[self.file_name])}
+            return merkle.from_hashes((os.path.relpath(name, self.file_name), record_hash(record))
+                                      for name, record in records.items())
+        if self.is_remote:
+            # The file metadata isn't available, so we rely on the server to tell us if the file has changed.
+            with remote.RemoteFile(self.url) as file:
+                return {"hash": hashlib.sha256(json.dumps(file.identity, sort_keys=True).encode('utf-8')).hexdigest()}
+        return merkle.build(self.path, previous)
 
     @property
     def hash(self):
-        return utils.shasum(self.path)
+        return self.tree()["hash"]
 
     @property
     def metadata(self):
@@ -185,27 +323,40 @@ class InternetArchiveSource(object):
         # URLs. The work is delegated to the sources as they know how to generate source-specific download URLs (at
         # least until we start caching assets somewhere else).
 
-        source_reference = model.ReferenceItem(name=self.title, url=f"https://archive.org/details/{self.internet_archive_identifier}")
-
-        def resolve_reference(reference):
+        source_reference = model.Reference([
+            model.ReferenceItem(name=self.title, url=f"https://archive.org/details/{self.internet_archive_identifier}"),
+        ])
 
-            def resolve_root_reference_item(reference_item):
-                return model.ReferenceItem(name=reference_item.name, url=self.url)
+        def resolve_root_reference_item(reference_item):
+            return model.ReferenceItem(name=reference_item.name, url=self.url)
 
-            # TODO: Not all first-level containers (e.g., .bin) can be accessed on the Internet Archive.
-            def resolve_first_tier_reference_item(reference_item):
-                return model.ReferenceItem(name=reference_item.name,
-                                           url=self.url + "/" + quote_plus(reference_item.name))
+        # TODO: Not all first-level containers (e.g., .bin) can be accessed on the Internet Archive.
+        def resolve_first_tier_reference_item(reference_item):
+            return model.ReferenceItem(name=reference_item.name,
+                                       url=self.url + "/" + quote_plus(reference_item.name))
 
+        # References are resolved from their parents so the resolved references share their prefixes too.
+        def resolve_reference(reference):
             if len(reference) < 1:
-                return [source_reference]
+                return source_reference
             if len(reference) == 1:
-                return [source_reference, resolve_root_reference_item(reference[0])]
-            else:
-                root, first_tier, *tail = reference
-                return [source_reference, resolve_root_reference_item(root)] + [resolve_first_tier_reference_item(first_tier)] + tail
-
-        for path, reference in containers.walk(self.path, relative_to=self.item_directory):
+                return source_reference.append(resolve_root_reference_item(reference.item))
+            if len(reference) == 2:
+                return (resolve_reference(reference.parent)
+                        .append(resolve_first_tier_reference_item(reference.item)))
+            return resolve_reference(reference.parent).append(reference.item)
+
+        archive = None
+        if self.is_remote:
+            # Archives can only be walked once, so later walks open the archive again.
+            archive, self._remote_archive = self._remote_archive, None
+            if archive is None:
+                archive = remote.open_archive(self.url)
+        if archive is not None:
+            assets = remote.walk(archive, self.path, relative_to=self.item_directory)
+        else:
+            assets = containers.walk(self.path, relative_to=self.item_directory)
+        for path, reference in assets:
             yield (path, resolve_reference(reference))
 
     def as_dict(self):
@@ -231,9 +382,12 @@ class LocalSource(object):
     def sync(self):
         pass
 
+    def tree(self, previous=None):
+        return merkle.build(self.path, previous)
+
     @property
     def hash(self):
-        return utils.shasum(self.path)
+        return self.tree()["hash"]
 
     @property
     def assets(self):
@@ -261,11 +415,13 @@ class SnapshotSource(object):
 
         self.path = os.path.join(root_directory, "snapshots", identifier)
         self.identifier = utils.safe_identifier("snapshot-" + identifier)
-        self._contents_path = os.path.join(self.path, "contents.tar.gz")
         self._metadata_path = os.path.join(self.path, "metadata.json")
         self._metadata = None
 
     def sync(self):
+        # Loading the snapshot tool configures logging, so we only do so when it's needed.
+        from . import snapshot
+
         logging.info("Syncing '%s'...", self.url)
         if os.path.exists(self.path):
             return
@@ -275,11 +431,39 @@ class SnapshotSource(object):
             contents_path = os.path.join(temporary_directory, "contents")
             os.makedirs(contents_path)
             containers.extract_tar_gz(filename, contents_path)
+            if snapshot.migrate(contents_path):
+                logging.info("Converted '%s' to the current snapshot format.", self.url)
             shutil.move(contents_path, self.path)
 
+    @property
+    def _members_path(self):
+        return os.path.join(self.path, "contents.json")
+
+    @property
+    def _contents_path(self):
+        contents_path = os.path.join(self.path, "contents.zip")
+        if os.path.exists(self._members_path):
+            return contents_path
+        logging.warning("Reading legacy snapshot '%s'; use `manage migrate-snapshots` to convert it.", self.path)
+        return os.path.join(self.path, "contents.tar.gz")
+
+    def tree(self, previous=None):
+        # Loading the snapshot tool configures logging, so we only do so when it's needed.
+        from . import snapshot
+
+        # The member table lists the hash of every file, so there's no need to hash the contents themselves.
+        members = snapshot.read_members(self.path)
+        if members is None:
+            return merkle.build(self.path, previous)
+        metadata_filename = os.path.basename(self._metadata_path)
+        return merkle.directory_node({
+            metadata_filename: merkle.build(self._metadata_path, merkle.subtree(previous, metadata_filename)),
+            snapshot.CONTENTS_FILENAME: merkle.from_hashes((member["path"], member["sha256"]) for member in members),
+        })
+
     @property
     def hash(self):
-        return utils.shasum(self.path)
+        return self.tree()["hash"]
 
     @property
     def metadata(self):
@@ -303,17 +487,18 @@ class SnapshotSource(object):
     @property
     def assets(self):
 
-        source_reference = model.ReferenceItem(name=self.title, url=self.snapshot_url)
+        source_reference = model.Reference([model.ReferenceItem(name=self.title, url=self.snapshot_url)])
 
         def make_link(reference):
             return model.ReferenceItem(name=reference.name, url=self.snapshot_url + "/" + reference.name)
 
+        # References are resolved from their parents so the resolved references share their prefixes too.
         def resolve_reference(reference):
-            contents_reference = reference[1:]
-            if len(contents_reference) < 1:
-                return [source_reference]
-            else:
-                return [source_reference] + [make_link(contents_reference[0])] + contents_reference[1:]
+            if len(reference) <= 1:
+                return source_reference  # The contents archive itself.
+            if len(reference) == 2:
+                return source_reference.append(make_link(reference.item))
+            return resolve_reference(reference.parent).append(reference.item)
 
         for path, reference in containers.walk(self._contents_path, relative_to=self.path):
             yield path, resolve_reference(reference)
@@ -21,15 +21,72 @@
 # SOFTWARE.
 
 import collections
+import concurrent.futures
+import contextlib
 import logging
+import mmap
+import multiprocessing
 import os
+import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
 import zipfile
 import zlib
 
+from . import iso9660
 from . import model
+from . import scratch
+from . import utils
+
+
+# Set to a `cache.ExtractionCache` to reuse the files extracted from 7-Zip and tar.gz containers across runs. Streamed
+# containers are cheap to list and read, so aren't cached.
+extraction_cache = None
+
+# The number of processes the indexer uses to extract containers while walking; up to this many sibling containers are
+# opened ahead of the one being walked so they're extracted concurrently. 0 extracts containers one at a time, as
+# they're walked.
+EXTRACTION_PROCESSES = int(os.environ.get("INDEXER_EXTRACTION_PROCESSES", os.cpu_count() or 1))
+
+# Set to `EXTRACTION_PROCESSES` to extract containers on a process pool. Walks are otherwise sequential, and only read
+# the data they're asked for, so other commands (e.g., listing a source) never start processes or read ahead.
+extraction_processes = 0
+
+_extraction_executor = None
+_extraction_executor_lock = threading.Lock()
+
+
+def initialize_extraction_process(extraction_cache_path, block_cache_path):
+    # Extraction processes are spawned, so they need their own instances of the caches set up by the indexer.
+    global extraction_cache
+    from . import cache
+    from . import remote
+    if extraction_cache_path is not None:
+        extraction_cache = cache.ExtractionCache(extraction_cache_path)
+    if block_cache_path is not None:
+        remote.block_cache = remote.BlockCache(block_cache_path)
+
+
+def extraction_executor():
+    """
+    Return the process pool shared by all walks, or None if `extraction_processes` is 0.
+    """
+    global _extraction_executor
+    if extraction_processes <= 0:
+        return None
+    from . import remote
+    with _extraction_executor_lock:
+        if _extraction_executor is None:
+            # The indexer is multi-threaded, so it's not safe to fork.
+            _extraction_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=extraction_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initialize_extraction_process,
+                initargs=(extraction_cache.path if extraction_cache is not None else None,
+                          remote.block_cache.path if remote.block_cache is not None else None))
+        return _extraction_executor
 
 
 def extract_7z(source, destination):
@@ -70,53 +127,576 @@ def get_extraction_method(path):
     return None
 
 
-class Extractor(object):
+class ExtractionError(Exception):
+    pass
 
-    def __init__(self, path, method):
+
+class Leases(object):
+    """
+    Counts the files inside open containers that are still being worked on, allowing `walk` to move on to the next file
+    while earlier ones are imported on other threads. Containers wait for their leases to be released before they clean
+    up their temporary directories, and then tell any listeners that the container has closed.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._counts = {}
+        self._listeners = []
+
+    def register(self, contents_path):
+        with self._condition:
+            self._counts[contents_path] = 0
+
+    def unregister(self, contents_path):
+        with self._condition:
+            self._condition.wait_for(lambda: self._counts[contents_path] == 0)
+            del self._counts[contents_path]
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(contents_path)
+
+    @contextlib.contextmanager
+    def listen(self, listener):
+        with self._condition:
+            self._listeners.append(listener)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._listeners.remove(listener)
+
+    def lease(self, path):
+        with self._condition:
+            candidates = [contents_path for contents_path in self._counts.keys()
+                          if path.startswith(contents_path + os.path.sep)]
+            if not candidates:
+                return None
+            contents_path = max(candidates, key=len)  # The innermost container.
+            self._counts[contents_path] += 1
+
+        def release():
+            with self._condition:
+                self._counts[contents_path] -= 1
+                self._condition.notify_all()
+
+        return release
+
+
+leases = Leases()
+
+
+def lease(path):
+    """
+    Keep the container holding a path returned by `walk` open until the returned function is called. Returns None for
+    paths that aren't in a container, as they're always available.
+    """
+    return leases.lease(path)
+
+
+def on_close(listener):
+    """
+    Call `listener` with the path of each container's contents once the container's leases have been released and it's
+    closing, until the returned context manager exits. Used to discard state that refers to the container's files.
+    """
+    return leases.listen(listener)
+
+
+def member_path(name):
+    # Sanitize member names in the same way as `zipfile.ZipFile.extract` to ensure they stay inside the destination.
+    name = os.path.splitdrive(name.replace("/", os.path.sep))[1]
+    return os.path.sep.join(x for x in name.split(os.path.sep) if x not in ("", os.path.curdir, os.path.pardir))
+
+
+class ArchiveMember(str):
+    """
+    Path of a file in a streamed archive. The path is where the file will be written in the archive's temporary
+    directory, but nothing is written until it's materialized (see `materialize`) or prefetched (see
+    `StreamingArchive.prefetch`).
+    """
+
+    def __new__(cls, path, archive):
+        member = super().__new__(cls, path)
+        member.archive = archive
+        return member
+
+
+class StreamingArchive(object):
+    """
+    Lists the members of an archive without extracting it, writing individual members (or directories of members) to a
+    temporary directory on demand. Subclasses implement `_open_archive`, `_list`, and either `_open_member` or
+    `_extract`.
+
+    The members the indexer is going to need can also be extracted up front (see `prefetch`), optionally in another
+    process; archives are pickled without their open file, which is opened again by the extraction process.
+    """
+
+    # Set for archives that are expensive to extract from one member at a time, so the indexer's members are always
+    # extracted up front.
+    EXTRACT_CANDIDATES = False
+
+    def __init__(self, path):
         self.path = os.path.abspath(path)
-        self.method = method
+        self._archive = None
+        self._members = {}
+        self._materialized = set()
+        self._prefetch = None
 
     def __enter__(self):
-        self.pwd = os.getcwd()
-        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.temporary_directory = scratch.TemporaryDirectory()
+        self.contents_path = self.temporary_directory.name
+        leases.register(self.contents_path)
         try:
-            self.method(self.path, self.temporary_directory.name)
-            return self.temporary_directory.name
+            self._archive = self._open_archive(self.path)
+            for name, member in self._list():
+                relative_path = member_path(name)
+                if relative_path:
+                    self._members[os.path.join(self.contents_path, relative_path)] = member
         except:
-            self.temporary_directory.cleanup()
+            self.__exit__(None, None, None)
             raise
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            concurrent.futures.wait([self._prefetch])  # The extraction process is writing to our directory.
+        leases.unregister(self.contents_path)
+        if self._archive is not None:
+            self._archive.close()
         self.temporary_directory.cleanup()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_archive"] = None
+        state["_prefetch"] = None
+        return state
 
-def walk(path, reference=None, relative_to=None):
-    reference = reference if reference is not None else []
-    path = os.path.abspath(path)
-    if os.path.isdir(path):
-        for root, dirs, files in os.walk(path):
-            files = [f for f in files if not f.startswith("._")]  # Ignore resource files.
-            for a in [os.path.join(root, f) for f in files]:
-                reference_item = model.ReferenceItem(name=os.path.relpath(a, relative_to), url=None)
-                for (inner_path, inner_reference) in walk(a, reference=reference, relative_to=relative_to):
-                    yield (inner_path, inner_reference)
-    else:
-        reference_item = model.ReferenceItem(name=os.path.relpath(path, relative_to), url=None)
-        extraction_method = get_extraction_method(path)
-        if extraction_method is not None:
-            logging.debug("Extracting '%s'...", path)
+    @property
+    def members(self):
+        return [ArchiveMember(path, self) for path in self._members.keys()]
+
+    def candidates(self):
+        """
+        Return the paths of the members the indexer is going to need: the files it imports (see `INDEXED_EXTENSIONS`),
+        and the rest of the directory for applications.
+        """
+        paths = [path for path in self._members.keys()
+                 if is_indexed(path) and not os.path.basename(path).startswith("._")]  # Ignore resource files.
+        for path in list(paths):
+            _, ext = os.path.splitext(path)
+            if ext.lower() in APPLICATION_EXTENSIONS:
+                directory_path = os.path.dirname(path) + os.path.sep
+                paths += [candidate_path for candidate_path in self._members.keys()
+                          if candidate_path.startswith(directory_path)]
+        return sorted(set(paths) - self._materialized)
+
+    def prefetch(self, executor=None):
+        """
+        Extract the members returned by `candidates`, using a process from `executor` if one is given, in which case
+        extraction continues in the background and is waited for when members are materialized. Members that fail to
+        extract are left to be extracted (and to report their errors) on demand.
+        """
+        paths = self.candidates()
+        if not paths:
+            return
+        if executor is not None:
+            self._prefetch = executor.submit(extract_members, self, paths)
+            return
+        try:
+            self._extract(paths)
+        except ExtractionError as e:
+            logging.debug("Failed to prefetch files from '%s' with error '%s'.", self.path, e)
+            return
+        self._prefetched()
+
+    def _wait(self):
+        if self._prefetch is None:
+            return
+        prefetch, self._prefetch = self._prefetch, None
+        try:
+            materialized, size = prefetch.result()
+        except Exception as e:  # Including failures of the extraction process itself.
+            logging.debug("Failed to prefetch files from '%s' with error '%s'.", self.path, e)
+            return
+        self._materialized.update(materialized)
+        self.temporary_directory.charge(size)
+        self._prefetched()
+
+    def _prefetched(self):
+        pass
+
+    def _extract(self, paths):
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             try:
-                with Extractor(path, method=extraction_method) as contents_path:
-                    for (inner_path, inner_reference) in walk(contents_path,
-                                                              reference=reference + [reference_item],
-                                                              relative_to=contents_path):
-                        yield (inner_path, inner_reference)
+                with self._open_member(self._members[path]) as source, open(path, "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+                    self.temporary_directory.charge(destination.tell())
             except (NotImplementedError,
+                    zipfile.BadZipFile,
+                    OSError, RuntimeError, EOFError,
+                    tarfile.TarError,
+                    zlib.error) as e:
+                raise ExtractionError(f"Failed to extract '{os.path.relpath(path, self.contents_path)}' from "
+                                      f"'{self.path}' with error '{e}'") from e
+            self._materialized.add(path)
+
+    def materialize(self, path, siblings=False):
+        self._wait()
+        if siblings:
+            directory_path = os.path.dirname(path) + os.path.sep
+            paths = [candidate_path for candidate_path in self._members.keys()
+                     if candidate_path.startswith(directory_path)]
+        else:
+            paths = [path]
+        self._extract([path for path in paths if path not in self._materialized])
+
+
+class ZipArchive(StreamingArchive):
+
+    def _open_archive(self, path):
+        return zipfile.ZipFile(path)
+
+    def _list(self):
+        return [(info.filename, info) for info in self._archive.infolist() if not info.is_dir()]
+
+    def _open_member(self, member):
+        return self._archive.open(member)
+
+
+class TarArchive(StreamingArchive):
+
+    def _open_archive(self, path):
+        return tarfile.TarFile(path)
+
+    def _list(self):
+        # Symbolic links and special files are skipped; hard links are read from their targets.
+        return [(info.name, info) for info in self._archive.getmembers() if info.isreg() or info.islnk()]
+
+    def _open_member(self, member):
+        return self._archive.extractfile(member)
+
+
+class SevenZipArchive(StreamingArchive):
+    """
+    7-Zip can't stream individual members, so the members the indexer is going to need (see `candidates`) are
+    extracted in a single invocation when the archive is walked, and anything else is extracted on demand.
+    """
+
+    EXTRACT_CANDIDATES = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._sha256 = None
+        self._restored = False
+
+    def __enter__(self):
+        super().__enter__()
+        if self._restored:
+            self._materialized.update(path for path in self._members.keys() if os.path.exists(path))
+            self.temporary_directory.charge(utils.directory_size(self.contents_path))
+        return self
+
+    def _prefetched(self):
+        logging.debug("Extracted %d of %d files from '%s'.", len(self._materialized), len(self._members), self.path)
+        if self._sha256 is not None and not self._restored:
+            extraction_cache.store(self._sha256, self.contents_path, self._materialized,
+                                   listing=list(self._members.values()))
+
+    def _open_archive(self, path):
+        return None
+
+    def _list(self):
+        if extraction_cache is not None:
+            self._sha256 = utils.shasum(self.path)
+            listing = extraction_cache.restore(self._sha256, self.contents_path)
+            if listing is not None:
+                self._restored = True
+                return [(name, name) for name in listing]
+
+        # `7z l -slt` prints a block of 'key = value' lines for the archive, followed by one for each member.
+        output = subprocess.run(["7z", "l", "-slt", "-sccUTF-8", self.path], capture_output=True, check=True).stdout
+        _, _, output = output.decode("utf-8", errors="surrogateescape").partition("\n----------\n")
+        members = []
+        for block in output.split("\n\n"):
+            fields = dict(line.split(" = ", 1) for line in block.splitlines() if " = " in line)
+            if "Path" not in fields:
+                continue
+            if fields.get("Folder") == "+" or fields.get("Attributes", "").startswith("D"):
+                continue
+            members.append((fields["Path"], fields["Path"]))
+        return members
+
+    def _extract(self, paths):
+        if not paths:
+            return
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", errors="surrogateescape", suffix=".txt") as fh:
+            fh.write("".join(self._members[path] + "\n" for path in paths))
+            fh.flush()
+            try:
+                subprocess.run(["7z", "x", "-y", "-scsUTF-8", "-o%s" % self.contents_path, self.path, "@" + fh.name],
+                               capture_output=True, check=True)
+            except subprocess.CalledProcessError as e:
+                raise ExtractionError(f"Failed to extract {len(paths)} files from '{self.path}' with error "
+                                      f"'{e.stderr.decode('utf-8', errors='replace').strip()}'") from e
+        for path in paths:
+            if os.path.exists(path):
+                self._materialized.add(path)
+                self.temporary_directory.charge(os.path.getsize(path))
+            else:
+                logging.warning("Failed to extract '%s' from '%s'.", self._members[path], self.path)
+
+
+class IsoArchive(StreamingArchive):
+    """
+    Reads ISO9660 images natively, copying member data straight out of a memory-mapped image. Use `open_iso`, which
+    falls back to 7-Zip for images this can't read.
+    """
+
+    def __init__(self, path, files):
+        super().__init__(path)
+        self._files = files
+
+    def _open_archive(self, path):
+        with open(path, "rb") as fh:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _list(self):
+        return [(name, (offset, length)) for name, offset, length in self._files]
+
+    def _extract(self, paths):
+        with memoryview(self._archive) as data:
+            for path in paths:
+                offset, length = self._members[path]
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with data[offset:offset + length] as contents, open(path, "wb") as fh:
+                    fh.write(contents)
+                self.temporary_directory.charge(length)
+                self._materialized.add(path)
+
+
+def extract_members(archive, paths):
+    # Runs in an extraction process, returning the paths that were extracted and their total size.
+    size = archive.temporary_directory.size
+    archive._archive = archive._open_archive(archive.path)
+    try:
+        archive._extract(paths)
+    finally:
+        if archive._archive is not None:
+            archive._archive.close()
+    return archive._materialized, archive.temporary_directory.size - size
+
+
+def open_iso(path):
+    try:
+        with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            files = iso9660.list_files(data)
+    except (iso9660.UnsupportedImage, ValueError) as e:
+        logging.debug("Using 7-Zip to read '%s' (%s).", path, e)
+        return SevenZipArchive(path)
+    return IsoArchive(path, files)
+
+
+# Extensions of the files the indexer imports, which are always extracted from archives that can't be streamed;
+# applications are imported along with the rest of their directory.
+INDEXED_EXTENSIONS = [".app", ".opa", ".sis"]
+APPLICATION_EXTENSIONS = [".app", ".opa"]
+
+# Containers that can be walked without extracting them. Everything else is extracted using `CONTAINER_MAPPING`.
+STREAMING_MAPPING = {
+    ".7z": SevenZipArchive,
+    ".cab": SevenZipArchive,
+    ".ima": SevenZipArchive,
+    ".iso": open_iso,
+    ".tar": TarArchive,
+    ".vhd": SevenZipArchive,
+    ".zip": ZipArchive,
+}
+
+
+def get_streaming_archive(path):
+    for ext, archive_class in STREAMING_MAPPING.items():
+        if path.lower().endswith(ext):
+            return archive_class
+    return None
+
+
+def is_indexed(path):
+    _, ext = os.path.splitext(path)
+    return (ext.lower() in INDEXED_EXTENSIONS
+            or get_streaming_archive(path) is not None
+            or get_extraction_method(path) is not None)
+
+
+def materialize(path, siblings=False):
+    """
+    Ensure a path returned by `walk` exists on disk, along with the rest of its directory (recursively) if `siblings` is
+    set. Paths that aren't members of a streamed archive are already on disk, so are returned unchanged. Raises
+    `ExtractionError` if the archive is damaged.
+    """
+    if isinstance(path, ArchiveMember):
+        path.archive.materialize(path, siblings=siblings)
+    return path
+
+
+class Extractor(object):
+    """
+    Extracts a whole container to a temporary directory, using a process from `executor` if one is given (see
+    `extract`). Use `wait` to get the path of the contents once extraction has finished.
+    """
+
+    def __init__(self, path, method):
+        self.path = os.path.abspath(path)
+        self.method = method
+        self._sha256 = None
+        self._extraction = None
+        self._restored = False
+
+    def __enter__(self):
+        self.temporary_directory = scratch.TemporaryDirectory()
+        self.contents_path = self.temporary_directory.name
+        leases.register(self.contents_path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._extraction is not None:
+            self._extraction.cancel()
+            concurrent.futures.wait([self._extraction])  # The extraction process is writing to our directory.
+        leases.unregister(self.contents_path)
+        self.temporary_directory.cleanup()
+
+    def extract(self, executor=None):
+        if extraction_cache is not None:
+            self._sha256 = utils.shasum(self.path)
+            if extraction_cache.restore(self._sha256, self.contents_path) is not None:
+                self._restored = True
+                return
+        if executor is not None:
+            self._extraction = executor.submit(self.method, self.path, self.contents_path)
+        else:
+            self.method(self.path, self.contents_path)
+
+    def wait(self):
+        if self._extraction is not None:
+            extraction, self._extraction = self._extraction, None
+            extraction.result()
+        if self._sha256 is not None and not self._restored:
+            extraction_cache.store(self._sha256, self.contents_path, [os.path.join(root, f)
+                                                                      for root, dirs, files in os.walk(self.contents_path)
+                                                                      for f in files])
+        self.temporary_directory.charge(utils.directory_size(self.contents_path))
+        return self.contents_path
+
+
+# Errors that mean a container (or a container within it) can't be read.
+CONTAINER_ERRORS = (NotImplementedError,
                     zipfile.BadZipFile,
                     OSError, RuntimeError,
                     tarfile.ReadError,
                     zlib.error,
-                    subprocess.CalledProcessError) as e:
-                logging.warning("Failed to extract file '%s' with error '%s'.", path, e)
-        else:
-            yield (path, reference + [reference_item])
+                    subprocess.CalledProcessError,
+                    ExtractionError)
+
+
+def is_container(path):
+    return get_streaming_archive(path) is not None or get_extraction_method(path) is not None
+
+
+def open_container(path, executor=None):
+    """
+    Open a container for walking, starting to extract the files the indexer needs (using a process from `executor` if
+    one is given). The caller is responsible for calling `__exit__` on the returned container.
+    """
+    archive_class = get_streaming_archive(path)
+    if archive_class is not None:
+        logging.debug("Reading '%s'...", path)
+        container = archive_class(path).__enter__()
+    else:
+        logging.debug("Extracting '%s'...", path)
+        container = Extractor(path, method=get_extraction_method(path)).__enter__()
+    try:
+        if isinstance(container, Extractor):
+            container.extract(executor)
+        elif executor is not None or container.EXTRACT_CANDIDATES:
+            container.prefetch(executor)
+    except:
+        container.__exit__(None, None, None)
+        raise
+    return container
+
+
+def walk_container(container, reference):
+    # Walks, and then closes, a container returned by `open_container`.
+    try:
+        if isinstance(container, Extractor):
+            contents_path = container.wait()
+            yield from walk(contents_path, reference=reference, relative_to=contents_path)
+            return
+        members = [member for member in container.members
+                   if not os.path.basename(member).startswith("._")]  # Ignore resource files.
+        yield from walk_files(members, reference=reference, relative_to=container.contents_path)
+    finally:
+        container.__exit__(None, None, None)
+
+
+def walk_files(paths, reference, relative_to):
+    # Walks a list of files (or members of an archive) in order. When there's an extraction process pool, containers
+    # are opened ahead of the one that's being walked, up to one per process, so sibling containers are extracted
+    # concurrently; the walk itself (and so the order of the results) is unchanged.
+    executor = extraction_executor()
+    lookahead = extraction_processes if executor is not None else 0
+    upcoming = collections.deque(path for path in paths if is_container(path))
+    opened = collections.OrderedDict()
+
+    def open_next():
+        if not upcoming:
+            return False
+        # Containers are only opened ahead while the scratch space is within budget, and never wait for it, as we might
+        # be holding the space that's needed.
+        if opened and not scratch.manager.has_space():
+            return False
+        path = upcoming.popleft()
+        try:
+            with scratch.manager.nested() if opened else contextlib.nullcontext():
+                materialize(path)  # Nested containers need to be on disk to be walked.
+                opened[path] = open_container(path, executor=executor)
+        except ExtractionError as e:
+            logging.warning("Failed to extract file '%s' with error '%s'.", path, e)
+            opened[path] = None
+        except CONTAINER_ERRORS as e:
+            logging.warning("Failed to %s file '%s' with error '%s'.",
+                            "read" if get_streaming_archive(path) is not None else "extract", path, e)
+            opened[path] = None
+        return True
+
+    try:
+        for path in paths:
+            reference_item = model.ReferenceItem(name=os.path.relpath(path, relative_to), url=None)
+            if not is_container(path):
+                yield (path, reference.append(reference_item))
+                continue
+            while (path not in opened or len(opened) <= lookahead) and open_next():
+                pass
+            container = opened.pop(path)
+            if container is None:
+                continue
+            try:
+                yield from walk_container(container, reference.append(reference_item))
+            except CONTAINER_ERRORS as e:
+                logging.warning("Failed to %s file '%s' with error '%s'.",
+                                "read" if isinstance(container, StreamingArchive) else "extract", path, e)
+    finally:
+        for container in opened.values():
+            if container is not None:
+                container.__exit__(None, None, None)
+
+
+def walk(path, reference=None, relative_to=None):
+    reference = reference if reference is not None else model.Reference()
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            files = [f for f in files if not f.startswith("._")]  # Ignore resource files.
+            yield from walk_files([os.path.join(root, f) for f in files], reference=reference, relative_to=relative_to)
+    else:
+        yield from walk_files([path], reference=reference, relative_to=relative_to)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Native parsers for the subset of the EPOC file formats read by the indexer.
+#
+# These are intentionally conservative: they only answer for files they fully understand and raise `UnsupportedFile`
+# for everything else, leaving it to the callers to fall back to the opolua tools (which remain the reference
+# implementation). `compare` can be used to check the two agree.
+
+import binascii
+import contextlib
+import logging
+import mmap
+import os
+import re
+import struct
+
+
+UID_DIRECT_FILE_STORE = 0x10000037
+UID_APP_INFO_FILE = 0x1000006A
+UID_SIS_ER5 = 0x1000006D
+UID_SIS = 0x10000419
+
+UID_PERMANENT_FILE_STORE = 0x10000050
+UID_DYNAMIC_LIBRARY = 0x10000079
+UID_EXECUTABLE = 0x1000007A
+
+# Well-known first UIDs that are accepted even if the UID checksum doesn't match.
+KNOWN_UID1S = set([
+    UID_DIRECT_FILE_STORE,
+    UID_PERMANENT_FILE_STORE,
+    UID_DYNAMIC_LIBRARY,
+    UID_EXECUTABLE,
+])
+
+SIS_OPTION_UNICODE = 0x0001
+
+SIS_FILE_RECORD_SIMPLE = 0
+SIS_FILE_RECORD_MULTI_LANGUAGE = 1
+
+# Files with this type are removed or created at install time, and have no data in the installer.
+SIS_FILE_TYPE_NULL = 4
+
+# Matches the drive prefix of SIS destination paths ("!:\", "C:\", etc.); anything else is left to dumpsis.
+SIS_DRIVE_PATTERN = re.compile(r"^[A-Za-z!]:\\")
+
+# Signature of the E32 ImageFileHeader, which follows the UIDs in EPOC32 executables.
+IMAGE_FILE_SIGNATURE = b"EPOC"
+
+# SIBO files typically start with a 16 byte ASCII signature (e.g., "OPLObjectFile**\0", "ImageFileType**\0",
+# "OPLDatabaseFile\0", "PSIONWPDATAFILE"); bitmaps are the exception.
+SIBO_SIGNATURE_PATTERN = re.compile(rb"^[A-Za-z]{8,15}(?:[*\x00]|$)")
+SIBO_BITMAP_SIGNATURE = b"PIC\xdc"
+
+# Psion file types that can't be identified from their contents alone (EPOC32 resource files and their localized
+# variants have no UIDs, and OPL source can be plain text), so are always passed on to the opolua tools.
+HEADERLESS_EXTENSION_PATTERN = re.compile(r"^\.(rsc|r\d\d|opl)$", re.IGNORECASE)
+
+# EPOC language codes, mapped to the locale identifiers used by the opolua tools. Files using any other language are
+# left to the opolua tools.
+LANGUAGES = {
+    1: "en_GB",
+    2: "fr_FR",
+    3: "de_DE",
+    5: "it_IT",
+    6: "sv_SE",
+    8: "no_NO",
+    10: "en_US",
+    11: "fr_CH",
+    15: "is_IS",
+    16: "ru_RU",
+    18: "nl_NL",
+    20: "en_AU",
+    21: "fr_BE",
+    25: "cs_CZ",
+    42: "bg_BG",
+}
+
+SIS_HEADER = struct.Struct("<IIIIHHHHHHHHIHHHHIIIIII")
+BITMAP_HEADER = struct.Struct("<IIIIIIIIII")
+
+BITMAP_COMPRESSION_NONE = 0
+BITMAP_COMPRESSION_BYTE_RLE = 1
+
+# Bitmaps larger than this are assumed to be the result of a parsing error.
+MAXIMUM_ICON_SIZE = 1024
+
+
+class UnsupportedFile(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def open_buffer(path):
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield memoryview(b"")
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            yield view
+
+
+class Reader(object):
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, format):
+        try:
+            values = struct.unpack_from(format, self.data, self.offset)
+        except struct.error as e:
+            raise UnsupportedFile(f"Unexpected end of data at offset {self.offset}") from e
+        self.offset += struct.calcsize(format)
+        return values
+
+    def read(self, length):
+        if length < 0 or self.offset + length > len(self.data):
+            raise UnsupportedFile(f"Unexpected end of data at offset {self.offset}")
+        data = bytes(self.data[self.offset:self.offset + length])
+        self.offset += length
+        return data
+
+    def cardinality(self):
+        (value, ) = self.unpack("<B")
+        if not value & 0x01:
+            return value >> 1
+        self.offset -= 1
+        if not value & 0x02:
+            (value, ) = self.unpack("<H")
+            return value >> 2
+        (value, ) = self.unpack("<I")
+        return value >> 3
+
+    def descriptor(self):
+        header = self.cardinality()
+        if header & 0x01:
+            raise UnsupportedFile("16-bit descriptors are not supported")
+        return decode_text(self.read(header >> 1))
+
+    def skip_descriptor(self):
+        header = self.cardinality()
+        self.read((header >> 1) * (2 if header & 0x01 else 1))
+
+
+def uid_checksum(uids):
+    # The checksum is the CRC-CCITT of the even bytes of the UIDs, with the CRC of the odd bytes in the upper 16 bits.
+    return binascii.crc_hqx(uids[1::2], 0) << 16 | binascii.crc_hqx(uids[0::2], 0)
+
+
+def is_psion_header(header):
+    if len(header) >= 16:
+        uid1, checksum = struct.unpack_from("<I8xI", header)
+        if uid1 in KNOWN_UID1S or (uid1 != 0 and uid_checksum(header[:12]) == checksum):
+            return True
+    if header[16:20] == IMAGE_FILE_SIGNATURE:
+        return True
+    if header.startswith(SIBO_BITMAP_SIGNATURE) or SIBO_SIGNATURE_PATTERN.match(header[:15]):
+        return True
+    return False
+
+
+def is_candidate(path):
+    """
+    Cheaply determine whether a file might be an EPOC16 or EPOC32 file by checking for UIDs and well-known signatures.
+    Returns False only if the file is definitely not one that the opolua tools would recognize.
+    """
+    _, ext = os.path.splitext(path)
+    if HEADERLESS_EXTENSION_PATTERN.match(ext):
+        return True
+    try:
+        with open(path, "rb") as fh:
+            header = fh.read(32)
+    except OSError:
+        return True  # Let the opolua tools decide what to do with it.
+    return is_psion_header(header)
+
+
+def is_candidate_data(filename, data):
+    """
+    Equivalent to `is_candidate` for a file that's only available in memory.
+    """
+    _, ext = os.path.splitext(filename)
+    return bool(HEADERLESS_EXTENSION_PATTERN.match(ext)) or is_psion_header(bytes(data[:32]))
+
+
+def decode_text(data):
+    # Without knowing the code page there's no reliable way to decode 8-bit text, so we leave anything outside of
+    # ASCII to the opolua tools.
+    try:
+        return data.decode("ascii")
+    except UnicodeDecodeError:
+        raise UnsupportedFile("Non-ASCII text")
+
+
+def localized(languages, values):
+    result = {}
+    for language, value in zip(languages, values):
+        try:
+            locale = LANGUAGES[language]
+        except KeyError:
+            raise UnsupportedFile(f"Unsupported language {language}")
+        if locale in result:
+            raise UnsupportedFile(f"Duplicate language {language}")
+        result[locale] = value
+    return result
+
+
+def parse_sis(data):
+    (uid1, uid2, uid3, uid4,
+     checksum, language_count, file_count, requisite_count, install_language, install_files, install_drive,
+     capability_count, installer_version, options, kind, major, minor, variant,
+     languages_pointer, files_pointer, requisites_pointer, certificates_pointer,
+     component_name_pointer) = Reader(data).unpack(SIS_HEADER.format)
+    if uid2 != UID_SIS_ER5 or uid3 != UID_SIS:
+        raise UnsupportedFile("Not an ER5 SIS file")
+    if options & SIS_OPTION_UNICODE:
+        raise UnsupportedFile("Unicode SIS files are not supported")
+    if language_count < 1:
+        raise UnsupportedFile("No languages")
+
+    languages = Reader(data, languages_pointer).unpack("<%dH" % language_count)
+
+    reader = Reader(data, component_name_pointer)
+    lengths = reader.unpack("<%dI" % language_count)
+    pointers = reader.unpack("<%dI" % language_count)
+    names = [decode_text(Reader(data, pointer).read(length)) for length, pointer in zip(lengths, pointers)]
+
+    return {
+        "uid": uid1,
+        "name": localized(languages, names),
+        "version": {
+            "major": major,
+            "minor": minor,
+        },
+    }
+
+
+class SisFile(object):
+
+    def __init__(self, path, file_type, offset, length):
+        self.path = path  # Relative path of the file's destination, with the drive removed.
+        self.file_type = file_type
+        self.offset = offset
+        self.length = length
+        self.data = None
+
+
+def parse_sis_files(data):
+    # ER5 file records are simple (one file) or multi-language (one file per language), and stored back-to-back; later
+    # releases add record types and fields that aren't supported here. Multi-language records only return the file for
+    # the first language.
+    (uid1, uid2, uid3, uid4,
+     checksum, language_count, file_count, *_,
+     languages_pointer, files_pointer, requisites_pointer, certificates_pointer,
+     component_name_pointer) = Reader(data).unpack(SIS_HEADER.format)
+    if uid2 != UID_SIS_ER5 or uid3 != UID_SIS:
+        raise UnsupportedFile("Not an ER5 SIS file")
+    if language_count < 1:
+        raise UnsupportedFile("No languages")
+
+    files = []
+    reader = Reader(data, files_pointer)
+    for _ in range(file_count):
+        (record_type, ) = reader.unpack("<I")
+        if record_type == SIS_FILE_RECORD_SIMPLE:
+            count = 1
+        elif record_type == SIS_FILE_RECORD_MULTI_LANGUAGE:
+            count = language_count
+        else:
+            raise UnsupportedFile(f"Unsupported file record type {record_type}")
+        (file_type, file_details,
+         source_length, source_pointer,
+         destination_length, destination_pointer) = reader.unpack("<IIIIII")
+        lengths = reader.unpack("<%dI" % count)
+        pointers = reader.unpack("<%dI" % count)
+        if file_type == SIS_FILE_TYPE_NULL:
+            continue
+        destination = decode_text(Reader(data, destination_pointer).read(destination_length))
+        if not SIS_DRIVE_PATTERN.match(destination):
+            raise UnsupportedFile(f"Unsupported destination path '{destination}'")
+        path = SIS_DRIVE_PATTERN.sub("", destination).replace("\\", "/")
+        if not path or path.startswith("/") or ".." in path.split("/"):
+            raise UnsupportedFile(f"Unsupported destination path '{destination}'")
+        if pointers[0] + lengths[0] > len(data):
+            raise UnsupportedFile(f"File data for '{destination}' is out of range")
+        files.append(SisFile(path, file_type, pointers[0], lengths[0]))
+    return files
+
+
+def parse_aif_header(data):
+    uid1, uid2, uid3, checksum, trailer_pointer = Reader(data).unpack("<IIIII")
+    if uid1 != UID_DIRECT_FILE_STORE or uid2 != UID_APP_INFO_FILE:
+        raise UnsupportedFile("Not an EPOC32 AIF file")
+    return uid3, Reader(data, trailer_pointer)
+
+
+def parse_aif(data):
+    uid3, reader = parse_aif_header(data)
+    languages = []
+    captions = []
+    for _ in range(reader.cardinality()):
+        captions.append(reader.descriptor())
+        (language, ) = reader.unpack("<H")
+        languages.append(language)
+    return {
+        "uid3": uid3,
+        "captions": localized(languages, captions),
+    }
+
+
+class Bitmap(object):
+
+    def __init__(self, width, height, bpp, color, data):
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.color = color
+        self.data = data  # Uncompressed pixel data; rows are padded to 32-bit boundaries.
+
+    @property
+    def stride(self):
+        return ((self.width * self.bpp + 31) // 32) * 4
+
+
+def decompress_byte_rle(data, length):
+    # Each run starts with a control byte; values below 0x80 repeat the following byte (value + 1) times, and values
+    # from 0x80 are followed by (0x100 - value) literal bytes.
+    result = bytearray()
+    offset = 0
+    while len(result) < length:
+        if offset >= len(data):
+            raise UnsupportedFile("Truncated bitmap data")
+        control = data[offset]
+        if control < 0x80:
+            result += data[offset + 1:offset + 2] * (control + 1)
+            offset += 2
+        else:
+            count = 0x100 - control
+            result += data[offset + 1:offset + 1 + count]
+            offset += 1 + count
+    return bytes(result[:length])
+
+
+def parse_bitmap(data, offset):
+    """
+    Parse a `CFbsBitmap` stream starting at `offset`, returning the bitmap and the offset of the data that follows it.
+    """
+    (bitmap_size, header_size, width, height, twips_width, twips_height, bpp, color, palette_entries,
+     compression) = Reader(data, offset).unpack(BITMAP_HEADER.format)
+    if (header_size != BITMAP_HEADER.size
+        or bitmap_size < header_size
+        or not 0 < width <= MAXIMUM_ICON_SIZE
+        or not 0 < height <= MAXIMUM_ICON_SIZE
+        or bpp not in [1, 2, 4, 8]
+        or color != 0):
+        raise UnsupportedFile("Unsupported bitmap")
+    bitmap = Bitmap(width, height, bpp, color, None)
+    length = bitmap.stride * height
+    pixels = Reader(data, offset + header_size).read(bitmap_size - header_size)
+    if compression == BITMAP_COMPRESSION_NONE:
+        if len(pixels) < length:
+            raise UnsupportedFile("Truncated bitmap data")
+        bitmap.data = pixels[:length]
+    elif compression == BITMAP_COMPRESSION_BYTE_RLE:
+        bitmap.data = decompress_byte_rle(pixels, length)
+    else:
+        raise UnsupportedFile(f"Unsupported bitmap compression {compression}")
+    return bitmap, offset + bitmap_size
+
+
+def parse_aif_icons(data):
+    """
+    Return the icons in an EPOC32 AIF as a list of (bitmap, mask) `Bitmap` pairs.
+    """
+    uid3, reader = parse_aif_header(data)
+    for _ in range(reader.cardinality()):
+        reader.skip_descriptor()
+        reader.unpack("<H")
+    icons = []
+    for _ in range(reader.cardinality()):
+        icon_pointer, size = reader.unpack("<IH")
+        bitmap, mask_pointer = parse_bitmap(data, icon_pointer)
+        mask, _ = parse_bitmap(data, mask_pointer)
+        if (bitmap.width, bitmap.height) != (mask.width, mask.height):
+            raise UnsupportedFile("Mismatched icon mask")
+        icons.append((bitmap, mask))
+    return icons
+
+
+def read_sis(path):
+    """
+    Return the UID, localized names, and version of an ER5 SIS file, matching the equivalent fields of `dumpsis
+    --json`. Raises `UnsupportedFile` if the file can't be handled natively.
+    """
+    with open_buffer(path) as data:
+        return parse_sis(data)
+
+
+@contextlib.contextmanager
+def open_sis_files(path):
+    """
+    Return the files in the payload of an ER5 SIS file as a list of `SisFile`s whose data remains valid until the
+    context exits. Raises `UnsupportedFile` if the file can't be handled natively.
+    """
+    with open_buffer(path) as data:
+        files = parse_sis_files(data)
+        for file in files:
+            file.data = data[file.offset:file.offset + file.length]
+        try:
+            yield files
+        finally:
+            for file in files:
+                file.data.release()
+
+
+def read_aif(path):
+    """
+    Return the UID and localized captions of an EPOC32 AIF file, matching the equivalent fields of `dumpaif --json`.
+    Raises `UnsupportedFile` if the file can't be handled natively.
+    """
+    with open_buffer(path) as data:
+        return parse_aif(data)
+
+
+def read_aif_icons(path):
+    """
+    Return the icons in an EPOC32 AIF file as a list of (bitmap, mask) `Bitmap` pairs. Only greyscale bitmaps are
+    supported; raises `UnsupportedFile` if the file can't be handled natively.
+    """
+    with open_buffer(path) as data:
+        return parse_aif_icons(data)
+
+
+class Comparison(object):
+
+    def __init__(self):
+        self.matches = 0
+        self.fallbacks = 0
+        self.mismatches = []  # (path, native, reference)
+
+
+def compare(paths, reference_sis, reference_aif):
+    """
+    Run the native parsers and the reference implementations (typically `opolua.dumpsis` and `opolua.dumpaif`) over
+    every SIS and AIF file in `paths`, returning a `Comparison` summarising where they agree.
+    """
+    comparison = Comparison()
+    for path in paths:
+        _, ext = os.path.splitext(path)
+        ext = ext.lower()
+        if ext == ".sis":
+            native, reference = read_sis, reference_sis
+        elif ext in [".aif", ".aco", ".abw"]:
+            native, reference = read_aif, reference_aif
+        else:
+            continue
+        try:
+            native_result = native(path)
+        except UnsupportedFile as e:
+            logging.debug("Falling back for '%s' (%s).", path, e)
+            comparison.fallbacks += 1
+            continue
+        try:
+            reference_result = reference(path)
+            reference_result = {key: reference_result.get(key) for key in native_result.keys()}
+        except Exception as e:
+            reference_result = {"error": str(e)}
+        if native_result == reference_result:
+            comparison.matches += 1
+        else:
+            comparison.mismatches.append((path, native_result, reference_result))
+    return comparison
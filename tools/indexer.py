@@ -35,10 +35,12 @@ import json
 import logging
 import operator
 import os
+import queue
 import re
 import shutil
 import sys
 import tempfile
+import threading
 import urllib.parse
 
 from enum import Enum
@@ -49,10 +51,14 @@ import natsort
 
 from PIL import Image as PILImage, ImageOps
 
+from . import cache
 from . import common
 from . import containers
+from . import merkle
 from . import model
 from . import opolua
+from . import remote
+from . import scratch
 from . import utils
 
 ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -64,6 +70,11 @@ logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%
 
 INDEXER_VERSION = 17
 
+# The number of threads importing the assets of each source, and the number of walked assets that can be waiting to be
+# written out (this bounds the containers, and hence the scratch space, held open for a source).
+IMPORT_WORKERS = max(int(os.environ.get("INDEXER_IMPORT_WORKERS", 4)), 1)
+IMPORT_QUEUE_SIZE = IMPORT_WORKERS * 2
+
 # TODO: Check if there are more languages.
 LANGUAGE_ORDER = ["en_GB", "en_US", "en_AU", "fr_FR", "de_DE", "it_IT", "nl_NL", "bg_BG", "is_IS", "cs_CZ", "sv_SE", "fr_CH", "fr_BE", "no_NO", "ru_RU", ""]
 
@@ -228,14 +239,6 @@ def decode(s, encodings=('ascii', 'utf8', 'latin1', 'cp1252')):
     raise UnicodeDecodeError("Unknown encoding")
 
 
-def find_sibling(path, name):
-    directory_path = os.path.dirname(path)
-    files = os.listdir(directory_path)
-    for f in files:
-        if f.lower() == name.lower():
-            return os.path.join(directory_path, f)
-
-
 def select_icon_dict(icons):
     candidates = [icon for icon in icons if icon['width'] == icon['height'] and icon['width'] <= 48]
     icons = list(reversed(sorted(candidates, key=lambda x: (x['bpp'], x['width']))))
@@ -274,18 +277,199 @@ def remap_tag(tag):
         return tag
 
 
-def discover_tags(path):
-    tags = set([])
-    for root, dirs, files in os.walk(path):
+def recognize_files(paths, result_cache=None, error_handler=None):
+    """
+    Recognize a list of files, returning a dictionary mapping each path to its recognition details, and using the
+    result cache if one is provided. Files that exceed a resource limit are passed to `error_handler` as described in
+    `opolua.recognize_batch`, and aren't cached.
+    """
+    if result_cache is None:
+        return opolua.recognize_many(paths, error_handler=error_handler)
+    results = {}
+    misses = {}
+    for file_path in paths:
+        # The prefilter only reads the file's header, so it's much cheaper than hashing the file to look it up.
+        if not opolua.is_candidate(file_path):
+            results[file_path] = {"type": "unknown"}
+            continue
+        sha256 = utils.shasum(file_path)
+        cached = result_cache.get("recognize", sha256)
+        if cached is not None:
+            results[file_path] = cached
+        else:
+            misses[file_path] = sha256
+    failed = set()
+    def record_error(error_path, error):
+        failed.add(error_path)
+        error_handler(error_path, error)
+    recognized = opolua.recognize_candidates(list(misses.keys()),
+                                             error_handler=record_error if error_handler is not None else None)
+    for file_path, file_details in recognized.items():
+        if file_path not in failed:
+            result_cache.set("recognize", misses[file_path], file_details)
+        results[file_path] = file_details
+    return results
+
+
+class DirectoryCache(object):
+    """
+    Memoizes directory listings, recognition details, and tags for the duration of a source import, so applications
+    that share a directory don't each list and recognize its contents again. Use `forget` to discard the entries for a
+    directory tree (e.g., a container's contents) once it's no longer needed.
+
+    Files that exceed a resource limit while a directory is being recognized are treated as unknown, so they don't
+    prevent the applications alongside them from being imported; use `take_skipped` to collect them.
+    """
+
+    def __init__(self, result_cache=None):
+        self.result_cache = result_cache
+        self._listings = {}
+        self._recognized = {}
+        self._tags = {}
+        self._skipped = {}
+        self._lock = threading.Lock()
+        self._directory_locks = collections.defaultdict(threading.Lock)
+
+    def listdir(self, path):
+        """
+        Return the names of the directories and files in `path` as a tuple of lists.
+        """
+        if path not in self._listings:
+            dirs = []
+            files = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    (dirs if entry.is_dir() else files).append(entry.name)
+            self._listings[path] = (dirs, files)
+        return self._listings[path]
+
+    def files(self, path):
+        """
+        Return the paths of all the (non-hidden) files in a directory tree.
+        """
+        dirs, files = self.listdir(path)
+        paths = [os.path.join(path, f) for f in files if not f.startswith(".")]
+        for d in dirs:
+            if not os.path.islink(os.path.join(path, d)):  # Match `os.walk`, which doesn't follow links.
+                paths += self.files(os.path.join(path, d))
+        return paths
+
+    def find_sibling(self, path, name):
+        directory_path = os.path.dirname(path)
+        _, files = self.listdir(directory_path)
         for f in files:
-            if f.startswith("."):  # Ignore hidden files.
-                continue
-            f = os.path.join(root, f)
-            details = opolua.recognize(f)
-            if "era" in details:
-                tags.add(remap_tag(details["era"]))
-            if "type" in details:
-                tags.add(remap_tag(details["type"]))
+            if f.lower() == name.lower():
+                return os.path.join(directory_path, f)
+
+    def tags(self, path):
+        # Applications are imported concurrently, so each directory is locked to ensure it's only recognized once.
+        with self._lock:
+            directory_lock = self._directory_locks[path]
+        with directory_lock:
+            if path not in self._tags:
+                paths = self.files(path)
+                unrecognized = [file_path for file_path in paths if file_path not in self._recognized]
+                if unrecognized:
+                    skipped = []
+                    self._recognized.update(recognize_files(unrecognized,
+                                                            result_cache=self.result_cache,
+                                                            error_handler=lambda *args: skipped.append(args)))
+                    if skipped:
+                        self._skipped[path] = skipped
+                self._tags[path] = tags_from_details([self._recognized[file_path] for file_path in paths])
+            return self._tags[path]
+
+    def take_skipped(self, path):
+        """
+        Return (and forget) the paths and errors of the files that were skipped while recognizing `path`.
+        """
+        with self._lock:
+            return self._skipped.pop(path, [])
+
+    def forget(self, path):
+        """
+        Discard the entries for `path` and everything beneath it.
+        """
+        prefix = path + os.path.sep
+        with self._lock:
+            for memo in (self._listings, self._recognized, self._tags, self._skipped, self._directory_locks):
+                for key in [key for key in list(memo) if key == path or key.startswith(prefix)]:
+                    memo.pop(key, None)
+
+
+def recognize(path, sha256, result_cache=None):
+    if result_cache is not None:
+        details = result_cache.get("recognize", sha256)
+        if details is not None:
+            return details
+    details = opolua.recognize(path)
+    if result_cache is not None:
+        result_cache.set("recognize", sha256, details)
+    return details
+
+
+def aif_details(path, result_cache=None):
+    """
+    Return the metadata and icons for an AIF (or EPOC16 OPA), using the result cache if one is provided.
+    """
+    sha256 = None
+    if result_cache is not None:
+        sha256 = utils.shasum(path)
+        cached = result_cache.get("aif", sha256)
+        if cached is not None:
+            try:
+                return cached["info"], result_cache.load_icons(cached["icons"])
+            except OSError:
+                pass  # The icons have been evicted; fall through and regenerate them.
+    info = opolua.aif_info(path)
+    icons = opolua.get_icons(path)
+    if result_cache is not None:
+        result_cache.set("aif", sha256, {"info": info, "icons": result_cache.store_icons(icons)})
+    return info, icons
+
+
+def analyse_installer(path, sha256, error_handler, result_cache=None):
+    """
+    Analyse an installer with `opolua.analyse_installer`, using the result cache if one is provided. Unsupported
+    installers are cached too, so they're only ever parsed once, but results that were only partially successful (i.e.,
+    those that reported errors to `error_handler`) aren't cached so they're retried on the next run.
+    """
+    if result_cache is not None:
+        cached = result_cache.get("installer", sha256)
+        if cached is not None and "unsupported" in cached:
+            raise opolua.UnsupportedInstaller(cached["unsupported"])
+        if cached is not None:
+            try:
+                return opolua.Installer(uid=cached["uid"],
+                                        name=cached["name"],
+                                        version=cached["version"],
+                                        files=cached["files"],
+                                        icons=result_cache.load_icons(cached["icons"]))
+            except OSError:
+                pass  # The icons have been evicted; fall through and regenerate them.
+    errors = []
+    def record_error(error_path, error):
+        errors.append(error)
+        error_handler(error_path, error)
+    try:
+        installer = opolua.analyse_installer(path, error_handler=record_error if error_handler is not None else None)
+    except opolua.UnsupportedInstaller as e:
+        if result_cache is not None:
+            result_cache.set("installer", sha256, {"unsupported": str(e)})
+        raise
+    if result_cache is not None and not errors:
+        result_cache.store_icons(installer.icons)
+        result_cache.set("installer", sha256, installer.as_dict())
+    return installer
+
+
+def tags_from_details(recognized):
+    tags = set([])
+    for details in recognized:
+        if "era" in details:
+            tags.add(remap_tag(details["era"]))
+        if "type" in details:
+            tags.add(remap_tag(details["type"]))
     if "unknown" in tags:
         tags.remove("unknown")
     return tags
@@ -300,103 +484,86 @@ def runtimes_from_tags(tags):
     return runtimes
 
 
-def find_files_recursive(path, extensions):
-    result = []
-    for extension in extensions:
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                if f.endswith(extension):
-                    result.append(os.path.join(root, f))
-    return result
-
-
-def import_installer(source, output_directory, reference, path, error_handler):
+def import_installer(source, output_directory, reference, path, error_handler, result_cache=None):
 
     logging.info(f"Importing installer '{path}'...")
 
-    info = opolua.dumpsis(path)
-    icons = []
-    tags = []
-
-    # TODO: Move this into an OpoLua utility.
-    with tempfile.TemporaryDirectory() as temporary_directory_path:
-        opolua.dumpsis_extract(path, temporary_directory_path)
-        tags = discover_tags(temporary_directory_path)
-        contents = find_files_recursive(temporary_directory_path, [".aif", ".aco", ".abw"])
-        if contents:
-            aif_path = contents[0]
-            try:
-                icons = opolua.get_icons(aif_path)
-            except Exception as e:
-                error_handler(aif_path, e)
+    # Unsupported installers are common, so installers are only added to the output once they've been analysed; the
+    # installer is hashed as it's copied, and the copy is discarded if it can't be.
+    with utils.ingest(path, output_directory) as sha256:
+        installer = analyse_installer(path, sha256, error_handler=error_handler, result_cache=result_cache)
 
-    sha256 = utils.shasum(path)
-    shutil.copyfile(path, os.path.join(output_directory, sha256))
     return Release(filename=os.path.basename(path),
                    size=os.path.getsize(path),
                    reference=reference,
                    kind=ReleaseKind.INSTALLER,
-                   id="0x%08x" % info["uid"],
-                   uid="0x%08x" % info["uid"],
+                   id="0x%08x" % installer.uid,
+                   uid="0x%08x" % installer.uid,
                    sha256=sha256,
-                   name=select_name(info["name"]),
-                   version=info["version"],
-                   icons=icons,
-                   tags=tags,
+                   name=select_name(installer.name),
+                   version=installer.version,
+                   icons=installer.icons,
+                   tags=tags_from_details(installer.files.values()),
                    platform="epoc32")
 
 
-def import_application(source, output_directory, reference, path, error_handler):
+def import_application(source, output_directory, reference, path, error_handler, result_cache=None,
+                       directory_cache=None):
 
     logging.info(f"Importing application '{path}'...")
 
+    if directory_cache is None:
+        directory_cache = DirectoryCache(result_cache=result_cache)
+
     basename = os.path.basename(path)
     name, _ = os.path.splitext(basename)
-    tags = discover_tags(os.path.dirname(path))
+    tags = directory_cache.tags(os.path.dirname(path))
 
     # TODO: Find the AIF by using recognize?
-    aif_path = find_sibling(path, name + ".aif")
+    aif_path = directory_cache.find_sibling(path, name + ".aif")
     if not aif_path:
-        aif_path = find_sibling(path, name + ".aco")
+        aif_path = directory_cache.find_sibling(path, name + ".aco")
     if not aif_path:
-        aif_path = find_sibling(path, name + ".abw")
-    id = utils.shasum(path)
-    uid = None
-    icons = []
-    app_name = name
-    has_aif = False
-
-    # Recognize the app to determine what to do.
-    details = opolua.recognize(path)
-    if details['type'] == 'unknown':
-        raise UnknownApplication()
+        aif_path = directory_cache.find_sibling(path, name + ".abw")
 
-    # Perhaps we're incorrectly detecting MBM files?
-    if details["type"] == "mbm" or details["type"] == "resource":
-        raise UnknownApplication()
+    # The app is only added to the output once we know it's an app; it's hashed as it's copied, and the copy is
+    # discarded if it isn't.
+    with utils.ingest(path, output_directory) as id:
+        uid = None
+        icons = []
+        app_name = name
+        has_aif = False
 
-    platform = "epoc16" if details["era"] == "sibo" else "epoc32"
+        # Recognize the app to determine what to do.
+        details = recognize(path, id, result_cache=result_cache)
+        if details['type'] == 'unknown':
+            raise UnknownApplication()
 
-    if aif_path:
-        # TODO: Remove this check.
-        try:
-            info = opolua.dumpaif(aif_path)
-            uid = ("0x%08x" % info["uid3"]).lower()
+        # Perhaps we're incorrectly detecting MBM files?
+        if details["type"] == "mbm" or details["type"] == "resource":
+            raise UnknownApplication()
+
+        platform = "epoc16" if details["era"] == "sibo" else "epoc32"
+
+        if aif_path:
+            # TODO: Remove this check.
+            try:
+                info, icons = aif_details(aif_path, result_cache=result_cache)
+                uid = ("0x%08x" % info["uid3"]).lower()
+                app_name = select_name(info["captions"])
+                has_aif = True
+            except opolua.ResourceLimitExceeded:
+                raise
+            except Exception as e:
+                error_handler(aif_path, e)
+                logging.warning("Failed to parse AIF with message '%s'", e)
+
+        # If we don't have a manifest, we can attempt to load one from EPOC16-era OPAs.
+        if not has_aif and details['era'] == 'sibo' and details['type'] == 'opa':
+            info, icons = aif_details(path, result_cache=result_cache)
             app_name = select_name(info["captions"])
-            icons = opolua.get_icons(aif_path)
-            has_aif = True
-        except Exception as e:
-            error_handler(aif_path, e)
-            logging.warning("Failed to parse AIF with message '%s'", e)
-
-    # If we don't have a manifest, we can attempt to load one from EPOC16-era OPAs.
-    if not has_aif and details['era'] == 'sibo' and details['type'] == 'opa':
-        info = opolua.dumpaif(path)
-        icons = opolua.get_icons(path)
-        app_name = select_name(info["captions"])
-
-    sha256 = utils.shasum(path)
-    shutil.copyfile(path, os.path.join(output_directory, sha256))
+
+    sha256 = id
     return Release(filename=os.path.basename(path),
                    size=os.path.getsize(path),
                    reference=reference,
@@ -415,53 +582,179 @@ class UnknownApplication(Exception):
     pass
 
 
-def import_source(source, output_directory, error_handler=None):
+def import_asset(source, output_directory, file_path, reference, error_handler=None, result_cache=None,
+                 directory_cache=None):
+    _, ext = os.path.splitext(file_path)
+    ext = ext.lower()
+    if ext == ".app" or ext == ".opa":
+        return import_application(source=source,
+                                  output_directory=output_directory,
+                                  reference=reference,
+                                  path=file_path,
+                                  error_handler=error_handler,
+                                  result_cache=result_cache,
+                                  directory_cache=directory_cache)
+    elif ext == ".sis":
+        return import_installer(source=source,
+                                output_directory=output_directory,
+                                reference=reference,
+                                path=file_path,
+                                error_handler=error_handler,
+                                result_cache=result_cache)
+    return None
+
+
+def import_source(source, output_directory, error_handler=None, skipped=None, result_cache=None):
+    """
+    Import the applications and installers in a source.
+
+    The import is pipelined: a producer thread walks the source (reading containers and materializing the files that
+    are needed), a pool of `IMPORT_WORKERS` threads imports them, and the calling thread collects the results in walk
+    order, so the output is the same as a sequential import. The stages are connected by a queue of at most
+    `IMPORT_QUEUE_SIZE` assets, and each queued asset holds a lease on its container so the container isn't cleaned up
+    until its result has been handled.
+    """
 
     apps = []
-    logging.info(f"Importing source '{source.path}'...")
-    for (file_path, reference) in source.assets:
-        basename = os.path.basename(file_path)
-        _, ext = os.path.splitext(basename)
-        ext = ext.lower()
+    directory_cache = DirectoryCache(result_cache=result_cache)
+    pending = queue.Queue(maxsize=IMPORT_QUEUE_SIZE)
+    stopped = threading.Event()
+    finished = object()
+    skipped_paths = set()
+
+    def enqueue(item):
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(file_path, reference):
+        # Only the producer waits for scratch space. Queued assets hold their containers open until they've been
+        # imported, so an import that waited (even for a file that isn't in a container) could wait forever.
+        with scratch.manager.nested():
+            return import_asset(source, output_directory, file_path, reference, error_handler=error_handler,
+                                result_cache=result_cache, directory_cache=directory_cache)
+
+    def release(lease):
+        if lease is not None:
+            lease()
+
+    def skip(file_path, reference, e):
+        # Pathological files shouldn't stall or fail the whole source; quarantine them and record that they were skipped
+        # so they can be investigated later. Each file is only skipped once, even if it's both an asset and a sibling.
+        if file_path in skipped_paths:
+            return
+        skipped_paths.add(file_path)
+        logging.warning("Skipping '%s' with message '%s'.", file_path, e)
+        if error_handler is not None:
+            error_handler(file_path, e)
+        if skipped is not None:
+            skipped.append({
+                "filename": os.path.basename(file_path),
+                "reference": [item.as_dict() for item in reference],
+                "reason": str(e),
+            })
 
+    def produce(executor):
+        assets = iter(source.assets)
         try:
-            if ext == ".app" or ext == ".opa":
-                apps.append(import_application(source=source,
-                                               output_directory=output_directory,
-                                               reference=reference,
-                                               path=file_path,
-                                               error_handler=error_handler))
-            elif ext == ".sis":
-                apps.append(import_installer(source=source,
-                                            output_directory=output_directory,
-                                            reference=reference,
-                                            path=file_path,
-                                            error_handler=error_handler))
-        except (UnknownApplication, opolua.UnsupportedInstaller):
-            # It's safe to ignore these exceptions as it implies the file is not an EPOC16 or EPOC32 file.
-            continue
-        except Exception as e:
-            logging.error("Failed to import with message '%s", e)
-            error_handler(file_path, e)
-            raise
+            for (file_path, reference) in assets:
+                if stopped.is_set():
+                    break
+                _, ext = os.path.splitext(file_path)
+                ext = ext.lower()
+                if ext not in (".app", ".opa", ".sis"):
+                    continue
+                lease = containers.lease(file_path)
+                try:
+                    # Applications are indexed using their siblings.
+                    containers.materialize(file_path, siblings=ext != ".sis")
+                    future = executor.submit(run, file_path, reference)
+                except Exception as e:
+                    future = concurrent.futures.Future()
+                    future.set_exception(e)
+                if not enqueue((file_path, reference, future, lease)):
+                    future.cancel()
+                    concurrent.futures.wait([future])
+                    release(lease)
+                    break
+            enqueue(finished)
+        except BaseException as e:
+            enqueue(e)
+        finally:
+            # Close the walk on this thread, as closing a container waits for the leases on its files.
+            if hasattr(assets, "close"):
+                assets.close()
+
+    logging.info(f"Importing source '{source.path}'...")
+    # Forget the contents of each container once it's closed, so the directory cache doesn't grow with the source.
+    with containers.on_close(directory_cache.forget), \
+         concurrent.futures.ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+        producer = threading.Thread(target=produce, args=(executor, ))
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is finished:
+                    break
+                elif isinstance(item, BaseException):
+                    raise item
+                file_path, reference, future, lease = item
+                try:
+                    result = future.result()
+                    if result is not None:
+                        apps.append(result)
+                except containers.ExtractionError as e:
+                    logging.warning("Skipping '%s' with message '%s'.", file_path, e)
+                except (UnknownApplication, opolua.UnsupportedInstaller):
+                    # It's safe to ignore these exceptions as it implies the file is not an EPOC16 or EPOC32 file.
+                    pass
+                except opolua.ResourceLimitExceeded as e:
+                    skip(file_path, reference, e)
+                except Exception as e:
+                    logging.error("Failed to import with message '%s", e)
+                    error_handler(file_path, e)
+                    raise
+                finally:
+                    # Files skipped while recognizing an application's siblings are recorded against the first
+                    # application in their directory, while its container is still held.
+                    if os.path.splitext(file_path)[1].lower() in (".app", ".opa"):
+                        for skipped_path, e in directory_cache.take_skipped(os.path.dirname(file_path)):
+                            skip(skipped_path, reference, e)
+                    release(lease)
+        finally:
+            # Stop the producer and release the containers held by any queued assets so it can finish walking.
+            stopped.set()
+            while producer.is_alive() or not pending.empty():
+                try:
+                    item = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if isinstance(item, tuple):
+                    _, _, future, lease = item
+                    future.cancel()
+                    concurrent.futures.wait([future])
+                    release(lease)
+            producer.join()
 
     return apps
 
 
-def index_source(source, source_index_directory):
+def index_source(source, source_index_directory, result_cache=None):
     logging.info("Indexing '%s'...", source.url)
 
     # Capture failing files for later investigation.
     # This creates a new path for each unique failing file and stores the error alongside the file.
     def error_handler(errors_directory):
         def inner(path, error):
-            sha = utils.shasum(path)
-            destination_path = os.path.join(errors_directory, sha)
-            if os.path.exists(destination_path):
-                logging.warning(f"Ignoring duplicate failing file with shasum '{sha}'...")
-                return
-            os.makedirs(destination_path)
-            shutil.copy(path, destination_path)
+            with utils.ingest(path, errors_directory, name=os.path.basename(path)) as sha:
+                destination_path = os.path.join(errors_directory, sha)
+                if os.path.exists(destination_path):
+                    logging.warning(f"Ignoring duplicate failing file with shasum '{sha}'...")
+                    return
             with open(os.path.join(destination_path, "error.txt"), "w") as fh:
                 fh.write(str(error))
         return inner
@@ -471,10 +764,16 @@ def index_source(source, source_index_directory):
     source_index_icons_directory = os.path.join(source_index_directory, "icons")
     source_index_errors_directory = os.path.join(source_index_directory, "errors")
     source_manifest_path = os.path.join(source_index_directory, "manifest.json")
+    source_tree_path = os.path.join(source_index_directory, "tree.json")
     source_releases_path = os.path.join(source_index_directory, "releases.json")
 
-    # Get the hash of the current source.
-    source_hash = source.hash
+    # Get the hash of the current source, only rehashing the files that have changed since it was last indexed.
+    previous_source_tree = None
+    if os.path.exists(source_tree_path):
+        with open(source_tree_path, "r") as fh:
+            previous_source_tree = json.load(fh)
+    source_tree = source.tree(previous=previous_source_tree)
+    source_hash = source_tree["hash"]
 
     # Load the manifest.
     # We initialize the manifest here with dummy values so we can always safely inspect it.
@@ -496,8 +795,19 @@ def index_source(source, source_index_directory):
         with open(source_releases_path, "r") as fh:
             source_releases = json.load(fh)
 
+        # Update the stored tree if any of the files' fingerprints have changed.
+        if source_tree != previous_source_tree:
+            with open(source_tree_path, "w") as fh:
+                json.dump(source_tree, fh)
+
     else:
 
+        if previous_source_tree is not None and previous_source_tree["hash"] != source_hash:
+            changes = merkle.changes(previous_source_tree, source_tree)
+            logging.info("Source changed in %s%s.",
+                         ", ".join(f"'{path or '.'}'" for path in changes[:10]),
+                         f" and {len(changes) - 10} more" if len(changes) > 10 else "")
+
         # Prepare the source index directory.
         utils.reset_directory(source_index_directory)
         utils.create_directories([
@@ -506,17 +816,23 @@ def index_source(source, source_index_directory):
             source_index_errors_directory
         ])
 
+        skipped = []
         source_releases = import_source(source=source,
                                         output_directory=source_index_files_directory,
-                                        error_handler=error_handler(source_index_errors_directory))
+                                        error_handler=error_handler(source_index_errors_directory),
+                                        skipped=skipped,
+                                        result_cache=result_cache)
 
         logging.info("Writing manifest to '%s'...", source_manifest_path)
         with open(source_manifest_path, "w") as fh:
             json.dump({
                 "identifier": source.identifier,
-                "hash": source.hash,
+                "hash": source_hash,
                 "indexer_version": INDEXER_VERSION,
+                "skipped": skipped,
             }, fh, indent=4)
+        with open(source_tree_path, "w") as fh:
+            json.dump(source_tree, fh)
 
         # Write the source index.
         logging.info("Writing source index to '%s'...", source_releases_path)
@@ -550,12 +866,17 @@ def index(library):
     logging.info("Indexing...")
 
     releases = []
+    result_cache = cache.ResultCache(os.path.join(library.cache_directory, "results"), version=INDEXER_VERSION)
+    containers.extraction_cache = cache.ExtractionCache(os.path.join(library.cache_directory, "extractions"))
+    remote.block_cache = remote.BlockCache(os.path.join(library.cache_directory, "ranges"))
+    utils.fingerprint_cache = cache.FingerprintCache(os.path.join(library.cache_directory, "fingerprints.json"))
+    containers.extraction_processes = containers.EXTRACTION_PROCESSES
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
         futures = []
         for source in library.sources:
             source_index_directory = os.path.join(library.intermediates_directory, "sources", source.identifier)
-            futures.append(executor.submit(index_source, source, source_index_directory))
+            futures.append(executor.submit(index_source, source, source_index_directory, result_cache))
         for future in concurrent.futures.as_completed(futures):
             releases += future.result()
 
@@ -574,6 +895,17 @@ def index(library):
     with open(releases_path, "w") as fh:
         json.dump(releases, fh, indent=4)
 
+    result_cache.trim()
+    containers.extraction_cache.trim()
+    remote.block_cache.trim()
+    utils.fingerprint_cache.save()
+    logging.info("Recognition prefilter %s.", opolua.prefilter_statistics)
+    logging.info("Result cache %s.", result_cache.statistics)
+    logging.info("Extraction cache %s.", containers.extraction_cache.statistics)
+    logging.info("Fingerprint cache %s.", utils.fingerprint_cache)
+    logging.info("Scratch space %s.", scratch.manager)
+    if remote.ENABLED:
+        logging.info("Remote containers fetched %s (block cache %s).", remote.statistics, remote.block_cache.statistics)
     logging.info("Indexing complete.")
 
 
@@ -700,16 +1032,16 @@ def group(library):
     with open(index_paths.redirects_path, "w", encoding="utf-8") as fh:
         json.dump([{"path": path, "destination": destination} for (path, destination) in redirects.items()], fh)
 
-    logging.info("Copying files to '%s'...", index_paths.files_directory)
+    logging.info("Publishing files to '%s'...", index_paths.files_directory)
     if os.path.exists(index_paths.files_directory):
         shutil.rmtree(index_paths.files_directory)
-    shutil.copytree(intermediate_files_directory, index_paths.files_directory)
+    utils.link_tree(intermediate_files_directory, index_paths.files_directory)
 
-    # Copy the icons.
-    logging.info("Copying icons to '%s'...", index_paths.icons_directory)
+    # Publish the icons.
+    logging.info("Publishing icons to '%s'...", index_paths.icons_directory)
     if os.path.exists(index_paths.icons_directory):
         shutil.rmtree(index_paths.icons_directory)
-    shutil.copytree(intermediate_icons_directory, index_paths.icons_directory)
+    utils.link_tree(intermediate_icons_directory, index_paths.icons_directory)
 
 
 def overlay(library):
@@ -841,7 +1173,7 @@ def overlay(library):
             relative_path = os.path.join("screenshots", identifier, os.path.basename(screenshot))
             destination_path = os.path.join(library.output_directory, relative_path)
             logging.info("Copying '%s' to '%s'...", screenshot, destination_path)
-            shutil.copyfile(screenshot, destination_path)
+            utils.link_or_copy(screenshot, destination_path)
             with PILImage.open(screenshot) as image:
                 width, height = image.size
             relative_paths.append({
@@ -884,14 +1216,14 @@ def overlay(library):
         json.dump(programs_all, fh)
     shutil.copyfile(index_paths.redirects_path, destination_redirects_path)
 
-    # Copy the files and icons.
-    shutil.copytree(index_paths.files_directory, files_output_path)
-    shutil.copytree(index_paths.icons_directory, icons_output_path)
+    # Publish the files and icons.
+    utils.link_tree(index_paths.files_directory, files_output_path)
+    utils.link_tree(index_paths.icons_directory, icons_output_path)
 
     # Write the API.
     os.makedirs(api_v1_output_path, exist_ok=True)
-    shutil.copytree(icons_output_path, os.path.join(api_v1_output_path, "icons"))
-    shutil.copytree(screenshots_output_path, os.path.join(api_v1_output_path, "screenshots"))
+    utils.link_tree(icons_output_path, os.path.join(api_v1_output_path, "icons"))
+    utils.link_tree(screenshots_output_path, os.path.join(api_v1_output_path, "screenshots"))
     os.makedirs(os.path.join(api_v1_output_path, "programs"), exist_ok=True)
     shutil.copyfile(destination_programs_path, os.path.join(api_v1_output_path, "programs", "index.json"))
     os.makedirs(os.path.join(api_v1_output_path, "sources"), exist_ok=True)
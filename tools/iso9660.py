@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Minimal reader for ISO9660 CD images, with support for Joliet and Rock Ridge names. Only the directory tables are
+# read; file data is left in place so it can be copied straight out of a memory-mapped image.
+
+import re
+import struct
+
+SECTOR_SIZE = 2048
+FIRST_VOLUME_DESCRIPTOR_SECTOR = 16
+
+STANDARD_IDENTIFIER = b"CD001"
+
+VOLUME_DESCRIPTOR_PRIMARY = 1
+VOLUME_DESCRIPTOR_SUPPLEMENTARY = 2
+VOLUME_DESCRIPTOR_TERMINATOR = 255
+
+# Escape sequences identifying a supplementary volume descriptor as Joliet (UCS-2 levels 1-3).
+JOLIET_ESCAPE_SEQUENCES = [b"%/@", b"%/C", b"%/E"]
+
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+
+ROCK_RIDGE_NAME_CONTINUE = 0x01
+ROCK_RIDGE_NAME_CURRENT = 0x02
+ROCK_RIDGE_NAME_PARENT = 0x04
+
+# Deeper directory trees are assumed to be the result of a damaged image.
+MAXIMUM_DEPTH = 64
+
+VERSION_PATTERN = re.compile(r";\d*$")
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+class Record(object):
+
+    def __init__(self, data):
+        if len(data) < 34:
+            raise UnsupportedImage("Truncated directory record")
+        (self.length, self.extended_attribute_length,
+         self.extent, self.size) = struct.unpack_from("<BBI4xI", data)
+        self.flags = data[25]
+        name_length = data[32]
+        self.name = bytes(data[33:33 + name_length])
+        self.system_use = bytes(data[33 + name_length + (1 - name_length % 2):self.length])
+
+    @property
+    def is_directory(self):
+        return bool(self.flags & FLAG_DIRECTORY)
+
+    @property
+    def is_special(self):
+        return self.name in (b"\x00", b"\x01")  # The current (".") and parent ("..") directories.
+
+
+def check_range(data, offset, length):
+    if offset < 0 or length < 0 or offset + length > len(data):
+        raise UnsupportedImage(f"Unexpected end of image at offset {offset}")
+
+
+def read(data, offset, length):
+    check_range(data, offset, length)
+    return data[offset:offset + length]
+
+
+def system_use_entries(data, system_use):
+    # Yields (signature, entry) pairs for the SUSP entries in a system use area, following continuation areas.
+    visited = set()
+    while system_use:
+        continuation = None
+        offset = 0
+        while offset + 4 <= len(system_use):
+            signature = system_use[offset:offset + 2]
+            length = system_use[offset + 2]
+            if length < 4 or offset + length > len(system_use):
+                break
+            entry = system_use[offset:offset + length]
+            if signature == b"ST":
+                break
+            elif signature == b"CE" and length >= 28:
+                continuation = struct.unpack_from("<I4xI4xI", entry, 4)
+            else:
+                yield signature, entry
+            offset += length
+        if continuation is None or continuation in visited:
+            break
+        visited.add(continuation)
+        block, block_offset, block_length = continuation
+        system_use = bytes(read(data, block * SECTOR_SIZE + block_offset, block_length))
+
+
+def rock_ridge_name(data, record):
+    name = b""
+    found = False
+    for signature, entry in system_use_entries(data, record.system_use):
+        if signature != b"NM" or len(entry) < 5:
+            continue
+        flags = entry[4]
+        if flags & (ROCK_RIDGE_NAME_CURRENT | ROCK_RIDGE_NAME_PARENT):
+            continue
+        name += entry[5:]
+        found = True
+        if not flags & ROCK_RIDGE_NAME_CONTINUE:
+            break
+    if not found:
+        return None
+    try:
+        return name.decode("utf-8")
+    except UnicodeDecodeError:
+        return name.decode("latin-1")
+
+
+def decode_name(data, record, joliet, rock_ridge):
+    if joliet:
+        name = record.name.decode("utf-16-be", errors="replace")
+    else:
+        name = rock_ridge_name(data, record) if rock_ridge else None
+        if name is not None:
+            return name
+        name = record.name.decode("latin-1")
+    name = VERSION_PATTERN.sub("", name)
+    if name.endswith(".") and not record.is_directory:
+        name = name[:-1]  # Files without an extension are recorded as 'NAME.'.
+    return name
+
+
+def has_rock_ridge(data, root):
+    # Rock Ridge images start the system use area of the root directory's '.' record with an 'SP' entry.
+    offset = root.extent * SECTOR_SIZE
+    first = Record(read(data, offset, read(data, offset, 1)[0]))
+    return first.system_use[:2] == b"SP"
+
+
+def volume_roots(data):
+    primary = None
+    joliet = None
+    sector = FIRST_VOLUME_DESCRIPTOR_SECTOR
+    while True:
+        descriptor = read(data, sector * SECTOR_SIZE, SECTOR_SIZE)
+        if bytes(descriptor[1:6]) != STANDARD_IDENTIFIER:
+            raise UnsupportedImage("Missing volume descriptor")
+        kind = descriptor[0]
+        if kind == VOLUME_DESCRIPTOR_TERMINATOR:
+            break
+        elif kind == VOLUME_DESCRIPTOR_PRIMARY and primary is None:
+            primary = Record(descriptor[156:190])
+        elif kind == VOLUME_DESCRIPTOR_SUPPLEMENTARY and joliet is None:
+            if bytes(descriptor[88:91]) in JOLIET_ESCAPE_SEQUENCES:
+                joliet = Record(descriptor[156:190])
+        sector += 1
+    if primary is None:
+        raise UnsupportedImage("Missing primary volume descriptor")
+    return primary, joliet
+
+
+def list_files(data):
+    """
+    Return the files in an ISO9660 image (as `bytes` or an `mmap`) as a list of (path, offset, length) tuples, where
+    `path` uses '/' as its separator. Joliet names are preferred (matching 7-Zip), followed by Rock Ridge and then
+    plain ISO9660 names. Raises `UnsupportedImage` if the image isn't an ISO9660 image or uses features that aren't
+    supported.
+    """
+    primary, joliet = volume_roots(data)
+    root = joliet if joliet is not None else primary
+    rock_ridge = joliet is None and has_rock_ridge(data, primary)
+
+    files = []
+    visited = set()
+
+    def walk(directory, path, depth):
+        if depth > MAXIMUM_DEPTH or directory.extent in visited:
+            raise UnsupportedImage("Invalid directory structure")
+        visited.add(directory.extent)
+        offset = directory.extent * SECTOR_SIZE
+        end = offset + directory.size
+        check_range(data, offset, directory.size)
+        while offset < end:
+            length = data[offset]
+            if length == 0:
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE  # Records never cross sector boundaries.
+                continue
+            record = Record(read(data, offset, length))
+            offset += length
+            if record.is_special:
+                continue
+            if record.flags & FLAG_MULTI_EXTENT:
+                raise UnsupportedImage("Multi-extent files are not supported")
+            name = decode_name(data, record, joliet=root is joliet, rock_ridge=rock_ridge)
+            if record.is_directory:
+                walk(record, path + name + "/", depth + 1)
+            else:
+                file_offset = (record.extent + record.extended_attribute_length) * SECTOR_SIZE
+                check_range(data, file_offset, record.size)
+                files.append((path + name, file_offset, record.size))
+
+    walk(root, "", 0)
+    return files
@@ -31,12 +31,15 @@ import requests
 import yaml
 
 from . import common
+from . import containers
+from . import epoc
 
 
 TOOLS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIRECTORY = os.path.dirname(TOOLS_DIRECTORY)
 
 DEFAULT_LIBRARY_PATH = os.path.join(ROOT_DIRECTORY, "libraries", "full.yaml")
+EXAMPLES_DIRECTORY = os.path.join(ROOT_DIRECTORY, "examples")
 
 
 # https://stackoverflow.com/questions/33046733/force-requests-to-use-ipv4-ipv6#46972341
@@ -185,6 +188,52 @@ def command_search(options):
         print(" -> ".join([item.name for item in reference] + [basename]))
 
 
+@fastcommand.command("compare-parsers", help="compare the native SIS and AIF parsers with the opolua tools", arguments=[
+    fastcommand.Argument("path", nargs="*", help=f"files, directories, or archives to compare (defaults to '{os.path.relpath(EXAMPLES_DIRECTORY)}')"),
+])
+def command_compare_parsers(options):
+    # Loading opolua resolves the Lua interpreter, so we only do so for the commands that need it.
+    from . import opolua
+
+    paths = options.path if options.path else [EXAMPLES_DIRECTORY]
+    comparison = epoc.Comparison()
+    for path in paths:
+        files = (containers.materialize(file_path)
+                 for (file_path, reference) in containers.walk(path, relative_to=os.path.dirname(path)))
+        result = epoc.compare(files, reference_sis=opolua.dumpsis, reference_aif=opolua.dumpaif)
+        comparison.matches += result.matches
+        comparison.fallbacks += result.fallbacks
+        comparison.mismatches += result.mismatches
+
+    for (path, native, reference) in comparison.mismatches:
+        print(f"{path}:")
+        print(f"    native:    {native}")
+        print(f"    reference: {reference}")
+
+    print(f"{comparison.matches} matching, {comparison.fallbacks} unsupported, {len(comparison.mismatches)} mismatched")
+    if comparison.mismatches:
+        exit(1)
+
+
+@fastcommand.command("migrate-snapshots", help="convert snapshots to the current format", arguments=[
+    fastcommand.Argument("path", nargs="*", help="snapshot archives or synced snapshot directories (defaults to the library's synced snapshots)"),
+])
+def command_migrate_snapshots(options):
+    # Loading the snapshot tool configures logging, so we only do so for the commands that need it.
+    from . import snapshot
+
+    paths = options.path
+    if not paths:
+        snapshots_directory = os.path.join(common.Library(options.library).assets_directory, "snapshots")
+        paths = [os.path.join(snapshots_directory, identifier)
+                 for identifier in sorted(os.listdir(snapshots_directory))] if os.path.isdir(snapshots_directory) else []
+    for path in paths:
+        if snapshot.migrate(path):
+            logging.info("Migrated '%s'.", path)
+        else:
+            logging.info("'%s' is already up to date.", path)
+
+
 def main():
     cli = fastcommand.CommandParser(description="Management tool for the Psion Software Index.")
     cli.add_argument("--library", help=f"path to the library (defaults to '{os.path.relpath(DEFAULT_LIBRARY_PATH)}')", default=DEFAULT_LIBRARY_PATH)
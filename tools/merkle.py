@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Merkle trees of the files in a source, used to tell whether (and where) a source has changed since it was indexed.
+#
+# Trees are plain dictionaries so they can be stored alongside the source manifest. Files are `{"hash": ...}` nodes
+# holding the sha256 of their contents, along with the fingerprint (see `utils.fingerprint`) they were hashed with, and
+# directories are `{"hash": ..., "children": {name: node}}` nodes whose hash covers the names and hashes of their
+# children. Building a tree from a previous one only reads the files whose fingerprints have changed.
+
+import hashlib
+import os
+import time
+
+from . import cache
+from . import utils
+
+
+def directory_node(children):
+    sha256 = hashlib.sha256()
+    for name, child in sorted(children.items()):
+        kind = "tree" if "children" in child else "blob"
+        sha256.update(f"{kind} {name}\0{child['hash']}\n".encode("utf-8"))
+    return {"hash": sha256.hexdigest(), "children": children}
+
+
+def build(path, previous=None):
+    """
+    Return the tree for the file or directory at `path`, reusing the hashes in `previous` for files that haven't
+    changed. Hidden files are ignored.
+    """
+    if os.path.isdir(path):
+        previous_children = previous.get("children", {}) if previous is not None else {}
+        return directory_node({name: build(os.path.join(path, name), previous_children.get(name))
+                               for name in utils.listdir(path, include_hidden=False)})
+
+    built_at = time.time_ns()
+    fingerprint = list(utils.fingerprint(os.stat(path)))
+    if previous is not None and previous.get("fingerprint") == fingerprint:
+        return previous
+    node = {"hash": utils.shasum(path)}
+    # Files modified just before they were hashed might change again without changing their fingerprint.
+    if fingerprint[3] < built_at - cache.RACY_INTERVAL_NS:
+        node["fingerprint"] = fingerprint
+    return node
+
+
+def from_hashes(files):
+    """
+    Return the tree for an iterable of ('/'-separated path, sha256) pairs, such as the members of a snapshot.
+    """
+    root = {"children": {}}
+    for path, sha256 in files:
+        *directories, name = path.split("/")
+        parent = root
+        for directory in directories:
+            parent = parent["children"].setdefault(directory, {"children": {}})
+        parent["children"][name] = {"hash": sha256}
+
+    def convert(node):
+        if "children" not in node:
+            return node
+        return directory_node({name: convert(child) for name, child in node["children"].items()})
+
+    return convert(root)
+
+
+def subtree(tree, path):
+    """
+    Return the node for the '/'-separated `path` within `tree`, or None if there's no such file or directory.
+    """
+    node = tree
+    for name in path.split("/") if path else []:
+        node = node.get("children", {}).get(name) if node is not None else None
+    return node
+
+
+def changes(previous, current, path=""):
+    """
+    Return the '/'-separated paths of the files and directories that differ between two trees, only descending into
+    directories that exist in both. An empty path means the whole tree has changed.
+    """
+    if previous is not None and current is not None and previous["hash"] == current["hash"]:
+        return []
+    if previous is None or current is None or "children" not in previous or "children" not in current:
+        return [path]
+    result = []
+    for name in sorted(set(previous["children"]) | set(current["children"])):
+        result += changes(previous["children"].get(name),
+                          current["children"].get(name),
+                          path + "/" + name if path else name)
+    return result
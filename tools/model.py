@@ -21,6 +21,10 @@
 # SOFTWARE.
 
 
+import threading
+import weakref
+
+
 class Collection(object):
 
     def __init__(self, identifier, items):
@@ -35,13 +39,113 @@ class Collection(object):
 
 
 class ReferenceItem(object):
+    """
+    Immutable item in a `Reference`. Items are interned, so every reference to the same container shares one item.
+    """
+
+    __slots__ = ("name", "url", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __new__(cls, name, url):
+        key = (name, url)
+        with cls._lock:
+            item = cls._interned.get(key)
+            if item is None:
+                item = super().__new__(cls)
+                object.__setattr__(item, "name", name)
+                object.__setattr__(item, "url", url)
+                cls._interned[key] = item
+        return item
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{type(self).__name__}' is immutable")
+
+    def __reduce__(self):
+        return (ReferenceItem, (self.name, self.url))
 
-    def __init__(self, name, url):
-        self.name = name
-        self.url = url
+    def __repr__(self):
+        return f"ReferenceItem(name={self.name!r}, url={self.url!r})"
 
     def as_dict(self):
         return {
             'name': self.name,
             'url': self.url,
         }
+
+
+class Reference(object):
+    """
+    Immutable chain of `ReferenceItem`s describing where a file was found (e.g., source, container, file).
+
+    Chains behave like tuples, but each one is stored as a link to its parent chain, and chains are interned, so the
+    references for all the files in a container share the container's prefix, and building a reference that already
+    exists allocates nothing. References are only converted to dictionaries when releases are serialised.
+    """
+
+    __slots__ = ("parent", "item", "_length", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+    _empty = None
+
+    def __new__(cls, items=()):
+        reference = cls._empty
+        for item in items:
+            reference = reference.append(item)
+        return reference
+
+    @classmethod
+    def _link(cls, parent, item):
+        key = (parent, item)
+        with cls._lock:
+            reference = cls._interned.get(key)
+            if reference is None:
+                reference = object.__new__(cls)
+                object.__setattr__(reference, "parent", parent)
+                object.__setattr__(reference, "item", item)
+                object.__setattr__(reference, "_length", parent._length + 1 if parent is not None else 0)
+                cls._interned[key] = reference
+        return reference
+
+    def append(self, item):
+        return Reference._link(self, item)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{type(self).__name__}' is immutable")
+
+    def __reduce__(self):
+        return (Reference, (tuple(self), ))
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        items = []
+        reference = self
+        while reference._length > 0:
+            items.append(reference.item)
+            reference = reference.parent
+        return reversed(items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Reference(tuple(self)[index])
+        return tuple(self)[index]
+
+    def __add__(self, items):
+        reference = self
+        for item in items:
+            reference = reference.append(item)
+        return reference
+
+    def __radd__(self, items):
+        return Reference(items) + self
+
+    def __repr__(self):
+        return f"Reference({list(self)!r})"
+
+
+# The root of every chain, which is kept alive for the lifetime of the process.
+Reference._empty = Reference._link(None, None)
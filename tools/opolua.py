@@ -18,20 +18,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import atexit
 import base64
+import contextlib
+import functools
 import hashlib
 import json
 import logging
 import os
 import re
+import resource
 import shutil
 import subprocess
-import tempfile
+import threading
 
 from io import BytesIO
 
 from PIL import Image as PILImage, ImageOps
 
+from . import epoc
+from . import scratch
+from . import utils
+
 
 TOOLS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIRECTORY = os.path.dirname(TOOLS_DIRECTORY)
@@ -39,17 +47,59 @@ OPOLUA_DIRECTORY = os.path.join(ROOT_DIRECTORY, "dependencies", "opolua")
 DUMPAIF_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "dumpaif.lua")
 DUMPSIS_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "dumpsis.lua")
 RECOGNIZE_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "recognize.lua")
+WORKER_PATH = os.path.join(TOOLS_DIRECTORY, "opolua_worker.lua")
+
+# The maximum number of paths sent to a single worker in one batch request.
+BATCH_SIZE = 256
+
+# The worker limits each file in a batch to `LUA_TIMEOUT` of CPU time itself, so the wall-clock timeout for a batch is
+# only a backstop for a stuck worker and is capped at this many multiples of `LUA_TIMEOUT`. Batches that time out are
+# retried one file at a time.
+MAX_BATCH_TIMEOUT_FACTOR = 2
+
+# Workers are recycled after this many requests to bound any state that accumulates in the Lua interpreter.
+MAX_WORKER_REQUESTS = 1000
 
+RESOURCE_LIMIT_MESSAGES = ["Resource limit exceeded", "not enough memory"]
 UNSUPPORTED_MESSAGE = "Only ER5 SIS files are supported"
 NOT_AN_AI_MESSAGE = "Not an AIF file"
 NO_DEVICE_MAPPING_MESSAGE = "No device path mapping for"
 
+# The `dumpaif -e` output only identifies icons with a single digit index, and only applies masks that are 2bpp, so the
+# native icon decoder is limited in the same way to ensure both produce the same icons.
+MAXIMUM_ICONS = 10
+MASK_BPP = 2
+
+# EPOC bitmaps store the first pixel in the least significant bits of each byte, while Pillow's raw decoders expect it
+# in the most significant bits, so we reorder the pixels within each byte before decoding.
+RAW_MODES = {
+    1: ("1;R", None),
+    2: ("L;2", bytes((b & 0x03) << 6 | (b & 0x0c) << 2 | (b & 0x30) >> 2 | (b & 0xc0) >> 6 for b in range(256))),
+    4: ("L;4", bytes((b & 0x0f) << 4 | (b & 0xf0) >> 4 for b in range(256))),
+    8: ("L", None),
+}
+
+# Extensions used for application information files, in order of preference.
+AIF_EXTENSIONS = [".aif", ".aco", ".abw"]
+
 try:
     LUA_PATH = os.environ["LUA_PATH"]
 except KeyError:
     # By default we respect the default version of lua specified in .tool-versions.
     LUA_PATH = subprocess.check_output(["mise", "which", "lua", "--cd", OPOLUA_DIRECTORY]).decode("utf-8").strip()
 
+# The number of long-lived Lua workers used to run the opolua tools; setting this to 0 reverts to launching a new Lua
+# process for every call, which can be useful when debugging the tools themselves.
+LUA_WORKERS = int(os.environ.get("INDEXER_LUA_WORKERS", os.cpu_count() or 1))
+
+# Limits applied to each invocation of an opolua tool: wall-clock time in seconds, and memory in megabytes. Setting either
+# to 0 disables the corresponding limit. Memory limits are only enforced when using the Lua workers.
+LUA_TIMEOUT = float(os.environ.get("INDEXER_LUA_TIMEOUT", 300))
+LUA_MEMORY_LIMIT = int(os.environ.get("INDEXER_LUA_MEMORY_LIMIT", 2048)) * 1024 * 1024
+
+# Use the native parsers in `epoc` for SIS and AIF headers where possible, falling back to the opolua tools.
+NATIVE_PARSERS = os.environ.get("INDEXER_NATIVE_PARSERS", "1") != "0"
+
 
 class UnsupportedInstaller(Exception):
     pass
@@ -70,14 +120,230 @@ class ExecutionError(Exception):
         return self.stdout + self.stderr
 
 
+class ResourceLimitExceeded(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+def check_resource_limits(returncode, stderr):
+    if returncode == 0:
+        return
+    stderr = stderr.decode("utf-8", errors="replace")
+    for message in RESOURCE_LIMIT_MESSAGES:
+        if message in stderr:
+            raise ResourceLimitExceeded(stderr.strip())
+
+
+class LuaWorker(object):
+
+    def __init__(self):
+        self.requests = 0
+        # The worker enforces the memory limit (and a CPU time limit) for each tool itself; the address space limit is
+        # a backstop for allocations that happen between its checks and, like the timeout, is only applied where
+        # supported.
+        try:
+            self.process = subprocess.Popen([LUA_PATH, WORKER_PATH, str(LUA_MEMORY_LIMIT), str(LUA_TIMEOUT)],
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        except OSError as e:
+            raise WorkerError(f"Failed to start Lua worker with error '{e}'")
+        if LUA_MEMORY_LIMIT > 0 and hasattr(resource, "prlimit"):
+            try:
+                resource.prlimit(self.process.pid, resource.RLIMIT_AS, (LUA_MEMORY_LIMIT * 2, LUA_MEMORY_LIMIT * 2))
+            except (ValueError, OSError) as e:
+                logging.debug("Failed to limit Lua worker memory with error '%s'.", e)
+
+    def request(self, items, timeout=0):
+        message = [b"%d\n" % len(items)]
+        for item in items:
+            data = os.fsencode(item)
+            message.append(b"%d\n" % len(data))
+            message.append(data)
+
+        # Kill the worker if it doesn't respond in time; this is the only way to recover from a tool that's stuck.
+        timed_out = threading.Event()
+        def expire():
+            timed_out.set()
+            self.process.kill()
+        timer = threading.Timer(timeout, expire) if timeout > 0 else None
+        if timer is not None:
+            timer.start()
+
+        try:
+            self.process.stdin.write(b"".join(message))
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            status, stdout_length, stderr_length = [int(value) for value in header.split()]
+            stdout = self.process.stdout.read(stdout_length)
+            stderr = self.process.stdout.read(stderr_length)
+            if len(stdout) != stdout_length or len(stderr) != stderr_length:
+                raise ValueError("Truncated response")
+        except (OSError, ValueError) as e:
+            if timed_out.is_set():
+                raise ResourceLimitExceeded(f"Timed out after {timeout}s")
+            raise WorkerError(f"Lua worker failed with error '{e}'")
+        finally:
+            if timer is not None:
+                timer.cancel()
+                timer.join()
+        # The timer can fire after the response has been read, leaving us with a complete response from a worker that's
+        # been killed; treat that as a timeout so the worker isn't returned to the pool.
+        if timed_out.is_set():
+            raise ResourceLimitExceeded(f"Timed out after {timeout}s")
+        self.requests += 1
+        return status, stdout, stderr
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class LuaWorkerPool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    @contextlib.contextmanager
+    def worker(self):
+        with self._semaphore:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None:
+                worker = LuaWorker()
+            try:
+                yield worker
+            except BaseException:
+                # We can't trust the state of the pipes after a failure, so we don't return the worker to the pool.
+                worker.close()
+                raise
+            if worker.requests >= MAX_WORKER_REQUESTS:
+                worker.close()
+            else:
+                with self._lock:
+                    self._idle.append(worker)
+
+    def run(self, command):
+        with self.worker() as worker:
+            returncode, stdout, stderr = worker.request(["run"] + command, timeout=LUA_TIMEOUT)
+            check_resource_limits(returncode, stderr)
+            return returncode, stdout, stderr
+
+    def analyse(self, path, destination):
+        with self.worker() as worker:
+            returncode, stdout, stderr = worker.request(["analyse", DUMPSIS_PATH, DUMPAIF_PATH, path, destination],
+                                                        timeout=LUA_TIMEOUT * 3)
+            check_resource_limits(returncode, stderr)
+            return returncode, stdout, stderr
+
+    def batch(self, command, paths):
+        script, *arguments = command
+        paths = list(paths)
+        with self.worker() as worker:
+            returncode, stdout, stderr = worker.request(["batch", script, str(len(arguments))] + arguments + paths,
+                                                        timeout=LUA_TIMEOUT * min(len(paths), MAX_BATCH_TIMEOUT_FACTOR))
+            check_resource_limits(returncode, stderr)
+            return returncode, stdout, stderr
+
+    def close(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LuaWorkerPool(size=LUA_WORKERS)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def run_lua_process(command):
+    if LUA_WORKERS < 1:
+        try:
+            result = subprocess.run([LUA_PATH] + command, capture_output=True, timeout=LUA_TIMEOUT or None)
+        except subprocess.TimeoutExpired:
+            raise ResourceLimitExceeded(f"Timed out after {LUA_TIMEOUT}s")
+        return result.returncode, result.stdout, result.stderr
+    try:
+        return get_pool().run(command)
+    except WorkerError as e:
+        # Surface worker crashes (e.g., the interpreter running out of memory) in the same way as a failing tool.
+        return 1, b"", str(e).encode("utf-8")
+
+
+class PrefilterStatistics(object):
+
+    def __init__(self):
+        self.checked = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, skipped):
+        with self._lock:
+            self.checked += 1
+            if skipped:
+                self.skipped += 1
+
+    @property
+    def hit_rate(self):
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def __str__(self):
+        return f"skipped {self.skipped} of {self.checked} files ({self.hit_rate:.1%})"
+
+
+# Counts the files the native prefilter was able to rule out without running recognize.lua.
+prefilter_statistics = PrefilterStatistics()
+
+
+class Installer(object):
+
+    def __init__(self, uid, name, version, files, icons):
+        self.uid = uid
+        self.name = name  # Localized names, keyed by locale.
+        self.version = version
+        self.files = files  # Recognition details, keyed by path relative to the root of the installer payload.
+        self.icons = icons
+
+    def as_dict(self):
+        return {
+            "uid": self.uid,
+            "name": self.name,
+            "version": self.version,
+            "files": self.files,
+            "icons": [icon.as_dict() for icon in self.icons],
+        }
+
+
 class Image(object):
 
-    def __init__(self, width, height, bpp, source):
+    def __init__(self, width, height, bpp, source, shasum=None):
         self.width = width
         self.height = height
         self.bpp = bpp
         self._source = source
-        self._shasum = None
+        self._shasum = shasum
 
     @property
     def shasum(self):
@@ -95,39 +361,81 @@ class Image(object):
     def write(self, directory_path):
         self._source.save(os.path.join(directory_path, self.filename), format="GIF")
 
+    def save(self, path, format):
+        self._source.save(path, format=format)
+
+    def as_dict(self):
+        return {
+            "width": self.width,
+            "height": self.height,
+            "bpp": self.bpp,
+            "sha256": self.shasum,
+        }
+
+
+@functools.cache
+def revision():
+    """
+    Return a digest identifying the current opolua sources and the Python code that drives them, for use in keying
+    cached results.
+    """
+    sha256 = hashlib.sha256()
+    paths = [os.path.join(root, f)
+             for root, dirs, files in os.walk(os.path.join(OPOLUA_DIRECTORY, "src"))
+             for f in files
+             if f.endswith(".lua")]
+    paths += [WORKER_PATH, os.path.abspath(__file__), epoc.__file__]
+    for path in sorted(paths):
+        sha256.update(os.path.relpath(path, ROOT_DIRECTORY).encode("utf-8"))
+        with open(path, "rb") as fh:
+            sha256.update(hashlib.sha256(fh.read()).digest())
+    return sha256.hexdigest()
+
 
 def run_lua_command(command, encoding, requires_decode=True):
-    result = subprocess.run([LUA_PATH] + command, capture_output=True)
+    returncode, stdout, stderr = run_lua_process(command)
     try:
-        stdout = result.stdout.decode(encoding)
-        stderr = result.stderr.decode(encoding)
+        stdout = stdout.decode(encoding)
+        stderr = stderr.decode(encoding)
     except UnicodeDecodeError:
         if requires_decode:
             raise
         stdout = ""
         stderr = ""
-    try:
-        result.check_returncode()
-    except:
+    if returncode != 0:
         raise ExecutionError(stdout, stderr)
     return stdout
 
 
+def json_command_error(error):
+    # Returns the exception to raise for an `ExecutionError` from `dumpsis --json` or `dumpaif --json`.
+    if UNSUPPORTED_MESSAGE in error.output:
+        return UnsupportedInstaller(error.output)
+    elif NOT_AN_AI_MESSAGE in error.output:
+        return InvalidAIF(error.output)
+    elif "Bad uid2 in SIS file!" in error.output:
+        return UnsupportedInstaller(error.output)
+    elif "Unknown record type 1037" in error.output:
+        return UnsupportedInstaller(error.output)
+    else:
+        # Everything else is an error we'd like to know about.
+        return error
+
+
+def extract_error(error):
+    # Returns the exception to raise for an `ExecutionError` from `dumpsis` when extracting an installer.
+    # TODO: #188: Remove guard against dumpsis invalid relative path extraction failures #18
+    #       https://github.com/inseven/psion-software-index/issues/1888
+    if NO_DEVICE_MAPPING_MESSAGE in error.output:
+        return UnsupportedInstaller(error.output)
+    return error
+
+
 def run_json_command(command, path, encoding="utf-8"):
     try:
         stdout = run_lua_command([command, "--json", path], encoding="utf-8")
     except ExecutionError as e:
-        if UNSUPPORTED_MESSAGE in e.output:
-            raise UnsupportedInstaller(e.output)
-        elif NOT_AN_AI_MESSAGE in e.output:
-            raise InvalidAIF(e.output)
-        elif "Bad uid2 in SIS file!" in e.output:
-            raise UnsupportedInstaller(e.output)
-        elif "Unknown record type 1037" in e.output:
-            raise UnsupportedInstaller(e.output)
-        else:
-            # Everything else is an error we'd like to know about.
-            raise
+        raise json_command_error(e)
 
     return json.loads(stdout)
 
@@ -140,58 +448,318 @@ def dumpaif(path):
     return run_json_command(DUMPAIF_PATH, path)
 
 
+def aif_info(path):
+    """
+    Return the `uid3` and `captions` fields of `dumpaif --json`, parsing the file natively where possible.
+    """
+    if NATIVE_PARSERS:
+        try:
+            return epoc.read_aif(path)
+        except epoc.UnsupportedFile as e:
+            logging.debug("Using dumpaif for '%s' (%s).", path, e)
+    return dumpaif(path)
+
+
 def dumpsis_extract(source, destination):
-    # TODO: #188: Remove guard against dumpsis invalid relative path extraction failures #18
-    #       https://github.com/inseven/psion-software-index/issues/1888
     try:
         return run_lua_command([DUMPSIS_PATH, source, destination], encoding='cp1252', requires_decode=False)
     except ExecutionError as e:
-        if NO_DEVICE_MAPPING_MESSAGE in e.output:
-            raise UnsupportedInstaller(e.output)
-        else:
-            raise
+        raise extract_error(e)
+
+
+def extract_installer_native(source, destination):
+    # Extracts the files needed to index an installer natively, raising `epoc.UnsupportedFile` if that's not possible.
+    skipped = []
+    with epoc.open_sis_files(source) as files:
+        for file in files:
+            _, ext = os.path.splitext(file.path)
+            if ext.lower() not in AIF_EXTENSIONS and not epoc.is_candidate_data(file.path, file.data):
+                skipped.append(file.path)
+                continue
+            path = os.path.join(destination, *file.path.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                fh.write(file.data)
+    logging.debug("Extracted %d of %d files from '%s'.", len(files) - len(skipped), len(files), source)
+    return skipped
+
+
+def find_aif(path):
+    # Walk the tree once, keeping the first match for each extension, and return the best match by extension.
+    matches = {}
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            for extension in AIF_EXTENSIONS:
+                if f.endswith(extension) and extension not in matches:
+                    matches[extension] = os.path.join(root, f)
+    for extension in AIF_EXTENSIONS:
+        if extension in matches:
+            return matches[extension]
+    return None
+
+
+def bitmap_image(bitmap):
+    # Returns a greyscale ("L") image, with each pixel scaled to the full 0-255 range.
+    rawmode, table = RAW_MODES[bitmap.bpp]
+    data = bitmap.data.translate(table) if table is not None else bitmap.data
+    mode = "1" if bitmap.bpp == 1 else "L"
+    return PILImage.frombytes(mode, (bitmap.width, bitmap.height), data, "raw", rawmode, bitmap.stride).convert("L")
 
 
 def get_icons(aif_path):
+    if NATIVE_PARSERS:
+        try:
+            icons = []
+            for bitmap, mask in epoc.read_aif_icons(aif_path)[:MAXIMUM_ICONS]:
+                image = bitmap_image(bitmap).convert("RGBA")
+                if mask.bpp == MASK_BPP:
+                    image.putalpha(ImageOps.invert(bitmap_image(mask)))
+                icons.append(Image(bitmap.width, bitmap.height, bitmap.bpp, image))
+            return icons
+        except epoc.UnsupportedFile as e:
+            logging.debug("Using dumpaif to extract icons from '%s' (%s).", aif_path, e)
+    return get_icons_dumpaif(aif_path)
+
+
+def get_icons_dumpaif(aif_path):
     aif_path = os.path.abspath(aif_path)
-    with tempfile.TemporaryDirectory() as directory_path:
+    with scratch.TemporaryDirectory() as directory_path:
         aif_basename = os.path.basename(aif_path)
         temporary_aif_path = os.path.join(directory_path, aif_basename)
         shutil.copyfile(aif_path, temporary_aif_path)
-        subprocess.check_output([LUA_PATH, DUMPAIF_PATH, "-e", temporary_aif_path])
-        aif_basename = os.path.basename(temporary_aif_path)
-        aif_dirname = os.path.dirname(temporary_aif_path)
-        icon_candidates = os.listdir(aif_dirname)
-        icons = []
-        for candidate in icon_candidates:
-            match = re.match("^" + re.escape(aif_basename) + r"_(\d)_(\d+)x(\d+)_(\d)bpp.bmp$", candidate)
-            if match:
-                index = match.group(1)
-                width = int(match.group(2))
-                height = int(match.group(3))
-                bpp = int(match.group(4))
-                asset_path = os.path.join(aif_dirname, candidate)
-
-                # Load the mask if it exists.
-                mask = None
-                mask_path = os.path.join(aif_dirname, f"{aif_basename}_{index}_mask_{width}x{height}_2bpp.bmp")
-                if os.path.exists(mask_path):
-                    with PILImage.open(mask_path) as m:
-                        mask = m.convert("L").point(lambda i: i * 85)
-                        mask = ImageOps.invert(mask)
-
-                # Load the image.
-                with PILImage.open(asset_path) as image, BytesIO() as output:
-                    image_copy = image.convert("RGBA")
-                    if mask:
-                        image_copy.putalpha(mask)
-                    icons.append(Image(width, height, bpp, image_copy))
-        return icons
+        run_lua_command([DUMPAIF_PATH, "-e", temporary_aif_path], encoding="utf-8", requires_decode=False)
+        return load_dumpaif_icons(temporary_aif_path, os.listdir(directory_path))
+
+
+def load_dumpaif_icons(aif_path, icon_candidates):
+    """
+    Load the icons written alongside `aif_path` by `dumpaif -e`, given the names of the files that might be icons.
+    """
+    aif_basename = os.path.basename(aif_path)
+    aif_dirname = os.path.dirname(aif_path)
+    icons = []
+    for candidate in icon_candidates:
+        match = re.match("^" + re.escape(aif_basename) + r"_(\d)_(\d+)x(\d+)_(\d)bpp.bmp$", candidate)
+        if match:
+            index = match.group(1)
+            width = int(match.group(2))
+            height = int(match.group(3))
+            bpp = int(match.group(4))
+            asset_path = os.path.join(aif_dirname, candidate)
+
+            # Load the mask if it exists.
+            mask = None
+            mask_path = os.path.join(aif_dirname, f"{aif_basename}_{index}_mask_{width}x{height}_2bpp.bmp")
+            if os.path.exists(mask_path):
+                with PILImage.open(mask_path) as m:
+                    mask = m.convert("L").point(lambda i: i * 85)
+                    mask = ImageOps.invert(mask)
+
+            # Load the image.
+            with PILImage.open(asset_path) as image, BytesIO() as output:
+                image_copy = image.convert("RGBA")
+                if mask:
+                    image_copy.putalpha(mask)
+                icons.append(Image(width, height, bpp, image_copy))
+    return icons
+
+
+def is_candidate(path):
+    if not NATIVE_PARSERS:
+        return True
+    candidate = epoc.is_candidate(path)
+    prefilter_statistics.record(skipped=not candidate)
+    return candidate
 
 
 def recognize(path):
+    if not is_candidate(path):
+        return {"type": "unknown"}
+    return recognize_lua(path)
+
+
+def recognize_lua(path):
     logging.debug("Recognizing '%s'...", path)
     try:
         return run_json_command(RECOGNIZE_PATH, path)
-    except:
+    except ResourceLimitExceeded:
+        # Leave it to the indexer to quarantine the file and record it as skipped.
+        raise
+    except Exception:
         return {"type": "unknown"}
+
+
+def recognize_batch(paths, error_handler=None):
+    """
+    Recognize a list of files with a single worker request. Files that exceed a resource limit are reported as unknown
+    and passed to `error_handler` (along with the `ResourceLimitExceeded` error) if one is provided, and the error is
+    raised otherwise.
+    """
+    if LUA_WORKERS < 1:
+        return [recognize_individually(path, error_handler) for path in paths]
+    try:
+        returncode, stdout, stderr = get_pool().batch([RECOGNIZE_PATH, "--json"], paths)
+        if returncode != 0:
+            raise ExecutionError(stdout, stderr)
+        results = json.loads(stdout.decode("utf-8"))
+    except (WorkerError, ResourceLimitExceeded, ExecutionError, UnicodeDecodeError, ValueError) as e:
+        # A single pathological file can take down (or time out) the whole batch, so we retry the files individually.
+        logging.debug("Batch recognition failed with error '%s'; recognizing individually...", e)
+        return [recognize_individually(path, error_handler) for path in paths]
+    return [recognition_result(path, result, error_handler) for path, result in zip(paths, results)]
+
+
+def recognize_individually(path, error_handler):
+    try:
+        return recognize_lua(path)
+    except ResourceLimitExceeded as e:
+        return resource_limit_exceeded(path, e, error_handler)
+
+
+def recognition_result(path, result, error_handler):
+    # The worker reports files the tool failed on (including Lua errors) as error records rather than failing the batch.
+    if result is None:
+        return {"type": "unknown"}
+    if "error" in result:
+        message = result["error"].strip()
+        if any(limit_message in message for limit_message in RESOURCE_LIMIT_MESSAGES):
+            return resource_limit_exceeded(path, ResourceLimitExceeded(message), error_handler)
+        logging.debug("Failed to recognize '%s' with error '%s'.", path, message)
+        return {"type": "unknown"}
+    return result
+
+
+def resource_limit_exceeded(path, error, error_handler):
+    if error_handler is None:
+        raise error
+    error_handler(path, error)
+    return {"type": "unknown"}
+
+
+def recognize_many(paths, error_handler=None):
+    """
+    Recognize a list of files, or all the (non-hidden) files in a directory tree, returning a dictionary mapping each
+    path to its recognition details. Files that the native prefilter rules out are reported as unknown without running
+    recognize.lua, and the rest are sent to the Lua workers in batches to avoid a round trip per file. Files that exceed
+    a resource limit are handled as described in `recognize_batch`.
+    """
+    if isinstance(paths, str) and os.path.isdir(paths):
+        paths = [os.path.join(root, f)
+                 for root, dirs, files in os.walk(paths)
+                 for f in files
+                 if not f.startswith(".")]
+    results = {}
+    candidates = []
+    for path in paths:
+        if is_candidate(path):
+            candidates.append(path)
+        else:
+            results[path] = {"type": "unknown"}
+    results.update(recognize_candidates(candidates, error_handler=error_handler))
+    return results
+
+
+def recognize_candidates(paths, error_handler=None):
+    """
+    Equivalent to `recognize_many` for a list of files that have already passed the native prefilter.
+    """
+    results = {}
+    for i in range(0, len(paths), BATCH_SIZE):
+        batch = paths[i:i + BATCH_SIZE]
+        logging.debug("Recognizing %d files...", len(batch))
+        results.update(zip(batch, recognize_batch(batch, error_handler=error_handler)))
+    return results
+
+
+def decode_worker_path(value):
+    # Reverses the Lua worker's escaping of bytes outside printable ASCII (see `encodeString`).
+    return os.fsdecode(value.encode("latin-1"))
+
+
+def analyse_installer_lua(path, destination):
+    """
+    Read an installer's metadata and extract its payload to `destination` with dumpsis, and extract the icons from its
+    AIF with dumpaif, in a single worker request. Returns the metadata (as `dumpsis --json`), the path of the AIF (or
+    None), and a function that returns the AIF's icons.
+    """
+    if LUA_WORKERS < 1:
+        info = dumpsis(path)
+        dumpsis_extract(path, destination)
+        aif_path = find_aif(destination)
+        return info, aif_path, functools.partial(get_icons, aif_path)
+
+    try:
+        returncode, stdout, stderr = get_pool().analyse(os.path.abspath(path), destination)
+    except WorkerError as e:
+        raise ExecutionError("", str(e))
+    if returncode != 0:
+        error = ExecutionError("", stderr.decode("utf-8", errors="replace"))
+        raise json_command_error(error) if stdout == b"info" else extract_error(error)
+    result = json.loads(stdout.decode("utf-8"))
+
+    # Fall back to finding the AIF ourselves if dumpsis didn't write its files in a way the worker could see.
+    if result["aif"] is None:
+        aif_path = find_aif(destination)
+        return result["info"], aif_path, functools.partial(get_icons, aif_path)
+
+    aif_path = decode_worker_path(result["aif"])
+    icon_paths = [decode_worker_path(icon_path) for icon_path in result["icons"]]
+
+    def load_icons():
+        try:
+            if "error" in result:
+                raise ExecutionError("", result["error"])
+            return load_dumpaif_icons(aif_path, [os.path.basename(icon_path) for icon_path in icon_paths])
+        finally:
+            # Remove the bitmaps so they're not mistaken for part of the payload.
+            for icon_path in icon_paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(icon_path)
+
+    return result["info"], aif_path, load_icons
+
+
+def analyse_installer(path, error_handler=None):
+    """
+    Analyse a SIS file in one pass, returning an `Installer` describing its metadata, the recognition details of every
+    file in its payload, and the icons from its AIF (if any). Installers are parsed natively where possible, extracting
+    only the files that might be recognized, and otherwise with a single combined opolua request; the extracted files
+    are recognized in a single batch. Failures to decode the icons are passed to `error_handler` (along with the path
+    of the offending AIF) if one is provided, and raised otherwise.
+    """
+    icons = []
+    temporary_directory = scratch.TemporaryDirectory()
+    with temporary_directory as temporary_directory_path:
+        try:
+            if not NATIVE_PARSERS:
+                raise epoc.UnsupportedFile("Native parsers are disabled")
+            info = epoc.read_sis(path)
+            skipped = extract_installer_native(path, temporary_directory_path)
+            aif_path = find_aif(temporary_directory_path)
+            load_icons = functools.partial(get_icons, aif_path)
+        except epoc.UnsupportedFile as e:
+            logging.debug("Using opolua to analyse '%s' (%s).", path, e)
+            shutil.rmtree(temporary_directory_path)
+            os.makedirs(temporary_directory_path)
+            skipped = []
+            info, aif_path, load_icons = analyse_installer_lua(path, temporary_directory_path)
+        if aif_path is not None:
+            try:
+                icons = load_icons()
+            except ResourceLimitExceeded:
+                raise
+            except Exception as e:
+                if error_handler is None:
+                    raise
+                error_handler(aif_path, e)
+        temporary_directory.charge(utils.directory_size(temporary_directory_path))
+        files = {os.path.relpath(file_path, temporary_directory_path): details
+                 for file_path, details in recognize_many(temporary_directory_path).items()}
+        for skipped_path in skipped:
+            prefilter_statistics.record(skipped=True)
+            files[os.path.join(*skipped_path.split("/"))] = {"type": "unknown"}
+    return Installer(uid=info["uid"],
+                     name=info["name"],
+                     version=info["version"],
+                     files=files,
+                     icons=icons)
@@ -0,0 +1,390 @@
+-- Copyright (c) 2024-2026 Jason Morley
+--
+-- Permission is hereby granted, free of charge, to any person obtaining a copy
+-- of this software and associated documentation files (the "Software"), to deal
+-- in the Software without restriction, including without limitation the rights
+-- to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+-- copies of the Software, and to permit persons to whom the Software is
+-- furnished to do so, subject to the following conditions:
+--
+-- The above copyright notice and this permission notice shall be included in all
+-- copies or substantial portions of the Software.
+--
+-- THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+-- IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+-- FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+-- AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+-- LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+-- OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+-- SOFTWARE.
+
+-- Long-lived worker used by `tools/opolua.py` to run the opolua command-line tools without paying for a new Lua
+-- interpreter (and a fresh load of the opolua sources) on every call.
+--
+-- Requests and responses are exchanged over stdin and stdout using a simple length-prefixed framing:
+--
+--   request:  <count>\n followed by <count> items, each encoded as <length>\n<bytes>
+--             The first item is the operation and the second is the path of the tool script to run; any remaining
+--             items are operation-specific (see `operations` below).
+--
+--   response: <status> <stdout length> <stderr length>\n<stdout><stderr>
+--
+-- Tool scripts are run in-process with `arg`, `print`, `io.write`, `io.stdout`, `io.stderr` and `os.exit` redirected
+-- so their output and exit status are captured exactly as they would be when run directly. Modules loaded with
+-- `require` stay cached in `package.loaded` between requests, which is where most of the savings come from.
+--
+-- The worker takes two optional arguments: a memory limit in bytes and a CPU time limit in seconds for each tool
+-- invocation (0 disables the corresponding limit). Tools that exceed a limit fail with a message containing
+-- "Resource limit exceeded".
+
+local stdin = io.stdin
+local stdout = io.stdout
+local stderr = io.stderr
+
+local realPrint = print
+local realWrite = io.write
+local realOutput = io.output
+local realOpen = io.open
+local realExit = os.exit
+
+local memoryLimit = tonumber(arg[1]) or 0
+local timeLimit = tonumber(arg[2]) or 0
+
+local Exit = {}
+local Limit = {}
+
+local chunks = {}
+
+local function loadTool(path)
+    local chunk = chunks[path]
+    if chunk == nil then
+        chunk = assert(loadfile(path))
+        chunks[path] = chunk
+    end
+    return chunk
+end
+
+local function makeStream(buffer)
+    local stream = {}
+    function stream:write(...)
+        for i = 1, select("#", ...) do
+            buffer[#buffer + 1] = tostring((select(i, ...)))
+        end
+        return self
+    end
+    function stream:flush()
+        return self
+    end
+    function stream:setvbuf()
+        return true
+    end
+    function stream:close()
+        return true
+    end
+    return stream
+end
+
+local function setLimits(started)
+    if memoryLimit <= 0 and timeLimit <= 0 then
+        return
+    end
+    debug.sethook(function()
+        if memoryLimit > 0 and collectgarbage("count") * 1024 > memoryLimit then
+            collectgarbage()
+            if collectgarbage("count") * 1024 > memoryLimit then
+                error(setmetatable({ message = "memory" }, Limit), 0)
+            end
+        end
+        if timeLimit > 0 and os.clock() - started > timeLimit then
+            error(setmetatable({ message = "time" }, Limit), 0)
+        end
+    end, "", 10000)
+end
+
+local function exitStatus(code)
+    if code == nil or code == true then
+        return 0
+    elseif code == false then
+        return 1
+    end
+    return math.tointeger(code) or 1
+end
+
+local function readItem()
+    local length = tonumber(stdin:read("l"))
+    if length == nil then
+        return nil
+    elseif length == 0 then
+        return ""
+    end
+    return stdin:read(length)
+end
+
+local function readRequest()
+    local header = stdin:read("l")
+    if header == nil then
+        return nil
+    end
+    local items = {}
+    for i = 1, tonumber(header) do
+        items[i] = assert(readItem(), "Truncated request")
+    end
+    return items
+end
+
+local responses = 0
+
+local function writeResponse(status, output, errors)
+    stdout:write(string.format("%d %d %d\n", status, #output, #errors), output, errors)
+    stdout:flush()
+    responses = responses + 1
+end
+
+local function restoreGlobals()
+    debug.sethook()
+    print = realPrint
+    io.write = realWrite
+    io.output = realOutput
+    io.stdout = stdout
+    io.stderr = stderr
+    os.exit = realExit
+end
+
+local function run(script, ...)
+    local out = {}
+    local err = {}
+    local outStream = makeStream(out)
+    local errStream = makeStream(err)
+
+    arg = { [0] = script, ... }
+    print = function(...)
+        local count = select("#", ...)
+        for i = 1, count do
+            out[#out + 1] = tostring((select(i, ...)))
+            if i < count then
+                out[#out + 1] = "\t"
+            end
+        end
+        out[#out + 1] = "\n"
+    end
+    io.write = function(...)
+        return outStream:write(...)
+    end
+    io.output = function()
+        return outStream
+    end
+    io.stdout = outStream
+    io.stderr = errStream
+    os.exit = function(code)
+        error(setmetatable({ code = code }, Exit), 0)
+    end
+
+    -- Scripts that can't be loaded fail like any other tool error rather than taking the worker down with them.
+    local ok, result = pcall(loadTool, script)
+    if ok then
+        setLimits(os.clock())
+        ok, result = xpcall(result, function(message)
+            if getmetatable(message) == Exit or getmetatable(message) == Limit then
+                return message
+            end
+            return debug.traceback(tostring(message), 2)
+        end, ...)
+    end
+    restoreGlobals()
+
+    local status = 0
+    if not ok then
+        if getmetatable(result) == Exit then
+            status = exitStatus(result.code)
+        elseif getmetatable(result) == Limit then
+            err[#err + 1] = "Resource limit exceeded (" .. result.message .. ")\n"
+            status = 1
+        else
+            err[#err + 1] = "lua: " .. tostring(result) .. "\n"
+            status = 1
+        end
+    end
+    return status, table.concat(out), table.concat(err)
+end
+
+-- Encodes a string as JSON, escaping every byte outside printable ASCII as \u00XX so arbitrary bytes (e.g., cp1252
+-- file names) survive the round trip; the reader recovers them by encoding the decoded string as latin-1.
+local function encodeString(value)
+    return '"' .. (value:gsub('[%c"\\\128-\255]', function(c)
+        return string.format("\\u%04x", c:byte())
+    end)) .. '"'
+end
+
+local function encodeStrings(values)
+    local items = {}
+    for i, value in ipairs(values) do
+        items[i] = encodeString(value)
+    end
+    return "[" .. table.concat(items, ",") .. "]"
+end
+
+-- Calls `f`, returning the paths of the files opened for writing while it ran, followed by its results.
+local function recordWrites(f, ...)
+    local paths = {}
+    io.open = function(path, mode)
+        if mode ~= nil and mode:find("[wa]") then
+            paths[#paths + 1] = path
+        end
+        return realOpen(path, mode)
+    end
+    local results = table.pack(pcall(f, ...))
+    io.open = realOpen
+    if not results[1] then
+        error(results[2], 0)
+    end
+    return paths, table.unpack(results, 2, results.n)
+end
+
+-- Replaces `module[name]` with a version that returns the same result for repeated calls with the same first argument,
+-- returning a function that restores the original. Does nothing if the module (or function) hasn't been loaded.
+local function memoize(module, name)
+    local original = type(module) == "table" and module[name] or nil
+    if type(original) ~= "function" then
+        return function() end
+    end
+    local results = {}
+    module[name] = function(key, ...)
+        local result = results[key]
+        if result == nil then
+            result = table.pack(original(key, ...))
+            results[key] = result
+        end
+        return table.unpack(result, 1, result.n)
+    end
+    return function()
+        module[name] = original
+    end
+end
+
+local AIF_EXTENSIONS = { ".aif", ".aco", ".abw" }
+
+local function findAif(paths)
+    for _, extension in ipairs(AIF_EXTENSIONS) do
+        for _, path in ipairs(paths) do
+            if path:sub(-#extension) == extension then
+                return path
+            end
+        end
+    end
+    return nil
+end
+
+local operations = {}
+
+-- run <script> <arguments...>
+-- Runs the tool once, returning its exit status and output.
+function operations.run(script, ...)
+    writeResponse(run(script, ...))
+end
+
+-- batch <script> <argument count> <arguments...> <paths...>
+-- Runs a JSON-producing tool once for each path, passing the fixed arguments followed by the path, and returns a JSON
+-- array containing the output for each path in order, or an error record of the form {"error": <tool errors>} if the
+-- tool failed for that path (including Lua errors raised while running it, and exceeding a resource limit).
+function operations.batch(script, count, ...)
+    count = tonumber(count)
+    local arguments = table.pack(...)
+    local toolArguments = table.move(arguments, 1, count, 1, {})
+    local results = {}
+    for i = count + 1, arguments.n do
+        toolArguments[count + 1] = arguments[i]
+        local ok, status, output, errors = pcall(run, script, table.unpack(toolArguments, 1, count + 1))
+        if not ok then
+            restoreGlobals()
+            status, output, errors = 1, "", "lua: " .. tostring(status) .. "\n"
+        end
+        output = output:match("^%s*(.-)%s*$")
+        if status == 0 and output ~= "" then
+            results[#results + 1] = output
+        else
+            results[#results + 1] = '{"error":' .. encodeString(errors) .. '}'
+        end
+    end
+    writeResponse(0, "[" .. table.concat(results, ",") .. "]", "")
+end
+
+-- analyse <dumpsis script> <dumpaif script> <installer path> <destination>
+-- Analyses an installer in a single request: reads its metadata with `dumpsis --json`, extracts its payload to
+-- <destination> with `dumpsis`, and extracts the icons of the first AIF in the payload (if any) alongside it with
+-- `dumpaif -e`. Once the SIS module has been loaded, the installer is only parsed once. Responds with a JSON object:
+--
+--   {"info": <dumpsis --json output>, "files": [<paths>], "aif": <path or null>, "icons": [<paths>], "error": <string>}
+--
+-- where "error" is only present if the icons couldn't be extracted. If reading the metadata or extracting the payload
+-- fails, the response instead has a non-zero status, the name of the failing step ("info" or "extract") as its output,
+-- and the tool's output as its errors.
+function operations.analyse(dumpsis, dumpaif, path, destination)
+    local restore = memoize(package.loaded.sis, "parseSisFile")
+    local ok, failure = pcall(function()
+        local status, info, errors = run(dumpsis, "--json", path)
+        if status ~= 0 then
+            writeResponse(status, "info", info .. errors)
+            return
+        end
+
+        local files, status, output, errors = recordWrites(run, dumpsis, path, destination)
+        if status ~= 0 then
+            writeResponse(status, "extract", output .. errors)
+            return
+        end
+
+        local aif = findAif(files)
+        local icons = {}
+        local iconsError = nil
+        if aif ~= nil then
+            icons, status, output, errors = recordWrites(run, dumpaif, "-e", aif)
+            if status ~= 0 then
+                iconsError = output .. errors
+            end
+        end
+
+        local response = {
+            '{"info":', info,
+            ',"files":', encodeStrings(files),
+            ',"aif":', aif ~= nil and encodeString(aif) or "null",
+            ',"icons":', encodeStrings(icons),
+        }
+        if iconsError ~= nil then
+            response[#response + 1] = ',"error":' .. encodeString(iconsError)
+        end
+        response[#response + 1] = "}"
+        writeResponse(0, table.concat(response), "")
+    end)
+    restore()
+    if not ok then
+        error(failure, 0)
+    end
+end
+
+while true do
+    local request = readRequest()
+    if request == nil then
+        break
+    end
+    local operation = operations[request[1]]
+    if operation == nil then
+        writeResponse(1, "", "Unknown operation '" .. tostring(request[1]) .. "'\n")
+    else
+        -- Errors escaping an operation fail the request, not the worker. The response is only written if the operation
+        -- didn't get as far as writing its own; otherwise the error is reported on the worker's stderr.
+        local expected = responses + 1
+        local ok, failure = pcall(operation, table.unpack(request, 2))
+        if not ok then
+            restoreGlobals()
+            io.open = realOpen
+            local message = getmetatable(failure) == Limit and "Resource limit exceeded (" .. failure.message .. ")"
+                or tostring(failure)
+            if responses < expected then
+                writeResponse(1, "", "lua: " .. message .. "\n")
+            else
+                stderr:write("lua: ", message, "\n")
+            end
+        end
+    end
+    collectgarbage()
+end
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Reads zips and ISO images in place on a web server using HTTP range requests, so sources can be indexed without
+# downloading them first. Only the zip central directory (or ISO directory tables) and the members the indexer needs
+# are fetched. Data is fetched in blocks, which are cached on disk (see `BlockCache`) so later runs don't fetch them
+# again.
+
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+import requests
+
+from . import cache
+from . import containers
+from . import iso9660
+from . import model
+
+
+# Set `INDEXER_REMOTE_CONTAINERS=1` to read Internet Archive zips and ISOs remotely rather than downloading them.
+ENABLED = os.environ.get("INDEXER_REMOTE_CONTAINERS", "0") != "0"
+
+# The maximum size of the block cache in megabytes.
+MAXIMUM_CACHE_SIZE = int(os.environ.get("INDEXER_RANGE_CACHE_SIZE", 4096)) * 1024 * 1024
+
+BLOCK_SIZE = 256 * 1024
+READAHEAD_BLOCKS = 16  # Used when reading sequentially (e.g., extracting a large member).
+MEMORY_BLOCKS = 64
+TIMEOUT = 60
+
+REMOTE_EXTENSIONS = [".iso", ".zip"]
+
+# Set to a `BlockCache` to keep fetched blocks across runs.
+block_cache = None
+
+
+class RangeRequestsUnsupported(OSError):
+    pass
+
+
+class TransferStatistics(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+
+    def __str__(self):
+        return f"{self.requests} requests, {self.bytes / (1024 * 1024):.1f} MB"
+
+
+statistics = TransferStatistics()
+
+
+class BlockCache(object):
+    """
+    On-disk cache of the blocks fetched by `RemoteFile`, keyed by URL. Each URL's blocks are discarded if the file
+    changes on the server (detected using its size, ETag, and Last-Modified headers).
+    """
+
+    def __init__(self, path, maximum_size=MAXIMUM_CACHE_SIZE):
+        self.path = path
+        self.maximum_size = maximum_size
+        self.statistics = cache.CacheStatistics()
+        os.makedirs(path, exist_ok=True)
+
+    def _directory_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def validate(self, key, identity):
+        directory_path = self._directory_path(key)
+        identity_path = os.path.join(directory_path, "identity.json")
+        try:
+            with open(identity_path) as fh:
+                if json.load(fh) == identity:
+                    return
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(directory_path, ignore_errors=True)
+        os.makedirs(directory_path, exist_ok=True)
+        self._write(identity_path, json.dumps(identity).encode("utf-8"))
+
+    def _write(self, path, data):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as fh:
+            fh.write(data)
+        os.replace(fh.name, path)
+
+    def get(self, key, index):
+        path = os.path.join(self._directory_path(key), f"{index}.block")
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)  # Mark the block as recently used.
+        except OSError:
+            self.statistics.record(hit=False)
+            return None
+        self.statistics.record(hit=True)
+        return data
+
+    def set(self, key, index, data):
+        try:
+            self._write(os.path.join(self._directory_path(key), f"{index}.block"), data)
+        except OSError as e:
+            # The cache may have been trimmed by another indexer; the block will simply be fetched again next time.
+            logging.debug("Failed to cache block %d of '%s' with error '%s'.", index, key, e)
+
+    def trim(self):
+        """
+        Remove the least recently used blocks until the cache fits within its maximum size.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                if not f.endswith(".block"):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        cache.trim(entries, self.maximum_size, self.statistics, os.unlink)
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable file on a web server, read using HTTP range requests. It can also be indexed and sliced like
+    `bytes` (as used by `iso9660.list_files`). Raises `RangeRequestsUnsupported` if the server doesn't support ranges.
+    """
+
+    def __init__(self, url, block_size=BLOCK_SIZE):
+        super().__init__()
+        self.url = url
+        self.block_size = block_size
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+        self._next_block = None
+        try:
+            response = self._session.head(url, allow_redirects=True, timeout=TIMEOUT)
+            response.raise_for_status()
+            if response.headers.get("Accept-Ranges", "").lower() != "bytes" or "Content-Length" not in response.headers:
+                raise RangeRequestsUnsupported(f"'{url}' doesn't support range requests")
+        except:
+            self._session.close()
+            raise
+        self.size = int(response.headers["Content-Length"])
+        self.identity = {
+            "size": self.size,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        self._key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        if block_cache is not None:
+            block_cache.validate(self._key, self.identity)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        return self._position
+
+    def readinto(self, buffer):
+        data = self.pread(self._position, len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._session.close()
+        super().close()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("Extended slices are not supported")
+            return self.pread(start, stop - start)
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError("Index out of range")
+        return self.pread(key, 1)[0]
+
+    def pread(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        with self._lock:
+            blocks = self._load(first, last)
+        start = offset - first * self.block_size
+        return b"".join(blocks)[start:start + end - offset]
+
+    def _load(self, first, last):
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            data = self._blocks.get(index)
+            if data is None and block_cache is not None:
+                data = block_cache.get(self._key, index)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+
+        # Fetch each run of missing blocks with a single request, reading ahead if the file is being read sequentially.
+        runs = []
+        for index in missing:
+            if runs and runs[-1][-1] == index - 1:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        if runs and first == self._next_block:
+            final_block = (self.size - 1) // self.block_size
+            runs[-1] += [index for index in range(runs[-1][-1] + 1, min(last + READAHEAD_BLOCKS, final_block) + 1)
+                         if index not in self._blocks]
+        for run in runs:
+            blocks.update(self._fetch(run[0], run[-1]))
+        self._next_block = last + 1
+
+        for index, data in blocks.items():
+            self._blocks[index] = data
+            self._blocks.move_to_end(index)
+        while len(self._blocks) > MEMORY_BLOCKS:
+            self._blocks.popitem(last=False)
+        return [blocks[index] for index in range(first, last + 1)]
+
+    def _fetch(self, first, last):
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
+        logging.debug("Fetching bytes %d-%d of '%s'...", start, end, self.url)
+        response = self._session.get(self.url, headers={"Range": f"bytes={start}-{end}"}, timeout=TIMEOUT)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeRequestsUnsupported(f"'{self.url}' ignored a range request")
+        content = response.content
+        if len(content) != end - start + 1:
+            raise OSError(f"Expected {end - start + 1} bytes from '{self.url}' but received {len(content)}")
+        statistics.record(len(content))
+        blocks = {}
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            blocks[index] = content[offset:offset + self.block_size]
+            if block_cache is not None:
+                block_cache.set(self._key, index, blocks[index])
+        return blocks
+
+
+class RemoteZipArchive(containers.ZipArchive):
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.path = url
+
+    def _open_archive(self, path):
+        file = RemoteFile(path)
+        try:
+            return zipfile.ZipFile(file)
+        except:
+            file.close()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        file = self._archive.fp if self._archive is not None else None
+        super().__exit__(exc_type, exc_value, traceback)
+        if file is not None:
+            file.close()
+
+
+class RemoteIsoArchive(containers.IsoArchive):
+
+    def __init__(self, url, files):
+        super().__init__(url, files)
+        self.path = url
+
+    def _open_archive(self, path):
+        return RemoteFile(path)
+
+    def _extract(self, paths):
+        for path in paths:
+            offset, length = self._members[path]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                self._archive.seek(offset)
+                while length > 0:
+                    data = self._archive.read(min(length, 1024 * 1024))
+                    if not data:
+                        raise containers.ExtractionError(f"Unexpected end of '{self.path}'")
+                    fh.write(data)
+                    length -= len(data)
+            self.temporary_directory.charge(self._members[path][1])
+            self._materialized.add(path)
+
+
+def open_archive(url):
+    """
+    Return a streaming archive for the zip or ISO image at `url`, or None if it can't be read remotely (e.g., because
+    the server doesn't support range requests, or the image needs 7-Zip), in which case it needs to be downloaded.
+    """
+    _, ext = os.path.splitext(url.lower())
+    if ext not in REMOTE_EXTENSIONS:
+        return None
+    try:
+        with RemoteFile(url) as file:
+            if ext == ".iso":
+                return RemoteIsoArchive(url, iso9660.list_files(file))
+    except (RangeRequestsUnsupported, iso9660.UnsupportedImage) as e:
+        logging.info("Unable to read '%s' remotely (%s).", url, e)
+        return None
+    except (requests.RequestException, OSError) as e:
+        logging.warning("Failed to read '%s' remotely with error '%s'.", url, e)
+        return None
+    return RemoteZipArchive(url)
+
+
+def walk(archive, path, relative_to):
+    """
+    Walk a remote archive returned by `open_archive` as though it had been downloaded to `path`, so the references
+    match those returned by `containers.walk`.
+    """
+    reference = model.Reference([model.ReferenceItem(name=os.path.relpath(path, relative_to), url=None)])
+    logging.debug("Reading '%s' remotely...", archive.path)
+    try:
+        container = archive.__enter__()
+    except containers.CONTAINER_ERRORS as e:
+        logging.warning("Failed to read file '%s' with error '%s'.", archive.path, e)
+        return
+    try:
+        yield from containers.walk_container(container, reference)
+    except containers.CONTAINER_ERRORS as e:
+        logging.warning("Failed to read file '%s' with error '%s'.", archive.path, e)
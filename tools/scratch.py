@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2026 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Scratch space for extracting containers and installers during indexing.
+#
+# Scratch directories are created in `INDEXER_SCRATCH_DIRECTORY` (e.g., a tmpfs mount such as `/dev/shm`), falling back
+# to the system temporary directory. Writers charge the space they use to their directory, and once the total exceeds
+# `INDEXER_SCRATCH_BUDGET` megabytes, threads wait before starting new top-level work until enough space has been freed.
+# Nested directories (e.g., a zip inside an ISO) never wait, so work that's already in progress can always finish.
+
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+SCRATCH_DIRECTORY = os.environ.get("INDEXER_SCRATCH_DIRECTORY") or None
+SCRATCH_BUDGET = int(os.environ.get("INDEXER_SCRATCH_BUDGET", 0)) * 1024 * 1024  # 0 disables the budget.
+
+
+class ScratchManager(object):
+
+    def __init__(self, path=SCRATCH_DIRECTORY, budget=SCRATCH_BUDGET):
+        self.path = path
+        self.budget = budget
+        self.usage = 0
+        self.peak_usage = 0
+        self.active = 0
+        self.waits = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def acquire(self):
+        depth = getattr(self._local, "depth", 0)
+        with self._condition:
+            if depth == 0 and self.budget > 0 and self.usage >= self.budget and self.active > 0:
+                self.waits += 1
+                logging.debug("Waiting for scratch space (%d MB in use)...", self.usage // (1024 * 1024))
+                self._condition.wait_for(lambda: self.usage < self.budget or self.active == 0)
+            self.active += 1
+        self._local.depth = depth + 1
+
+    def has_space(self):
+        """
+        Return whether the scratch space is within budget, for work that can be put off rather than waiting.
+        """
+        with self._condition:
+            return self.budget <= 0 or self.usage < self.budget
+
+    def release(self, size):
+        self._local.depth = max(getattr(self._local, "depth", 0) - 1, 0)
+        with self._condition:
+            self.active -= 1
+            self.usage -= size
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def nested(self):
+        """
+        Treat scratch directories created by the current thread as nested within work that's already in progress (e.g.,
+        when importing an asset on another thread while the walk holds containers open), so they never wait.
+        """
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+
+    def charge(self, size):
+        with self._condition:
+            self.usage += size
+            self.peak_usage = max(self.peak_usage, self.usage)
+
+    def __str__(self):
+        return (f"peak usage {self.peak_usage / (1024 * 1024):.1f} MB in '{self.path or tempfile.gettempdir()}' "
+                f"({self.waits} waits)")
+
+
+manager = ScratchManager()
+
+
+class TemporaryDirectory(object):
+    """
+    Drop-in replacement for `tempfile.TemporaryDirectory` that's placed in, and accounted against, the scratch space.
+    Use `charge` to record the space used by files written to the directory.
+    """
+
+    def __init__(self):
+        manager.acquire()
+        try:
+            self.name = tempfile.mkdtemp(dir=manager.path)
+        except:
+            manager.release(0)
+            raise
+        self.size = 0
+        self._cleaned_up = False
+
+    def charge(self, size):
+        self.size += size
+        manager.charge(size)
+
+    def cleanup(self):
+        if self._cleaned_up:
+            return
+        self._cleaned_up = True
+        shutil.rmtree(self.name, ignore_errors=True)
+        manager.release(self.size)
+
+    def __enter__(self):
+        return self.name
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
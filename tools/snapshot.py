@@ -23,12 +23,15 @@
 import argparse
 import contextlib
 import datetime
+import hashlib
 import json
 import logging
 import os
+import struct
 import subprocess
 import sys
 import tempfile
+import zipfile
 
 from urllib.parse import urlparse
 
@@ -46,6 +49,20 @@ CONFIG_PATH = os.path.expanduser("~/.config/psion-software-index/snapshot-config
 
 USER_AGENT = "Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0"
 
+# Snapshots are tar.gz archives containing 'metadata.json', the wget log ('log.txt'), and the mirrored site. The site is
+# stored as an uncompressed zip ('contents.zip'; the outer archive takes care of compression) along with a member table
+# ('contents.json') giving the path, data offset, size, and sha256 of every file. This lets the indexer read individual
+# files in place, and identify a snapshot without hashing the whole site.
+#
+# Older snapshots store the site as 'contents.tar.gz', which has to be extracted in full to be read; these can be
+# converted with `migrate` (see `manage migrate-snapshots`).
+CONTENTS_FILENAME = "contents.zip"
+MEMBERS_FILENAME = "contents.json"
+LEGACY_CONTENTS_FILENAME = "contents.tar.gz"
+FORMAT_VERSION = 1
+
+LOCAL_FILE_HEADER_SIZE = 30
+
 
 verbose = '--verbose' in sys.argv[1:] or '-v' in sys.argv[1:]
 logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%(levelname)s] %(message)s")
@@ -63,7 +80,7 @@ def mirror_site(url, path, log_path):
                                  "--user-agent", USER_AGENT,
                                  "-o", log_path,
                                  url])
-        tar("root", path)
+        pack("root", path)
         return result.returncode
 
 
@@ -75,6 +92,111 @@ def tar(source, destination):
                            "."])
 
 
+def untar(source, destination):
+    subprocess.check_call(["tar",
+                           "-zxf",
+                           source,
+                           "-C", destination])
+
+
+def pack(source, destination):
+    """
+    Write the files in directory `source` to directory `destination` as snapshot contents (see `CONTENTS_FILENAME`),
+    along with their member table. The table is written last, so its presence marks the contents as complete.
+    """
+    contents_path = os.path.join(destination, CONTENTS_FILENAME)
+    members_path = os.path.join(destination, MEMBERS_FILENAME)
+
+    paths = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            if os.path.islink(path):
+                logging.warning("Skipping symbolic link '%s'.", os.path.relpath(path, source))
+                continue
+            paths.append(path)
+
+    members = []
+    with tempfile.NamedTemporaryFile(dir=destination, delete=False) as fh:
+        temporary_contents_path = fh.name
+    try:
+        with zipfile.ZipFile(temporary_contents_path, "w", compression=zipfile.ZIP_STORED) as archive:
+            for path in paths:
+                name = os.path.relpath(path, source).replace(os.path.sep, "/")
+                info = zipfile.ZipInfo.from_file(path, name, strict_timestamps=False)
+                sha256 = hashlib.sha256()
+                with open(path, "rb") as source_file, \
+                        archive.open(info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as destination_file:
+                    while data := source_file.read(65536):
+                        sha256.update(data)
+                        destination_file.write(data)
+                members.append({
+                    "path": name,
+                    "size": info.file_size,
+                    "sha256": sha256.hexdigest(),
+                })
+
+        # The data offsets are only known once the local headers have been written.
+        with open(temporary_contents_path, "rb") as fh, zipfile.ZipFile(fh) as archive:
+            for member, info in zip(members, archive.infolist()):
+                fh.seek(info.header_offset)
+                name_length, extra_length = struct.unpack("<HH", fh.read(LOCAL_FILE_HEADER_SIZE)[26:])
+                member["offset"] = info.header_offset + LOCAL_FILE_HEADER_SIZE + name_length + extra_length
+
+        os.replace(temporary_contents_path, contents_path)
+    except:
+        os.unlink(temporary_contents_path)
+        raise
+
+    with open(members_path + ".tmp", "w") as fh:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "members": members,
+        }, fh, indent=4)
+        fh.write("\n")
+    os.replace(members_path + ".tmp", members_path)
+
+
+def read_members(path):
+    """
+    Return the member table for the snapshot directory `path`, or None if it's in the legacy format.
+    """
+    try:
+        with open(os.path.join(path, MEMBERS_FILENAME)) as fh:
+            table = json.load(fh)
+    except FileNotFoundError:
+        return None
+    if table["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version {table['version']}")
+    return table["members"]
+
+
+def migrate(path):
+    """
+    Convert a snapshot in the legacy format to the current format. `path` is either a synced snapshot directory, which
+    is converted in place, or a snapshot archive, which is rewritten. Returns False if the snapshot didn't need
+    converting.
+    """
+    if not os.path.isdir(path):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            untar(path, temporary_directory)
+            if not migrate(temporary_directory):
+                return False
+            tar(temporary_directory, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return True
+
+    legacy_contents_path = os.path.join(path, LEGACY_CONTENTS_FILENAME)
+    if not os.path.exists(legacy_contents_path):
+        return False
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        untar(legacy_contents_path, temporary_directory)
+        pack(temporary_directory, path)
+    os.remove(legacy_contents_path)
+    return True
+
+
 def get_title(url):
     response = requests.get(url, headers={
         "User-Agent": USER_AGENT,
@@ -112,7 +234,7 @@ def main():
         title = get_title(url)
 
         # Create an archive of the site.
-        returncode = mirror_site(url, "contents.tar.gz", "log.txt")
+        returncode = mirror_site(url, temporary_directory, "log.txt")
 
         # Write the metadata.
         metadata = {
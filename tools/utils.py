@@ -20,12 +20,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextlib
+import fcntl
 import hashlib
 import logging
 import os
 import requests
 import shutil
 import tempfile
+import time
 
 from tqdm import tqdm
 
@@ -49,19 +52,116 @@ def listdir(path, include_hidden):
     return [f for f in os.listdir(path) if (include_hidden or not f.startswith("."))]
 
 
-def shasum(path):
+# Set to a `cache.FingerprintCache` to look up the hashes of unchanged files rather than reading them.
+fingerprint_cache = None
+
+
+def fingerprint(stat):
+    # Identifies the contents of a file without reading it; any change to the file changes its change time.
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+def file_shasum(path):
     sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def shasum(path):
     if os.path.isdir(path):
+        sha256 = hashlib.sha256()
         for f in sorted(listdir(path, include_hidden=False)):
             sha256.update(shasum(os.path.join(path, f)).encode('utf-8'))
-    else:
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(65536)
-                if not data:
-                    break
-                sha256.update(data)
-    return sha256.hexdigest()
+        return sha256.hexdigest()
+    if fingerprint_cache is not None:
+        return fingerprint_cache.shasum(path)
+    return file_shasum(path)
+
+
+@contextlib.contextmanager
+def ingest(path, directory, name=None):
+    """
+    Copy a file into the content-addressed `directory`, hashing it as it's copied, and yield its sha256. The copy is
+    renamed into place as `<sha256>` (or `<sha256>/<name>`) once the block completes, and discarded if the block raises
+    an exception or the store already contains the file.
+    """
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".ingest-", delete=False) as destination:
+        temporary_path = destination.name
+        try:
+            with open(path, "rb") as source:
+                source_fingerprint = fingerprint(os.fstat(source.fileno()))
+                hashed_at = time.time_ns()
+                while data := source.read(1024 * 1024):
+                    sha256.update(data)
+                    destination.write(data)
+        except:
+            os.unlink(temporary_path)
+            raise
+    digest = sha256.hexdigest()
+    try:
+        if fingerprint_cache is not None:
+            fingerprint_cache.record(path, source_fingerprint, digest, hashed_at)
+        yield digest
+        destination_path = os.path.join(directory, digest)
+        try:
+            if name is not None:
+                os.mkdir(destination_path)
+                os.replace(temporary_path, os.path.join(destination_path, name))
+            elif not os.path.exists(destination_path):
+                os.replace(temporary_path, destination_path)
+        except FileExistsError:
+            pass
+    finally:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def link_or_copy(source, destination):
+    """
+    Publish `source` at `destination` without copying its contents where possible, trying a hard link, then a copy-on-
+    write clone (reflink), and falling back to a copy. Any existing file at `destination` is replaced rather than
+    overwritten, as it may itself be linked. Files published this way must never be modified in place.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    clone = getattr(fcntl, "FICLONE", None)
+    if clone is not None:
+        try:
+            with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+                fcntl.ioctl(destination_file.fileno(), clone, source_file.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+def link_tree(source, destination):
+    """
+    Equivalent to `shutil.copytree`, publishing each file with `link_or_copy`.
+    """
+    shutil.copytree(source, destination, copy_function=link_or_copy)
 
 
 def merge_files(source, destination):
@@ -69,7 +169,7 @@ def merge_files(source, destination):
         source_path = os.path.join(source, f)
         destination_path = os.path.join(destination, f)
         if not os.path.exists(destination_path):
-            shutil.copy(source_path, destination_path)
+            link_or_copy(source_path, destination_path)
 
 
 def safe_identifier(id):